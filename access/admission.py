@@ -0,0 +1,178 @@
+"""
+Admission control of websocket connections
+
+Wraps the websocket application of metamap.asgi in front of AuthMiddlewareStack, a
+connection turned away never reaches the session and user tables:
+
+    AdmissionMiddleware(AuthMiddlewareStack(URLRouter(...)), max_connections=10000,
+                        rate=200, burst=400)
+
+A worker process admits at most `max_connections` websockets at a time, and new ones at
+`rate` per second with bursts of `burst` (a token bucket), so a reconnect storm is spread
+out instead of landing on the auth database at once. A rejected client gets one frame
+and the close code 1013 (try again later):
+
+    {"type": "rejected", "reason": "full", "retry_after": 5}
+
+daphne answers a close before the handshake with a bare 403, the handshake is accepted
+so the client can see the hint.
+
+Every `report_interval` seconds each worker sends its live count to the circus plugin
+access.plugins.ConnectionCounts, one UDP datagram "pid;connections;max_connections".
+
+A worker about to be replaced by `manage.py deploy rollout` gets DRAIN_SIGNAL, from then
+on it turns every new websocket away ("reason": "draining") while the open ones finish,
+the shared socket keeps handing it connections until it stops.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import signal
+import socket
+import time
+from typing import Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+# try again later
+CLOSE_CODE = 1013
+
+DRAIN_SIGNAL = signal.SIGUSR1
+
+_draining = False
+
+LOGGER = logging.getLogger('django')
+
+CONNECTIONS = Gauge('access_connections', 'Websocket connections of this process')
+REJECTED = Counter(
+    'access_rejected_total', 'Websocket connections turned away', ['reason']
+)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def take(self) -> float:
+        """0 when a token was taken, otherwise the seconds until there is one"""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+def start_draining(signum=None, frame=None):
+    """Turn new websockets away from now on, this process is about to stop"""
+    global _draining
+
+    _draining = True
+
+
+def install_drain_handler():
+    """DRAIN_SIGNAL starts draining, from the main thread only"""
+    signal.signal(DRAIN_SIGNAL, start_draining)
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+class AdmissionMiddleware:
+    def __init__(
+        self,
+        inner,
+        max_connections: Optional[int] = None,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        retry_after: float = 5,
+        report_to: Optional[str] = None,
+        report_interval: float = 1,
+    ):
+        self.inner = inner
+        self.max_connections = max_connections
+        self.bucket = None
+        if rate:
+            self.bucket = TokenBucket(rate, burst or rate)
+        self.retry_after = retry_after
+        self.connections = 0
+        self.report_to = parse_address(report_to) if report_to else None
+        self.report_interval = report_interval
+        self.report_socket = None
+
+    def admit(self) -> Optional[Tuple[str, float]]:
+        """None when the connection is admitted, otherwise (reason, retry after)"""
+        if _draining:
+            # any other process of the socket takes it right away
+            return 'draining', 0
+        if self.max_connections is not None and (
+            self.connections >= self.max_connections
+        ):
+            return 'full', self.retry_after
+        if self.bucket is not None:
+            wait = self.bucket.take()
+            if wait:
+                return 'rate', wait
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'websocket':
+            return await self.inner(scope, receive, send)
+        if self.report_to is not None and self.report_socket is None:
+            self.start_reports()
+
+        rejection = self.admit()
+        if rejection is not None:
+            REJECTED.labels(rejection[0]).inc()
+            await self.reject(receive, send, *rejection)
+            return
+
+        self.connections += 1
+        CONNECTIONS.inc()
+        try:
+            return await self.inner(scope, receive, send)
+        finally:
+            self.connections -= 1
+            CONNECTIONS.dec()
+
+    @staticmethod
+    async def reject(receive, send, reason: str, retry_after: float):
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        await send({'type': 'websocket.accept'})
+        await send(
+            {
+                'type': 'websocket.send',
+                'text': json.dumps(
+                    {
+                        'type': 'rejected',
+                        'reason': reason,
+                        'retry_after': math.ceil(retry_after),
+                    }
+                ),
+            }
+        )
+        await send({'type': 'websocket.close', 'code': CLOSE_CODE})
+
+    def start_reports(self):
+        self.report_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.report_socket.setblocking(False)
+        asyncio.get_running_loop().call_soon(self.report)
+
+    def report(self):
+        message = f'{os.getpid()};{self.connections};{self.max_connections or ""}'
+        try:
+            self.report_socket.sendto(message.encode(), self.report_to)
+        except OSError as e:
+            LOGGER.debug('connection count not reported', exc_info=e)
+        asyncio.get_running_loop().call_later(self.report_interval, self.report)
@@ -0,0 +1,140 @@
+"""
+Database free authentication of websocket connections
+
+AuthMiddlewareStack loads the session and then the user row on every connect, during a
+reconnect storm those two queries are the bottleneck. A client gets a short lived token
+over HTTP (POST /api-extra/access/token with its session) and connects with it:
+
+    ws://host/ws/access/room/?token=42:1700000000:alice:<signature>
+
+The token is an HMAC (django.core.signing, keyed by SECRET_KEY) over the user id, the
+username and the expiry, it is verified in memory. scope['user'] is a TokenUser then,
+carrying what the token says, or the full user from an LRU of resolved users when
+`user_cache_size` is set, a miss costs one query.
+
+Connections without a token go through AuthMiddlewareStack as before, an invalid or
+expired token gets the AnonymousUser, never a fallback to the database.
+"""
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core import signing
+
+SALT = 'access.auth'
+
+
+def options() -> dict:
+    return getattr(settings, 'ACCESS_TOKEN', {})
+
+
+def make_token(user, ttl: Optional[float] = None) -> str:
+    """A connection token of the user, valid for ttl seconds"""
+    if ttl is None:
+        ttl = options().get('ttl', 300)
+    expires_at = int(time.time() + ttl)
+    return signing.Signer(salt=SALT).sign(
+        f'{user.pk}:{expires_at}:{user.username or ""}'
+    )
+
+
+def verify_token(token: str) -> Optional[Tuple[int, str]]:
+    """(user id, username) of a genuine token not expired yet, None otherwise"""
+    try:
+        value = signing.Signer(salt=SALT).unsign(token)
+    except signing.BadSignature:
+        return None
+    try:
+        user_id, expires_at, username = value.split(':', 2)
+        if int(expires_at) < time.time():
+            return None
+        return int(user_id), username
+    except ValueError:
+        return None
+
+
+class TokenUser:
+    """The user a token was issued to, without its row"""
+
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True
+
+    def __init__(self, user_id: int, username: str):
+        self.pk = self.id = user_id
+        self.username = username
+
+    def __str__(self):
+        return self.username
+
+    def __eq__(self, other):
+        return isinstance(other, TokenUser) and other.pk == self.pk
+
+    def __hash__(self):
+        return hash(self.pk)
+
+
+class UserCache:
+    """The last `maxsize` users resolved, each kept for `ttl` seconds"""
+
+    def __init__(self, maxsize: int, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # user id -> (user, expire at), the least recently used first
+        self.users: OrderedDict = OrderedDict()
+
+    async def get(self, user_id: int):
+        entry = self.users.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self.users.move_to_end(user_id)
+            return entry[0]
+        user = await self.load(user_id)
+        self.users[user_id] = (user, time.monotonic() + self.ttl)
+        self.users.move_to_end(user_id)
+        while len(self.users) > self.maxsize:
+            self.users.popitem(last=False)
+        return user
+
+    @staticmethod
+    @database_sync_to_async
+    def load(user_id: int):
+        user = get_user_model().objects.filter(pk=user_id, is_active=True).first()
+        return user or AnonymousUser()
+
+
+class TokenAuthMiddleware:
+    def __init__(self, inner, fallback, user_cache: Optional[UserCache] = None):
+        self.inner = inner
+        self.fallback = fallback
+        self.user_cache = user_cache
+
+    async def __call__(self, scope, receive, send):
+        tokens = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('token')
+        if not tokens:
+            return await self.fallback(scope, receive, send)
+
+        scope = dict(scope)
+        verified = verify_token(tokens[-1])
+        if verified is None:
+            scope['user'] = AnonymousUser()
+        elif self.user_cache is not None:
+            scope['user'] = await self.user_cache.get(verified[0])
+        else:
+            scope['user'] = TokenUser(*verified)
+        return await self.inner(scope, receive, send)
+
+
+def TokenAuthMiddlewareStack(inner):
+    """Token authentication, AuthMiddlewareStack for the connections without one"""
+    user_cache = None
+    if options().get('user_cache_size'):
+        user_cache = UserCache(
+            options()['user_cache_size'], ttl=options().get('user_cache_ttl', 60)
+        )
+    return TokenAuthMiddleware(inner, AuthMiddlewareStack(inner), user_cache=user_cache)
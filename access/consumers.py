@@ -1,52 +1,223 @@
+import asyncio
 import json
 import logging
+import uuid
 
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+
+from access.fanout import batch_frame_of, get_fanout
+from access.history import get_history, max_replay, parse_resume
+from access.outbox import Outbox
+from access.presence import get_notifier, get_presence, heartbeat_interval
+from access.protocol import (
+    MSGPACK_SUBPROTOCOL,
+    OP_DISPATCH,
+    OP_KEYED_MESSAGE,
+    Payload,
+    ProtocolError,
+    decode_binary,
+    decode_text,
+    encode_dispatch,
+    negotiate,
+    replay_frames,
+)
+from server.drivers import AsyncDriver
+from server.registry import (
+    Dispatcher,
+    InvalidMessage,
+    MessageTypeNotFound,
+    NotAllowed,
+    parse_message,
+)
+from server.replay import recorder_from_settings
 
 
 class AccessConsumer(AsyncWebsocketConsumer):
     LOGGER = logging.getLogger('django')
+    dispatcher = Dispatcher(AsyncDriver(), recorder=recorder_from_settings())
 
     def __init__(self, *args, **kwargs):
         self.group_name = None
+        self.subprotocol = None
+        self.member = None
+        self.heartbeat_task = None
+        self.outbox = None
+        # live frames up to this sequence number were in the replay already
+        self.replayed_seq = None
         super().__init__(*args, **kwargs)
 
+    @staticmethod
+    def group_name_of(name: str) -> str:
+        return f'group_{name}'
+
     async def connect(self):
         user = self.scope['user']
         self.LOGGER.info('user is %s', user)
-        self.group_name = self.scope['url_route']['kwargs']['group_name']
-        self.group_name = f'group_{self.group_name}'
+        self.group_name = self.group_name_of(
+            self.scope['url_route']['kwargs']['group_name']
+        )
+        options = getattr(settings, 'ACCESS_OUTBOX', {})
+        self.outbox = Outbox(
+            self.send,
+            self.close,
+            maxsize=options.get('maxsize', 100),
+            policy=options.get('policy', 'drop_oldest'),
+        )
         await self.channel_layer.group_add(self.group_name, self.channel_name)
-        await self.accept()
+        self.subprotocol = negotiate(self.scope.get('subprotocols', ()))
+        await self.accept(subprotocol=self.subprotocol)
+        self.member = {
+            'channel': self.channel_name,
+            'user': user.username if user.is_authenticated else None,
+        }
+        resume = parse_resume(self.scope.get('query_string', b''))
+        if resume is not None:
+            await self.replay(resume)
         await self.say_hi()
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
 
-    async def say_hi(self):
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                'type': 'handle_message',
-                'message': f'{self.channel_name} joined!',
-            },
+    async def replay(self, after: int):
+        """What the group got after sequence number `after`, in one frame"""
+        history = get_history()
+        payloads, seq, complete = [], after, False
+        if history is not None:
+            try:
+                raws, seq, complete = await history.since(
+                    self.group_name, after, max_replay()
+                )
+                payloads = [Payload(raw=raw) for raw in raws]
+            except Exception as e:
+                self.LOGGER.warning(
+                    'history of %s not read', self.group_name, exc_info=e
+                )
+        self.replayed_seq = seq
+        text, binary = replay_frames(payloads, seq, complete)
+        if self.binary:
+            self.outbox.put(bytes_data=binary)
+        else:
+            self.outbox.put(text_data=text)
+
+    async def broadcast(self, message, key=None):
+        """Coalesced with the other messages to the group, see access.fanout"""
+        await get_fanout().publish(
+            self.channel_layer, self.group_name, message, message_key=key
         )
 
+    async def say_hi(self):
+        """Joins are announced in batches, see access.presence"""
+        try:
+            await get_presence().join(self.group_name, self.member)
+        except Exception as e:
+            self.LOGGER.warning(
+                'presence of %s not stored', self.channel_name, exc_info=e
+            )
+        get_notifier().joined(self.channel_layer, self.group_name, self.member)
+
     async def say_bye(self):
-        await self.channel_layer.group_send(
-            self.group_name,
-            {'type': 'handle_message', 'message': f'{self.channel_name} left!'},
-        )
+        try:
+            await get_presence().leave(self.group_name, self.member)
+        except Exception as e:
+            # expires after the presence ttl
+            self.LOGGER.warning(
+                'presence of %s not removed', self.channel_name, exc_info=e
+            )
+        get_notifier().left(self.channel_layer, self.group_name, self.member)
+
+    async def heartbeat(self):
+        """Keep the presence and the channel layer group membership from expiring"""
+        while True:
+            await asyncio.sleep(heartbeat_interval())
+            try:
+                await get_presence().heartbeat(self.group_name, self.member)
+                await self.channel_layer.group_add(self.group_name, self.channel_name)
+            except Exception as e:
+                self.LOGGER.warning(
+                    'heartbeat of %s failed', self.channel_name, exc_info=e
+                )
 
     async def disconnect(self, code):
-        await self.say_bye()
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        if self.outbox is not None:
+            await self.outbox.stop()
+        if self.member is not None:
+            await self.say_bye()
         await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
+    @property
+    def binary(self) -> bool:
+        return self.subprotocol == MSGPACK_SUBPROTOCOL
+
     async def receive(self, text_data=None, bytes_data=None):
-        data = text_data or bytes_data
-        text_data_json = json.loads(data)
-        message = text_data_json['message']
-        await self.channel_layer.group_send(
-            self.group_name, {'type': 'handle_message', 'message': message}
-        )
+        try:
+            if bytes_data is not None and self.binary:
+                op, data = decode_binary(bytes_data)
+            else:
+                op, data = decode_text(text_data or bytes_data)
+        except ProtocolError as e:
+            self.LOGGER.info('invalid frame from %s: %s', self.channel_name, e)
+            self.reply({'type': None, 'error': f'invalid frame: {e}'})
+            return
+        if op == OP_DISPATCH:
+            # a message for the handlers in server.servers, reply to the sender only
+            await self.dispatch_message(data)
+        elif op == OP_KEYED_MESSAGE:
+            key, payload = data
+            await self.broadcast(payload, key=key)
+        else:
+            # forwarded as encoded by the client
+            await self.broadcast(data)
+
+    async def dispatch_message(self, data):
+        """A handler error is replied to the sender, the consumer stays up"""
+        reply = {'type': None}
+        if isinstance(data, dict):
+            reply['type'] = data.get('type')
+            if 'id' in data:
+                reply['id'] = data['id']
+        try:
+            message = parse_message(data, user=self.scope.get('user'))
+            reply['data'] = await self.dispatcher.dispatch(message)
+        except MessageTypeNotFound:
+            reply['error'] = f'unknown message type {reply["type"]}'
+        except (InvalidMessage, NotAllowed) as e:
+            reply['error'] = str(e)
+        except Exception as e:
+            self.LOGGER.warning('handler of %s failed', reply['type'], exc_info=e)
+            reply['error'] = f'{reply["type"]} failed'
+        self.reply(reply)
+
+    def reply(self, reply: dict):
+        """To the sender only, in the encoding of its frames"""
+        if self.binary:
+            self.outbox.put(bytes_data=encode_dispatch(reply))
+        else:
+            self.outbox.put(text_data=json.dumps(reply))
 
     async def handle_message(self, event):
-        message = event['message']
-        await self.send(text_data=json.dumps({'message': message}))
+        """One message from a process sending handle.message still, during a rollout"""
+        await self.handle_batch(
+            {
+                'type': 'handle_batch',
+                'id': uuid.uuid4().hex,
+                'payloads': [Payload(event['message']).raw],
+            }
+        )
+
+    async def handle_batch(self, event):
+        """Queued in the outbox, a slow client never holds up this consumer"""
+        seq = event.get('seq')
+        if (
+            seq is not None
+            and self.replayed_seq is not None
+            and seq <= self.replayed_seq
+        ):
+            # joined the group before reading the history, sent with the replay
+            return
+        key = event.get('key')
+        frame = batch_frame_of(event, self.binary)
+        if self.binary:
+            self.outbox.put(key, bytes_data=frame)
+        elif frame is not None:
+            self.outbox.put(key, text_data=frame)
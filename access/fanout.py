@@ -0,0 +1,185 @@
+"""
+Coalesced group fan-out
+
+Every broadcast used to cost one `group_send` (one Redis round trip per member shard) and
+one `json.dumps` per recipient. Messages to the same group are now collected for a short
+window and sent as one event carrying a pre-serialized frame, consumers forward that frame
+untouched:
+
+    await get_fanout().publish(channel_layer, 'group_room', 'hello')
+
+A lone message keeps the single message frame, so quiet groups see no change:
+
+    {"message": "hello"}
+    {"messages": ["hello", "again", ...]}
+
+The event carries the payloads msgpack encoded, as msgpack clients sent them. Each
+process builds the frames of a batch only for the encodings its consumers speak, once per
+batch (`batch_frame_of`): a batch only msgpack clients get is never decoded, one only JSON
+clients get is never encoded to a binary frame, see access.protocol.
+A message published with a key replaces the one with the same key in the window, and is
+sent on its own so outboxes can coalesce it too, see access.outbox.
+
+The window is settings.ACCESS_FANOUT['window_ms'], 0 sends every message right away.
+With settings.ACCESS_HISTORY a batch is numbered and kept for resuming clients before it
+is sent, the frames carry its last sequence number, see access.history.
+"""
+import asyncio
+import logging
+import uuid
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
+
+from django.conf import settings
+
+from access.history import get_history
+from access.protocol import Payload, binary_frame, json_frame
+
+LOGGER = logging.getLogger('django')
+
+
+class GroupFanout:
+    """Batches of one event loop, groups are flushed independently"""
+
+    def __init__(self, window: float = 0.01, max_batch: int = 500):
+        self.window = window
+        self.max_batch = max_batch
+        # (channel layer, group) -> messages waiting for the window to close
+        self.pending: Dict[tuple, List] = {}
+        # (channel layer, group) -> {key: latest message with that key}
+        self.keyed: Dict[tuple, Dict[str, Payload]] = {}
+        self.timers: Dict[tuple, asyncio.TimerHandle] = {}
+        # (channel layer, group) -> [lock, flushes using it], batches of a group are sent
+        # in order even when a max_batch flush overtakes the timer one
+        self.locks: Dict[tuple, list] = {}
+        self.tasks = set()
+
+    async def publish(
+        self, channel_layer, group: str, message, message_key: Optional[str] = None
+    ):
+        """message: any msgpack/JSON serializable value, or a Payload"""
+        if not isinstance(message, Payload):
+            message = Payload(message)
+        if self.window <= 0:
+            await self.send(channel_layer, group, [message], message_key)
+            return
+
+        key = (channel_layer, group)
+        if message_key is None:
+            self.pending.setdefault(key, []).append(message)
+        else:
+            self.keyed.setdefault(key, {})[message_key] = message
+        size = len(self.pending.get(key, ())) + len(self.keyed.get(key, ()))
+        if size >= self.max_batch:
+            await self.flush(key)
+        elif key not in self.timers:
+            loop = asyncio.get_running_loop()
+            self.timers[key] = loop.call_later(self.window, self.flush_later, key)
+
+    def flush_later(self, key: tuple):
+        task = asyncio.ensure_future(self.flush(key))
+        # keep a reference, the loop only holds weak ones
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self, key: tuple):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self.send_pending(key)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+    async def send_pending(self, key: tuple):
+        batch = self.pending.pop(key, None)
+        keyed = self.keyed.pop(key, {})
+        channel_layer, group = key
+        try:
+            if batch:
+                await self.send(channel_layer, group, batch)
+            for message_key, message in keyed.items():
+                await self.send(channel_layer, group, [message], message_key)
+        except Exception as e:
+            LOGGER.warning('messages to %s not sent', group, exc_info=e)
+
+    async def flush_all(self):
+        keys = set(self.pending) | set(self.keyed)
+        await asyncio.gather(*(self.flush(key) for key in keys))
+
+    @staticmethod
+    async def send(
+        channel_layer,
+        group: str,
+        messages: List[Payload],
+        message_key: Optional[str] = None,
+    ):
+        seq = None
+        history = get_history()
+        if history is not None:
+            try:
+                seq = await history.append(group, [message.raw for message in messages])
+            except Exception as e:
+                # still delivered live, only a resume misses them
+                LOGGER.warning('history of %s not stored', group, exc_info=e)
+        # the frames are built by the processes delivering it, see batch_frame_of
+        event = {
+            'type': 'handle_batch',
+            'id': uuid.uuid4().hex,
+            'payloads': [message.raw for message in messages],
+        }
+        if message_key is not None:
+            event['key'] = message_key
+        if seq is not None:
+            event['seq'] = seq
+        await channel_layer.group_send(group, event)
+
+
+# (batch id, binary) -> frame, of the last batches delivered in this process
+_frames: 'OrderedDict[tuple, Union[str, bytes, None]]' = OrderedDict()
+FRAME_CACHE_SIZE = 256
+
+
+def batch_frame_of(event: dict, binary: bool) -> Union[str, bytes, None]:
+    """
+    The frame of a handle_batch event for a msgpack (binary) or a JSON consumer, built by
+    the first consumer of the process that needs it, None when no payload has a JSON form
+    """
+    key = (event['id'], binary)
+    try:
+        return _frames[key]
+    except KeyError:
+        pass
+    payloads = [Payload(raw=raw) for raw in event['payloads']]
+    if binary:
+        frame = binary_frame(payloads, event.get('seq'))
+    else:
+        frame = json_frame(payloads, event.get('seq'))
+    _frames[key] = frame
+    if len(_frames) > FRAME_CACHE_SIZE:
+        _frames.popitem(last=False)
+    return frame
+
+
+_fanouts: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, GroupFanout]' = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_fanout() -> GroupFanout:
+    """The fan-out of the running event loop, configured by settings.ACCESS_FANOUT"""
+    loop = asyncio.get_running_loop()
+    fanout = _fanouts.get(loop)
+    if fanout is None:
+        options = getattr(settings, 'ACCESS_FANOUT', {})
+        fanout = _fanouts[loop] = GroupFanout(
+            window=options.get('window_ms', 10) / 1000,
+            max_batch=options.get('max_batch', 500),
+        )
+    return fanout
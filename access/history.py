@@ -0,0 +1,179 @@
+"""
+Sequence numbers and recent history of websocket groups
+
+Every message sent to a group gets the next sequence number of the group and is kept in a
+bounded buffer. Frames carry the sequence number of their last message, messages of a
+batch are consecutive:
+
+    {"message": "hello", "seq": 41}
+    {"messages": ["a", "b", "c"], "seq": 44}     # a is 42, b 43, c 44
+
+A client reconnecting with ?resume=41 gets everything after 41 in one frame, then the
+live frames. `complete` is false when the buffer no longer reaches back to 42 or holds
+more than `max_replay` messages, the client has to refetch its state then:
+
+    {"messages": [...], "seq": 44, "replay": true, "complete": true}
+
+With the "redis" backend the buffer is a Redis Stream per group capped by `maxlen`, and a
+Lua script numbers and appends a batch in one round trip, groups are spread over
+`redis_urls` with a consistent hash ring. The "memory" backend keeps the buffers of one
+process, capped by `maxlen` and `max_bytes`.
+"""
+import asyncio
+import time
+import weakref
+from collections import deque
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from uhashring import HashRing
+
+# KEYS: counter, stream. ARGV: maxlen, ttl, payloads...
+APPEND_SCRIPT = '''
+local count = #ARGV - 2
+local last = redis.call('INCRBY', KEYS[1], count)
+for i = 1, count do
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[1],
+        (last - count + i) .. '-0', 'p', ARGV[i + 2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return last
+'''
+
+# messages after the sequence number, whether they reach back to it, and the last number
+Replay = Tuple[List[bytes], int, bool]
+
+
+def check_replay(after: int, last: int, entries: List[Tuple[int, bytes]]) -> Replay:
+    if after >= last:
+        # nothing missed, unless the counter went back (the history expired)
+        return [], last, after == last
+    complete = bool(entries) and entries[0][0] == after + 1 and entries[-1][0] == last
+    seq = entries[-1][0] if entries else last
+    return [payload for _, payload in entries], seq, complete
+
+
+class MemoryHistory:
+    def __init__(self, maxlen: int = 1000, max_bytes: int = 1 << 20, ttl: float = 3600):
+        self.maxlen = maxlen
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # group -> [last sequence number, deque of (seq, payload), bytes, touched at]
+        self.groups: Dict[str, list] = {}
+
+    def expire(self):
+        deadline = time.monotonic() - self.ttl
+        for group, state in list(self.groups.items()):
+            if state[3] < deadline:
+                del self.groups[group]
+
+    async def append(self, group: str, payloads: List[bytes]) -> int:
+        self.expire()
+        state = self.groups.setdefault(group, [0, deque(), 0, 0])
+        entries = state[1]
+        for payload in payloads:
+            state[0] += 1
+            entries.append((state[0], payload))
+            state[2] += len(payload)
+        while entries and (len(entries) > self.maxlen or state[2] > self.max_bytes):
+            state[2] -= len(entries.popleft()[1])
+        state[3] = time.monotonic()
+        return state[0]
+
+    async def since(self, group: str, after: int, limit: int) -> Replay:
+        self.expire()
+        state = self.groups.get(group)
+        if state is None:
+            return check_replay(after, 0, [])
+        entries = [entry for entry in state[1] if entry[0] > after][:limit]
+        return check_replay(after, state[0], entries)
+
+
+class RedisHistory:
+    def __init__(
+        self,
+        urls: List[str],
+        maxlen: int = 1000,
+        ttl: float = 3600,
+        prefix: str = 'history',
+    ):
+        import redis.asyncio
+
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self.prefix = prefix
+        self.ring = HashRing(nodes=list(urls))
+        self.factory = redis.asyncio.Redis.from_url
+        # the asyncio clients are bound to the loop they connected in
+        self.clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def keys(self, group: str) -> Tuple[str, str]:
+        return f'{self.prefix}:{group}:seq', f'{self.prefix}:{group}:stream'
+
+    def client(self, group: str):
+        clients = self.clients.setdefault(asyncio.get_running_loop(), {})
+        url = self.ring.get_node(group)
+        if url not in clients:
+            client = self.factory(url)
+            clients[url] = (client, client.register_script(APPEND_SCRIPT))
+        return clients[url]
+
+    async def append(self, group: str, payloads: List[bytes]) -> int:
+        _, append = self.client(group)
+        return await append(
+            keys=self.keys(group), args=[self.maxlen, int(self.ttl), *payloads]
+        )
+
+    async def since(self, group: str, after: int, limit: int) -> Replay:
+        client, _ = self.client(group)
+        counter, stream = self.keys(group)
+        pipeline = client.pipeline(transaction=False)
+        pipeline.get(counter)
+        pipeline.xrange(stream, min=f'{after + 1}-0', count=limit)
+        last, entries = await pipeline.execute()
+        entries = [
+            (int(entry_id.split(b'-')[0]), fields[b'p']) for entry_id, fields in entries
+        ]
+        return check_replay(after, int(last or 0), entries)
+
+
+def options() -> dict:
+    return getattr(settings, 'ACCESS_HISTORY', {})
+
+
+def max_replay() -> int:
+    return options().get('max_replay', 1000)
+
+
+@lru_cache(maxsize=None)
+def get_history():
+    """The history configured by settings.ACCESS_HISTORY, None when disabled"""
+    backend = options().get('backend')
+    maxlen = options().get('maxlen', 1000)
+    ttl = options().get('ttl', 3600)
+    if backend == 'memory':
+        return MemoryHistory(
+            maxlen=maxlen, max_bytes=options().get('max_bytes', 1 << 20), ttl=ttl
+        )
+    if backend == 'redis':
+        return RedisHistory(
+            options()['redis_urls'],
+            maxlen=maxlen,
+            ttl=ttl,
+            prefix=options().get('prefix', 'history'),
+        )
+    return None
+
+
+def parse_resume(query_string: bytes) -> Optional[int]:
+    from urllib.parse import parse_qs
+
+    values = parse_qs(query_string.decode('latin-1')).get('resume')
+    if not values:
+        return None
+    try:
+        return max(int(values[-1]), 0)
+    except ValueError:
+        return None
@@ -0,0 +1,685 @@
+"""
+Channel layer for the processes of one host
+
+With RedisChannelLayer every group_send of a daphne process pays a Redis round trip and a
+msgpack encode and decode, even when all members live in processes next to it. Here each
+process keeps the members of its own connections and listens on a Unix socket in
+`socket_dir`. Processes of the host connect to each other, tell each other which groups
+they have members in, and a group_send writes one frame to the interested processes only.
+
+`socket_dir` defaults to `$XDG_RUNTIME_DIR/<MAIN_MODULE_NAME>-channels`, or `run/channels`
+in the project without it. It is created with mode 0700, the layer refuses to start on a
+directory of another user or that other users can write to, where anyone could listen
+for or inject group messages.
+
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'access.layers.LocalShardedChannelLayer',
+            'CONFIG': {
+                'socket_dir': '/run/user/1000/metamap-channels',
+                # other hosts, left out on a single host deployment
+                'remote': {
+                    'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                    'CONFIG': {'hosts': ['redis://127.0.0.1:6379/0']},
+                },
+            },
+        },
+    }
+
+With `remote` each process also joins its groups in the Redis layer with one channel of
+its own, messages of other hosts come in through it, the copies of this host are dropped
+since they were delivered over the sockets already. The group_add of the heartbeats of the
+local members keeps that membership from expiring, it is refreshed in the remote layer once
+half of its group_expiry went by.
+
+Channel names carry the host and the pid of their process, `specific.web1.4242!abc`.
+Channels without `!` are local to the process.
+"""
+import asyncio
+import logging
+import os
+import random
+import re
+import socket
+import stat
+import string
+import struct
+import time
+import uuid
+from typing import Dict, Optional, Set, Tuple
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from uhashring import HashRing
+
+LOGGER = logging.getLogger('django')
+
+HEADER = struct.Struct('!I')
+
+
+def pack(frame: list) -> bytes:
+    body = msgpack.packb(frame, use_bin_type=True)
+    return HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader: asyncio.StreamReader) -> list:
+    (size,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return msgpack.unpackb(await reader.readexactly(size), raw=False)
+
+
+def default_socket_dir() -> str:
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, f'{settings.MAIN_MODULE_NAME}-channels')
+    return os.path.join(settings.BASE_DIR, 'run', 'channels')
+
+
+def make_private_dir(path: str):
+    """Create `path` for this user only, refuse one that other users could write to"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise ImproperlyConfigured(f'{path} is not a directory')
+    if info.st_uid != os.getuid():
+        raise ImproperlyConfigured(f'{path} belongs to uid {info.st_uid}')
+    if info.st_mode & 0o077:
+        raise ImproperlyConfigured(
+            f'{path} has mode {stat.S_IMODE(info.st_mode):o}, 700 expected'
+        )
+
+
+class LocalShardedChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(
+        self,
+        socket_dir: Optional[str] = None,
+        remote: Optional[dict] = None,
+        host: Optional[str] = None,
+        expiry: int = 60,
+        group_expiry: int = 86400,
+        capacity: int = 100,
+        channel_capacity: Optional[dict] = None,
+    ):
+        super().__init__(
+            expiry=expiry, capacity=capacity, channel_capacity=channel_capacity
+        )
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.socket_dir = socket_dir or default_socket_dir()
+        self.remote_config = remote
+        self.host = re.sub(r'[^\w\-]', '-', host or socket.gethostname())
+        self.group_expiry = group_expiry
+        # set when the layer starts in the worker, after any fork
+        self.pid: Optional[str] = None
+
+        self.channels: Dict[str, asyncio.Queue] = {}
+        # group -> {local channel: joined at}
+        self.groups: Dict[str, Dict[str, float]] = {}
+        # group -> when the remote layer was last told we are in it
+        self.remote_joined: Dict[str, float] = {}
+        # pid -> groups with members in that process / connection to its socket
+        self.peer_groups: Dict[str, Set[str]] = {}
+        self.peer_writers: Dict[str, asyncio.StreamWriter] = {}
+        # connections of the peers to our socket
+        self.inbound: Set[asyncio.StreamWriter] = set()
+        self.remote = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.tasks = set()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.ready: Optional[asyncio.Event] = None
+
+    # Peers
+
+    def socket_path(self, pid: str) -> str:
+        return os.path.join(self.socket_dir, f'{pid}.sock')
+
+    @property
+    def remote_channel(self) -> str:
+        return self.remote_channel_of(self.host, self.pid)
+
+    @staticmethod
+    def remote_channel_of(host: str, pid: str) -> str:
+        return f'layer.{host}.{pid}'
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            await self.ready.wait()
+            return
+
+        # first use, or the previous loop is gone (tests run one loop per test)
+        make_private_dir(self.socket_dir)
+        self.loop = loop
+        self.ready = asyncio.Event()
+        self.channels, self.groups, self.remote_joined = {}, {}, {}
+        self.peer_groups, self.peer_writers, self.inbound = {}, {}, set()
+        if self.pid is None:
+            self.pid = str(os.getpid())
+        try:
+            path = self.socket_path(self.pid)
+            if os.path.exists(path):
+                # left by a dead process that had our pid
+                os.unlink(path)
+            self.server = await asyncio.start_unix_server(self.handle_peer, path=path)
+            for name in os.listdir(self.socket_dir):
+                pid, extension = os.path.splitext(name)
+                if extension == '.sock' and pid != self.pid:
+                    await self.connect_peer(pid)
+
+            if self.remote_config is not None:
+                self.remote = import_string(self.remote_config['BACKEND'])(
+                    **self.remote_config.get('CONFIG', {})
+                )
+                self.spawn(self.receive_remote())
+        finally:
+            self.ready.set()
+
+    async def connect_peer(self, pid: str):
+        path = self.socket_path(pid)
+        try:
+            reader, writer = await asyncio.open_unix_connection(path)
+        except ConnectionRefusedError:
+            LOGGER.info('removing the socket of dead process %s', pid)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            return
+        except FileNotFoundError:
+            return
+        self.peer_writers[pid] = writer
+        writer.write(pack(['hello', self.pid, list(self.groups)]))
+        self.spawn(self.watch_peer(pid, reader, writer))
+
+    async def watch_peer(self, pid: str, reader, writer):
+        """Peers never write on our connection, EOF means they are gone"""
+        try:
+            await reader.read()
+        finally:
+            self.drop_peer(pid, writer)
+
+    def drop_peer(self, pid: str, writer):
+        if self.peer_writers.get(pid) is writer:
+            del self.peer_writers[pid]
+        writer.close()
+
+    async def handle_peer(self, reader, writer):
+        pid = None
+        self.inbound.add(writer)
+        try:
+            while True:
+                frame = await read_frame(reader)
+                kind = frame[0]
+                if kind == 'group':
+                    self.deliver_group(frame[1], frame[2])
+                elif kind == 'send':
+                    self.deliver(frame[1], frame[2])
+                elif kind == 'sub':
+                    self.peer_groups[pid].add(frame[1])
+                elif kind == 'unsub':
+                    self.peer_groups[pid].discard(frame[1])
+                elif kind == 'hello':
+                    pid = frame[1]
+                    self.peer_groups[pid] = set(frame[2])
+                    if pid not in self.peer_writers:
+                        await self.connect_peer(pid)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if pid is not None:
+                self.peer_groups.pop(pid, None)
+            self.inbound.discard(writer)
+            writer.close()
+
+    async def write_peers(self, pids, frame: bytes):
+        for pid in pids:
+            writer = self.peer_writers.get(pid)
+            if writer is None:
+                continue
+            try:
+                writer.write(frame)
+                await writer.drain()
+            except ConnectionError:
+                self.drop_peer(pid, writer)
+
+    async def receive_remote(self):
+        while True:
+            try:
+                event = await self.remote.receive(self.remote_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                LOGGER.warning('remote channel layer receive failed', exc_info=e)
+                await asyncio.sleep(1)
+                continue
+            if 'channel' in event:
+                self.deliver(event['channel'], event['message'])
+            elif event['host'] != self.host:
+                self.deliver_group(event['group'], event['message'])
+
+    # Local delivery
+
+    def deliver(self, channel: str, message: dict) -> bool:
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        if queue.qsize() >= self.get_capacity(channel):
+            return False
+        queue.put_nowait((time.time() + self.expiry, message))
+        return True
+
+    def deliver_group(self, group: str, message: dict):
+        # members share the message, consumers only read it
+        for channel in self.groups.get(group, ()):
+            self.deliver(channel, message)
+
+    def owner(self, channel: str) -> Optional[Tuple[str, str]]:
+        if '!' not in channel:
+            return None
+        parts = channel[: channel.index('!')].rsplit('.', 2)
+        if len(parts) < 3:
+            return None
+        return parts[1], parts[2]
+
+    # Channel layer API
+
+    async def send(self, channel: str, message: dict):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self.ensure_started()
+
+        owner = self.owner(channel)
+        if owner is None or owner == (self.host, self.pid):
+            if not self.deliver(channel, message):
+                raise ChannelFull(channel)
+        elif owner[0] == self.host:
+            await self.write_peers([owner[1]], pack(['send', channel, message]))
+        elif self.remote is not None:
+            await self.remote.send(
+                self.remote_channel_of(*owner),
+                {'type': 'layer.send', 'channel': channel, 'message': message},
+            )
+
+    async def receive(self, channel: str) -> dict:
+        assert self.valid_channel_name(channel)
+        await self.ensure_started()
+
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        try:
+            while True:
+                expire_at, message = await queue.get()
+                if expire_at >= time.time():
+                    return message
+        finally:
+            if queue.empty():
+                self.channels.pop(channel, None)
+
+    async def new_channel(self, prefix: str = 'specific') -> str:
+        await self.ensure_started()
+        token = ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        return f'{prefix.rstrip(".")}.{self.host}.{self.pid}!{token}'
+
+    # Groups extension
+
+    async def group_add(self, group: str, channel: str):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self.ensure_started()
+
+        members = self.groups.setdefault(group, {})
+        first = not members
+        now = members[channel] = time.time()
+        if first:
+            await self.write_peers(list(self.peer_writers), pack(['sub', group]))
+        if self.remote is not None:
+            remote_expiry = getattr(self.remote, 'group_expiry', self.group_expiry)
+            if now - self.remote_joined.get(group, 0) > remote_expiry / 2:
+                await self.remote.group_add(group, self.remote_channel)
+                self.remote_joined[group] = now
+
+    async def group_discard(self, group: str, channel: str):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self.ensure_started()
+
+        members = self.groups.get(group)
+        if members is None:
+            return
+        members.pop(channel, None)
+        if not members:
+            await self.forget_group(group)
+
+    async def forget_group(self, group: str):
+        del self.groups[group]
+        self.remote_joined.pop(group, None)
+        await self.write_peers(list(self.peer_writers), pack(['unsub', group]))
+        if self.remote is not None:
+            await self.remote.group_discard(group, self.remote_channel)
+
+    async def group_send(self, group: str, message: dict):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Group name not valid'
+        await self.ensure_started()
+        await self.expire_members(group)
+
+        self.deliver_group(group, message)
+        # encoded once, whatever the number of processes
+        await self.write_peers(
+            [pid for pid, groups in self.peer_groups.items() if group in groups],
+            pack(['group', group, message]),
+        )
+        if self.remote is not None:
+            await self.remote.group_send(
+                group,
+                {
+                    'type': 'layer.group',
+                    'host': self.host,
+                    'group': group,
+                    'message': message,
+                },
+            )
+
+    async def expire_members(self, group: str):
+        members = self.groups.get(group)
+        if not members:
+            return
+        deadline = time.time() - self.group_expiry
+        for channel, joined_at in list(members.items()):
+            if joined_at < deadline:
+                del members[channel]
+        if not members:
+            await self.forget_group(group)
+
+    # Flush extension
+
+    async def flush(self):
+        for group in list(self.groups):
+            await self.forget_group(group)
+        self.channels = {}
+        if self.remote is not None:
+            await self.remote.flush()
+
+    async def close(self):
+        for writer in [*self.peer_writers.values(), *self.inbound]:
+            writer.close()
+        self.peer_writers = {}
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            try:
+                os.unlink(self.socket_path(self.pid))
+            except FileNotFoundError:
+                pass
+        self.loop = None
+
+
+class HashRingChannelLayer(BaseChannelLayer):
+    """
+    Redis channel layer sharding by group on a `uhashring` ring
+
+    channels_redis spreads a group over every host its members hash to, and changing the
+    host list rehashes all of them. Here a group lives on the node the ring gives for its
+    name, its members set and the messages sent to it stay there, and a node added or
+    removed moves about 1/N of the groups. Each process receives its channels on every
+    node, with one RedisChannelLayer per node sharing a client prefix.
+
+    `rebalance(hosts)` moves live: the members of the moved groups join on their new node
+    first, senders keep the old node for `rebalance_grace` seconds, then switch, and the
+    old memberships are dropped after another grace period. `announce_rebalance(hosts)`
+    runs it in every process through a control group, joined again every half
+    group_expiry so that it never expires.
+    """
+
+    extensions = ['groups', 'flush']
+    control_group = 'channel-layer-control'
+
+    def __init__(
+        self,
+        hosts=None,
+        prefix: str = 'asgi',
+        expiry: int = 60,
+        group_expiry: int = 86400,
+        capacity: int = 100,
+        channel_capacity: Optional[dict] = None,
+        symmetric_encryption_keys=None,
+        rebalance_grace: float = 5,
+    ):
+        super().__init__(
+            expiry=expiry, capacity=capacity, channel_capacity=channel_capacity
+        )
+        self.layer_options = {
+            'prefix': prefix,
+            'expiry': expiry,
+            'group_expiry': group_expiry,
+            'capacity': capacity,
+            'channel_capacity': channel_capacity,
+            'symmetric_encryption_keys': symmetric_encryption_keys,
+        }
+        self.rebalance_grace = rebalance_grace
+        self.client_prefix = uuid.uuid4().hex
+        self.layers: Dict[str, BaseChannelLayer] = {}
+        self.ring = self.make_ring(hosts or ['redis://localhost:6379'])
+        # while rebalancing: the ring before, and the ring senders still use
+        self.previous: Optional[HashRing] = None
+        self.send_ring = self.ring
+        # group -> channels of this process, joined again on a new node when it moves
+        self.memberships: Dict[str, Set[str]] = {}
+        # channel -> node -> pending receive
+        self.receivers: Dict[str, Dict[str, asyncio.Future]] = {}
+        self.ring_changed = asyncio.Event()
+        self.control: Optional[asyncio.Task] = None
+        self.rebalancing: Optional[asyncio.Task] = None
+        self.control_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # Nodes
+
+    @staticmethod
+    def node_name(host) -> str:
+        return host if isinstance(host, str) else str(host['address'])
+
+    def make_layer(self, host) -> BaseChannelLayer:
+        from channels_redis.core import RedisChannelLayer
+
+        return RedisChannelLayer(hosts=[host], **self.layer_options)
+
+    def make_ring(self, hosts) -> HashRing:
+        for host in hosts:
+            name = self.node_name(host)
+            if name not in self.layers:
+                layer = self.make_layer(host)
+                # receives on any node accept the channels of this process
+                layer.client_prefix = self.client_prefix
+                self.layers[name] = layer
+        return HashRing(nodes=[self.node_name(host) for host in hosts])
+
+    def nodes_for_group(self, group: str) -> Set[str]:
+        nodes = {self.ring.get_node(group)}
+        if self.previous is not None:
+            nodes.add(self.previous.get_node(group))
+        return nodes
+
+    def receiving_nodes(self) -> Set[str]:
+        nodes = set(self.ring.get_nodes())
+        if self.previous is not None:
+            nodes.update(self.previous.get_nodes())
+        return nodes
+
+    def notify_ring_changed(self):
+        self.ring_changed.set()
+        self.ring_changed = asyncio.Event()
+
+    # Channel layer API
+
+    async def send(self, channel: str, message: dict):
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        node = self.send_ring.get_node(self.non_local_name(channel))
+        await self.layers[node].send(channel, message)
+
+    async def receive(self, channel: str) -> dict:
+        assert self.valid_channel_name(channel)
+        pending = self.receivers.setdefault(channel, {})
+        try:
+            while True:
+                nodes = self.receiving_nodes()
+                for node in set(pending) - nodes:
+                    if not pending[node].done():
+                        pending.pop(node).cancel()
+                for node in nodes - set(pending):
+                    pending[node] = asyncio.ensure_future(
+                        self.layers[node].receive(channel)
+                    )
+                changed = asyncio.ensure_future(self.ring_changed.wait())
+                try:
+                    await asyncio.wait(
+                        [*pending.values(), changed],
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                finally:
+                    changed.cancel()
+                for node, task in list(pending.items()):
+                    if task.done():
+                        # the messages other nodes delivered meanwhile wait for the next call
+                        del pending[node]
+                        return task.result()
+        except asyncio.CancelledError:
+            for task in pending.values():
+                task.cancel()
+            self.receivers.pop(channel, None)
+            raise
+        finally:
+            if not pending:
+                self.receivers.pop(channel, None)
+
+    async def new_channel(self, prefix: str = 'specific') -> str:
+        self.start_control()
+        return f'{prefix}.{self.client_prefix}!{uuid.uuid4().hex}'
+
+    # Groups extension
+
+    async def group_add(self, group: str, channel: str):
+        assert self.valid_group_name(group), 'Group name not valid'
+        self.memberships.setdefault(group, set()).add(channel)
+        for node in self.nodes_for_group(group):
+            await self.layers[node].group_add(group, channel)
+
+    async def group_discard(self, group: str, channel: str):
+        assert self.valid_group_name(group), 'Group name not valid'
+        members = self.memberships.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.memberships[group]
+        for node in self.nodes_for_group(group):
+            await self.layers[node].group_discard(group, channel)
+
+    async def group_send(self, group: str, message: dict):
+        assert self.valid_group_name(group), 'Group name not valid'
+        await self.layers[self.send_ring.get_node(group)].group_send(group, message)
+
+    # Rebalancing
+
+    async def rebalance(self, hosts, grace: Optional[float] = None):
+        if grace is None:
+            grace = self.rebalance_grace
+        previous, ring = self.ring, self.make_ring(hosts)
+        moved = {
+            group: (previous.get_node(group), ring.get_node(group))
+            for group in self.memberships
+            if previous.get_node(group) != ring.get_node(group)
+        }
+        LOGGER.info('rebalancing %s groups of this process', len(moved))
+
+        self.previous, self.ring = previous, ring
+        self.notify_ring_changed()
+        for group, (_, new) in moved.items():
+            for channel in list(self.memberships.get(group, ())):
+                await self.layers[new].group_add(group, channel)
+
+        # other processes join the new nodes meanwhile
+        await asyncio.sleep(grace)
+        self.send_ring = ring
+        # messages sent to the old nodes just before the switch are still received
+        await asyncio.sleep(grace)
+        for group, (old, _) in moved.items():
+            for channel in list(self.memberships.get(group, ())):
+                await self.layers[old].group_discard(group, channel)
+        self.previous = None
+        self.notify_ring_changed()
+        for name in set(self.layers) - set(ring.get_nodes()):
+            self.layers.pop(name)
+
+    async def announce_rebalance(self, hosts):
+        """Rebalance every process using this layer"""
+        await self.group_send(
+            self.control_group, {'type': 'layer.rebalance', 'hosts': list(hosts)}
+        )
+
+    def start_control(self):
+        loop = asyncio.get_running_loop()
+        if self.control_loop is loop:
+            return
+        self.control_loop = loop
+        self.control = loop.create_task(self.receive_control())
+
+    async def receive_control(self):
+        channel = f'control.{self.client_prefix}!{uuid.uuid4().hex}'
+        await self.group_add(self.control_group, channel)
+        refresh = asyncio.ensure_future(self.refresh_control(channel))
+        try:
+            while True:
+                try:
+                    event = await self.receive(channel)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    LOGGER.warning('channel layer control receive failed', exc_info=e)
+                    await asyncio.sleep(1)
+                    continue
+                if event.get('type') == 'layer.rebalance':
+                    self.rebalancing = asyncio.ensure_future(
+                        self.rebalance(event['hosts'])
+                    )
+        finally:
+            refresh.cancel()
+
+    async def refresh_control(self, channel: str):
+        """The control channel has no heartbeat, its membership is renewed here"""
+        while True:
+            await asyncio.sleep(self.layer_options['group_expiry'] / 2)
+            try:
+                await self.group_add(self.control_group, channel)
+            except Exception as e:
+                LOGGER.warning('channel layer control group refresh failed', exc_info=e)
+
+    # Flush extension
+
+    async def flush(self):
+        self.memberships = {}
+        for layer in self.layers.values():
+            await layer.flush()
+
+    async def close(self):
+        if self.control is not None:
+            self.control.cancel()
+            await asyncio.gather(self.control, return_exceptions=True)
+            self.control, self.control_loop = None, None
+        for pending in self.receivers.values():
+            for task in pending.values():
+                task.cancel()
+        self.receivers = {}
+        for layer in self.layers.values():
+            close_pools = getattr(layer, 'close_pools', None)
+            if close_pools is not None:
+                await close_pools()
@@ -0,0 +1,132 @@
+"""
+Bounded outbound queue of a websocket connection
+
+Handlers used to await `send` themselves, a slow client held its consumer and the
+messages piling up behind it in the channel layer were dropped past `capacity` without a
+trace. Frames now go through an Outbox, drained by a task of the connection, and a
+handler never waits. When `maxsize` frames are waiting the policy decides:
+
+    drop_oldest  the oldest waiting frame is dropped
+    coalesce     a frame with a key replaces the waiting frame with the same key, where
+                 it stands, other frames drop the oldest one
+    disconnect   the connection is closed, the client reconnects and resyncs
+
+The depth of the queues and their overflows are exported with the django_prometheus
+metrics (/metrics).
+"""
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+# policy violation, the close frame a lagging client gets with the disconnect policy
+CLOSE_CODE = 1008
+
+LOGGER = logging.getLogger('django')
+
+QUEUED_FRAMES = Gauge(
+    'access_outbox_frames', 'Frames waiting in the websocket outboxes of this process'
+)
+QUEUE_DEPTH = Histogram(
+    'access_outbox_depth',
+    'Depth of a websocket outbox when a frame is queued',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+OVERFLOWS = Counter(
+    'access_outbox_overflow_total',
+    'Frames dropped, coalesced, or connections closed by a full outbox',
+    ['policy', 'action'],
+)
+
+
+class Outbox:
+    def __init__(
+        self,
+        send: Callable[..., Awaitable],
+        close: Callable[..., Awaitable],
+        maxsize: int = 100,
+        policy: str = DROP_OLDEST,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown outbox policy {policy}, one of {POLICIES}')
+        self.send = send
+        self.close = close
+        self.maxsize = maxsize
+        self.policy = policy
+        # [key, send kwargs], lists so a coalesced frame is replaced in place
+        self.frames: deque = deque()
+        self.keys: Dict[str, list] = {}
+        self.ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.closing = False
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, key: Optional[str] = None, **kwargs) -> bool:
+        """Queue send(**kwargs), False when the frame was not queued"""
+        if self.closing:
+            return False
+        if key is not None and self.policy == COALESCE and key in self.keys:
+            self.keys[key][1] = kwargs
+            OVERFLOWS.labels(self.policy, 'coalesced').inc()
+            return True
+
+        if len(self.frames) >= self.maxsize:
+            if self.policy == DISCONNECT:
+                OVERFLOWS.labels(self.policy, 'disconnected').inc()
+                self.closing = True
+                self.discard()
+                asyncio.ensure_future(self.close(code=CLOSE_CODE))
+                return False
+            self.forget(self.frames.popleft())
+            QUEUED_FRAMES.dec()
+            OVERFLOWS.labels(self.policy, 'dropped').inc()
+
+        entry = [key, kwargs]
+        self.frames.append(entry)
+        if key is not None:
+            self.keys[key] = entry
+        QUEUED_FRAMES.inc()
+        QUEUE_DEPTH.observe(len(self.frames))
+        self.ready.set()
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.drain())
+        return True
+
+    def forget(self, entry: list):
+        if entry[0] is not None and self.keys.get(entry[0]) is entry:
+            del self.keys[entry[0]]
+
+    async def drain(self):
+        while True:
+            while not self.frames:
+                self.ready.clear()
+                await self.ready.wait()
+            entry = self.frames.popleft()
+            self.forget(entry)
+            QUEUED_FRAMES.dec()
+            try:
+                await self.send(**entry[1])
+            except Exception as e:
+                LOGGER.warning('frame not sent', exc_info=e)
+
+    def discard(self):
+        QUEUED_FRAMES.dec(len(self.frames))
+        self.frames.clear()
+        self.keys.clear()
+
+    async def stop(self):
+        self.closing = True
+        self.discard()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
@@ -0,0 +1,107 @@
+"""
+Circus plugins
+
+ConnectionCounts collects the websocket connection counts the daphne workers report
+(see access.admission) and keeps them in `stats_file`, a JSON object by pid:
+
+    {"4242": {"watcher": "daphne", "connections": 812, "max_connections": 10000}}
+
+Counts of a reaped process are dropped right away, the ones not refreshed within
+`max_age` seconds on the next write. Read them with `manage.py circusd connections`.
+"""
+import json
+import os
+import socket
+import time
+
+from circus import logger
+from circus.plugins import CircusPlugin
+from tornado import ioloop
+
+
+def parse_report(data: bytes) -> dict:
+    pid, connections, max_connections = data.decode().split(';')
+    return {
+        'pid': pid,
+        'connections': int(connections),
+        'max_connections': int(max_connections) if max_connections else None,
+    }
+
+
+class ConnectionCounts(CircusPlugin):
+    name = 'connection_counts'
+
+    def __init__(self, endpoint, pubsub_endpoint, check_delay, ssh_server, **config):
+        super().__init__(endpoint, pubsub_endpoint, check_delay, ssh_server=ssh_server)
+        self.ip = config.get('ip', '127.0.0.1')
+        self.port = int(config.get('port', 1665))
+        self.stats_file = config['stats_file']
+        self.loop_rate = float(config.get('loop_rate', 1))
+        self.max_age = float(config.get('max_age', 10))
+        # pid -> count, with the watcher of the pid when circus told us
+        self.counts = {}
+        self.watchers = {}
+        self.sock = None
+        self.period = None
+
+    def handle_init(self):
+        # BASE_DIR/run by default, not part of a checkout
+        os.makedirs(os.path.dirname(os.path.abspath(self.stats_file)), exist_ok=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((self.ip, self.port))
+        self.sock.setblocking(False)
+        self.loop.add_handler(self.sock.fileno(), self.receive, ioloop.IOLoop.READ)
+        self.period = ioloop.PeriodicCallback(self.write, self.loop_rate * 1000)
+        self.period.start()
+
+    def handle_stop(self):
+        if self.period is not None:
+            self.period.stop()
+        if self.sock is not None:
+            self.loop.remove_handler(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+    def handle_recv(self, data):
+        watcher, action, msg = self.split_data(data)
+        if action not in ('spawn', 'reap'):
+            return
+        try:
+            pid = str(self.load_message(msg)['process_pid'])
+        except (ValueError, KeyError):
+            return
+        if action == 'spawn':
+            self.watchers[pid] = watcher
+        else:
+            self.watchers.pop(pid, None)
+            self.counts.pop(pid, None)
+
+    def receive(self, fd, events):
+        while True:
+            try:
+                data, _ = self.sock.recvfrom(1024)
+            except BlockingIOError:
+                return
+            try:
+                report = parse_report(data)
+            except ValueError:
+                logger.warning('invalid connection count report %r', data)
+                continue
+            pid = report.pop('pid')
+            report['reported_at'] = time.time()
+            self.counts[pid] = report
+
+    def write(self):
+        deadline = time.time() - self.max_age
+        for pid, report in list(self.counts.items()):
+            if report['reported_at'] < deadline:
+                del self.counts[pid]
+        stats = {
+            pid: {'watcher': self.watchers.get(pid), **report}
+            for pid, report in self.counts.items()
+        }
+        # replaced at once, a reader never sees half of it
+        temporary = f'{self.stats_file}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(stats, f)
+        os.replace(temporary, self.stats_file)
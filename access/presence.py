@@ -0,0 +1,254 @@
+"""
+Who is connected to a websocket group
+
+Every connection is a member of its group's presence set, a Redis sorted set scored by
+the time the membership expires, next to a sorted set of the same members all scored 0
+for listing them in a stable order. Groups are spread over `redis_urls` with a consistent
+hash ring, a group is on one node, so counting or listing it is one round trip:
+
+    store = get_presence()
+    store.count('group_room')                      # prune + ZCARD
+    store.members('group_room', offset=0, limit=100)  # prune + ZRANGEBYLEX
+
+Connections heartbeat every `heartbeat_interval` seconds, refreshing both their presence
+and their channel layer group membership. A presence expires after `ttl` seconds without
+one, by default three heartbeats, so a dead connection leaves its groups within minutes.
+
+Joins and leaves are not broadcast one by one, a reconnect storm of N members would send
+N² messages. Each process collects them per group for `notice_interval_ms` and sends one
+notice, a join and a leave of the same connection in between cancel out:
+
+    {"type": "presence", "joined": [...], "left": [...], "count": 42}
+"""
+import asyncio
+import json
+import logging
+import time
+import weakref
+from functools import lru_cache
+from typing import Dict, List
+
+from django.conf import settings
+from uhashring import HashRing
+
+from access.fanout import get_fanout
+
+LOGGER = logging.getLogger('django')
+
+
+def encode_member(member: dict) -> str:
+    return json.dumps(member, sort_keys=True, separators=(',', ':'))
+
+
+class MemoryPresence:
+    """Presence of one process, for tests and single process deployments"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # group -> {member: expire at}
+        self.groups: Dict[str, Dict[str, float]] = {}
+
+    def prune(self, group: str) -> Dict[str, float]:
+        members = self.groups.get(group, {})
+        now = time.time()
+        for member, expire_at in list(members.items()):
+            if expire_at < now:
+                del members[member]
+        if not members:
+            self.groups.pop(group, None)
+        return members
+
+    def count(self, group: str) -> int:
+        return len(self.prune(group))
+
+    def members(self, group: str, offset: int = 0, limit: int = 100) -> List[dict]:
+        members = sorted(self.prune(group))[offset : offset + limit]
+        return [json.loads(member) for member in members]
+
+    async def acount(self, group: str) -> int:
+        return self.count(group)
+
+    async def join(self, group: str, member: dict):
+        self.groups.setdefault(group, {})[encode_member(member)] = (
+            time.time() + self.ttl
+        )
+
+    heartbeat = join
+
+    async def leave(self, group: str, member: dict):
+        members = self.groups.get(group, {})
+        members.pop(encode_member(member), None)
+        if not members:
+            self.groups.pop(group, None)
+
+
+class RedisPresence:
+    # KEYS: the expiry set and the member set, ARGV[1]: now
+    PRUNE = """
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    for i = 1, #expired, 1000 do
+        local chunk = {unpack(expired, i, math.min(i + 999, #expired))}
+        redis.call('ZREM', KEYS[1], unpack(chunk))
+        redis.call('ZREM', KEYS[2], unpack(chunk))
+    end
+    """
+    COUNT = PRUNE + "return redis.call('ZCARD', KEYS[1])"
+    # ARGV[2], ARGV[3]: offset and limit
+    MEMBERS = (
+        PRUNE + "return redis.call('ZRANGEBYLEX', KEYS[2], '-', '+', 'LIMIT', "
+        "ARGV[2], ARGV[3])"
+    )
+
+    def __init__(self, urls: List[str], ttl: float, prefix: str = 'presence'):
+        import redis
+        import redis.asyncio
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self.ring = HashRing(nodes=list(urls))
+        self.clients = {url: redis.Redis.from_url(url) for url in urls}
+        self.async_factory = redis.asyncio.Redis.from_url
+        # the asyncio clients are bound to the loop they connected in
+        self.async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def key(self, group: str) -> str:
+        return f'{self.prefix}:{group}'
+
+    def members_key(self, group: str) -> str:
+        return f'{self.prefix}:{group}:members'
+
+    def keys(self, group: str) -> List[str]:
+        return [self.key(group), self.members_key(group)]
+
+    def client(self, group: str):
+        return self.clients[self.ring.get_node(group)]
+
+    def async_client(self, group: str):
+        loop = asyncio.get_running_loop()
+        clients = self.async_clients.setdefault(loop, {})
+        url = self.ring.get_node(group)
+        if url not in clients:
+            clients[url] = self.async_factory(url)
+        return clients[url]
+
+    def count(self, group: str) -> int:
+        return self.client(group).eval(self.COUNT, 2, *self.keys(group), time.time())
+
+    def members(self, group: str, offset: int = 0, limit: int = 100) -> List[dict]:
+        """Ordered by member, pages do not shift as members heartbeat"""
+        members = self.client(group).eval(
+            self.MEMBERS, 2, *self.keys(group), time.time(), offset, limit
+        )
+        return [json.loads(member) for member in members]
+
+    async def acount(self, group: str) -> int:
+        return await self.async_client(group).eval(
+            self.COUNT, 2, *self.keys(group), time.time()
+        )
+
+    async def join(self, group: str, member: dict):
+        member = encode_member(member)
+        pipeline = self.async_client(group).pipeline(transaction=False)
+        pipeline.zadd(self.key(group), {member: time.time() + self.ttl})
+        pipeline.zadd(self.members_key(group), {member: 0})
+        # the whole sets go away with their last member
+        for key in self.keys(group):
+            pipeline.expire(key, int(self.ttl) + 1)
+        await pipeline.execute()
+
+    heartbeat = join
+
+    async def leave(self, group: str, member: dict):
+        member = encode_member(member)
+        pipeline = self.async_client(group).pipeline(transaction=False)
+        for key in self.keys(group):
+            pipeline.zrem(key, member)
+        await pipeline.execute()
+
+
+def options() -> dict:
+    return getattr(settings, 'ACCESS_PRESENCE', {})
+
+
+def heartbeat_interval() -> float:
+    return options().get('heartbeat_interval', 30)
+
+
+@lru_cache(maxsize=None)
+def get_presence():
+    """The presence store configured by settings.ACCESS_PRESENCE"""
+    ttl = options().get('ttl')
+    if ttl is None:
+        # a connection missing three heartbeats in a row is gone
+        ttl = 3 * heartbeat_interval()
+    if options().get('backend', 'redis') == 'memory':
+        return MemoryPresence(ttl)
+    return RedisPresence(
+        options()['redis_urls'], ttl, prefix=options().get('prefix', 'presence')
+    )
+
+
+class PresenceNotifier:
+    """Joins and leaves of the connections of one event loop, one notice per group"""
+
+    def __init__(self, store, interval: float = 0.5):
+        self.store = store
+        self.interval = interval
+        # (channel layer, group) -> {'joined': {...}, 'left': {...}} keyed by channel
+        self.pending: Dict[tuple, Dict[str, Dict[str, dict]]] = {}
+        self.tasks = set()
+
+    def joined(self, channel_layer, group: str, member: dict):
+        self.add(channel_layer, group, member, 'joined', 'left')
+
+    def left(self, channel_layer, group: str, member: dict):
+        self.add(channel_layer, group, member, 'left', 'joined')
+
+    def add(self, channel_layer, group: str, member: dict, kind: str, opposite: str):
+        key = (channel_layer, group)
+        notice = self.pending.get(key)
+        if notice is None:
+            notice = self.pending[key] = {'joined': {}, 'left': {}}
+            loop = asyncio.get_running_loop()
+            loop.call_later(self.interval, self.flush_later, key)
+        if notice[opposite].pop(member['channel'], None) is None:
+            notice[kind][member['channel']] = member
+
+    def flush_later(self, key: tuple):
+        task = asyncio.ensure_future(self.flush(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self, key: tuple):
+        notice = self.pending.pop(key, None)
+        if notice is None or not (notice['joined'] or notice['left']):
+            return
+        channel_layer, group = key
+        try:
+            await get_fanout().publish(
+                channel_layer,
+                group,
+                {
+                    'type': 'presence',
+                    'joined': list(notice['joined'].values()),
+                    'left': list(notice['left'].values()),
+                    'count': await self.store.acount(group),
+                },
+            )
+        except Exception as e:
+            LOGGER.warning('presence notice of %s not sent', group, exc_info=e)
+
+
+_notifiers: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, PresenceNotifier]' = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_notifier() -> PresenceNotifier:
+    loop = asyncio.get_running_loop()
+    notifier = _notifiers.get(loop)
+    if notifier is None:
+        notifier = _notifiers[loop] = PresenceNotifier(
+            get_presence(), interval=options().get('notice_interval_ms', 500) / 1000
+        )
+    return notifier
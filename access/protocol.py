@@ -0,0 +1,212 @@
+"""
+Websocket framing of AccessConsumer
+
+Clients pick the encoding with the websocket subprotocol, JSON text frames stay the
+default for clients asking for none:
+
+    new WebSocket(url, ['metamap.msgpack', 'metamap.json'])
+
+Binary frames are one operation byte followed by msgpack:
+
+    0x01 <payload>                          a message to the group, or from it
+    0x02 <{"type": ..., "data": ..., "id": ...}>  a message for the handlers, and the reply
+    0x03 (<4 bytes length> <payload>)*      messages coalesced by access.fanout
+    0x04 <1 byte length> <key> <payload>    a message superseding the previous one with
+                                            the same key, see access.outbox
+    0x05 <8 bytes seq> <1 byte flags> <frame>  a 0x01 or 0x03 frame of the group history,
+                                            seq is the number of its last message, see
+                                            access.history; flags are 0x01 for the
+                                            replay on a resume, 0x02 when it is incomplete
+
+JSON clients send {"type": ..., "data": ..., "id": ...} for the handlers, or
+{"message": ..., "key": ...} to the group, see decode_text.
+
+The server never looks into a message payload, it is forwarded as the client encoded it.
+A payload is only decoded to build the JSON frame of JSON clients, once per batch and
+process, and only when such a client gets the batch. A payload that has no JSON form is
+left out of the JSON frames, the binary ones still carry it.
+"""
+import base64
+import json
+import struct
+from typing import List, Optional, Sequence, Tuple
+
+import msgpack
+
+JSON_SUBPROTOCOL = 'metamap.json'
+MSGPACK_SUBPROTOCOL = 'metamap.msgpack'
+SUBPROTOCOLS = (MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL)
+
+OP_MESSAGE = 0x01
+OP_DISPATCH = 0x02
+OP_BATCH = 0x03
+OP_KEYED_MESSAGE = 0x04
+OP_SEQUENCED = 0x05
+
+FLAG_REPLAY = 0x01
+FLAG_INCOMPLETE = 0x02
+
+LENGTH = struct.Struct('!I')
+SEQUENCE = struct.Struct('!QB')
+
+_MISSING = object()
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class Payload:
+    """A message payload, converted between its value and its msgpack bytes at most once"""
+
+    __slots__ = ('_value', '_raw')
+
+    def __init__(self, value=_MISSING, raw: Optional[bytes] = None):
+        self._value = value
+        self._raw = raw
+
+    @property
+    def value(self):
+        if self._value is _MISSING:
+            self._value = msgpack.unpackb(self._raw, raw=False)
+        return self._value
+
+    @property
+    def raw(self) -> bytes:
+        if self._raw is None:
+            self._raw = msgpack.packb(self._value, use_bin_type=True)
+        return self._raw
+
+
+def negotiate(subprotocols: Sequence[str]) -> Optional[str]:
+    """The first subprotocol the client offers that we speak"""
+    for subprotocol in subprotocols:
+        if subprotocol in SUBPROTOCOLS:
+            return subprotocol
+    return None
+
+
+def json_default(value):
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def json_text(payload: Payload) -> Optional[str]:
+    """None for garbage sent by a msgpack client, or a value JSON can not hold"""
+    try:
+        return json.dumps(payload.value, default=json_default)
+    except (ValueError, TypeError):
+        # a map with non string keys for instance, not for the others to choke on
+        return None
+
+
+def json_texts(payloads: List[Payload]) -> List[str]:
+    return [text for text in map(json_text, payloads) if text is not None]
+
+
+def json_frame(payloads: List[Payload], seq: Optional[int] = None) -> Optional[str]:
+    """Put together from the JSON of each payload, one that fails costs only itself"""
+    texts = json_texts(payloads)
+    if not texts:
+        return None
+    if len(payloads) == 1:
+        frame = f'{{"message": {texts[0]}'
+    else:
+        frame = f'{{"messages": [{", ".join(texts)}]'
+    if seq is not None:
+        frame += f', "seq": {int(seq)}'
+    return frame + '}'
+
+
+def batch_frame(payloads: List[Payload]) -> bytes:
+    parts = [bytes((OP_BATCH,))]
+    for payload in payloads:
+        parts.append(LENGTH.pack(len(payload.raw)))
+        parts.append(payload.raw)
+    return b''.join(parts)
+
+
+def binary_frame(payloads: List[Payload], seq: Optional[int] = None) -> bytes:
+    if len(payloads) == 1:
+        frame = bytes((OP_MESSAGE,)) + payloads[0].raw
+    else:
+        frame = batch_frame(payloads)
+    if seq is None:
+        return frame
+    return bytes((OP_SEQUENCED,)) + SEQUENCE.pack(seq, 0) + frame
+
+
+def replay_frames(
+    payloads: List[Payload], seq: int, complete: bool
+) -> Tuple[str, bytes]:
+    """The JSON and the binary frame of the messages missed by a resuming client"""
+    text = (
+        f'{{"messages": [{", ".join(json_texts(payloads))}], "seq": {int(seq)}, '
+        f'"replay": true, "complete": {json.dumps(bool(complete))}}}'
+    )
+    flags = FLAG_REPLAY if complete else FLAG_REPLAY | FLAG_INCOMPLETE
+    binary = bytes((OP_SEQUENCED,)) + SEQUENCE.pack(seq, flags) + batch_frame(payloads)
+    return text, binary
+
+
+def decode_binary(data: bytes) -> Tuple[int, object]:
+    """
+    (OP_MESSAGE, Payload) and (OP_KEYED_MESSAGE, (key, Payload)) with the payload left
+    encoded, or (OP_DISPATCH, dict)
+    """
+    if not data:
+        raise ProtocolError('empty frame')
+    op, body = data[0], data[1:]
+    if op == OP_MESSAGE:
+        return op, Payload(raw=body)
+    if op == OP_KEYED_MESSAGE:
+        if not body or len(body) < 1 + body[0]:
+            raise ProtocolError('truncated key')
+        try:
+            key = body[1 : 1 + body[0]].decode()
+        except UnicodeDecodeError as e:
+            raise ProtocolError('invalid key') from e
+        return op, (key, Payload(raw=body[1 + body[0] :]))
+    if op == OP_DISPATCH:
+        try:
+            message = msgpack.unpackb(body, raw=False)
+        except ValueError as e:
+            raise ProtocolError('invalid msgpack') from e
+        if not isinstance(message, dict) or 'type' not in message:
+            raise ProtocolError('a dispatched message needs a type')
+        return op, message
+    raise ProtocolError(f'unknown operation {op}')
+
+
+def decode_text(data) -> Tuple[int, object]:
+    """
+    The JSON counterpart of decode_binary: (OP_MESSAGE, Payload),
+    (OP_KEYED_MESSAGE, (key, Payload)) or (OP_DISPATCH, dict)
+    """
+    try:
+        message = json.loads(data)
+    except ValueError as e:
+        raise ProtocolError('invalid JSON') from e
+    if not isinstance(message, dict):
+        raise ProtocolError('a frame is a JSON object')
+    if 'type' in message:
+        return OP_DISPATCH, message
+    if 'message' not in message:
+        raise ProtocolError('a frame needs a type or a message')
+    key = message.get('key')
+    if key is not None and not isinstance(key, str):
+        raise ProtocolError('a message key is a string')
+    payload = Payload(message['message'])
+    try:
+        # encoded once here, for the binary clients and the history
+        payload.raw
+    except (OverflowError, ValueError, TypeError) as e:
+        raise ProtocolError('message has no msgpack form') from e
+    if key is None:
+        return OP_MESSAGE, payload
+    return OP_KEYED_MESSAGE, (key, payload)
+
+
+def encode_dispatch(message: dict) -> bytes:
+    return bytes((OP_DISPATCH,)) + msgpack.packb(message, use_bin_type=True)
@@ -1,3 +1,752 @@
-from django.test import TestCase
+import asyncio
+import json
 
-# Create your tests here.
+import msgpack
+import pytest
+from channels.layers import InMemoryChannelLayer
+from channels.testing import WebsocketCommunicator
+from django.core.exceptions import ImproperlyConfigured
+from uhashring import HashRing
+
+from access.admission import AdmissionMiddleware, TokenBucket
+from access.auth import TokenUser, UserCache, make_token, verify_token
+from access.fanout import GroupFanout, batch_frame_of
+from access.history import MemoryHistory, get_history
+from access.outbox import Outbox
+from access.presence import get_presence
+from access.layers import HashRingChannelLayer, LocalShardedChannelLayer
+from access.protocol import (
+    LENGTH,
+    OP_BATCH,
+    OP_DISPATCH,
+    OP_MESSAGE,
+    OP_SEQUENCED,
+    SEQUENCE,
+    Payload,
+    binary_frame,
+    json_frame,
+)
+from metamap.asgi import application
+
+
+@pytest.fixture(autouse=True)
+def in_memory_channel_layer(settings):
+    settings.CHANNEL_LAYERS = {
+        'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}
+    }
+    settings.ACCESS_PRESENCE = {
+        'backend': 'memory',
+        'ttl': 60,
+        'heartbeat_interval': 30,
+        'notice_interval_ms': 10,
+    }
+    get_presence.cache_clear()
+    settings.ACCESS_HISTORY = {'backend': None}
+    get_history.cache_clear()
+
+
+async def test_broadcast(transactional_db):
+    communicator = WebsocketCommunicator(application, '/ws/access/room/')
+    connected, _ = await communicator.connect()
+    assert connected
+    assert 'joined' in (await communicator.receive_json_from())['message']
+
+    await communicator.send_json_to({'message': 'hello'})
+    assert await communicator.receive_json_from() == {'message': 'hello'}
+    await communicator.disconnect()
+
+
+async def test_handle_message_of_older_processes(transactional_db):
+    from channels.layers import get_channel_layer
+
+    communicator = WebsocketCommunicator(application, '/ws/access/room/')
+    await communicator.connect()
+    await communicator.receive_json_from()
+
+    await get_channel_layer().group_send(
+        'group_room', {'type': 'handle_message', 'message': 'from v1'}
+    )
+    assert await communicator.receive_json_from() == {'message': 'from v1'}
+    await communicator.disconnect()
+
+
+async def test_dispatch_to_handler(transactional_db):
+    communicator = WebsocketCommunicator(application, '/ws/access/room/')
+    await communicator.connect()
+    await communicator.receive_json_from()
+
+    await communicator.send_json_to(
+        {'id': 1, 'type': 'account.profiles', 'data': {'user_ids': [10000]}}
+    )
+    assert await communicator.receive_json_from() == {
+        'id': 1,
+        'type': 'account.profiles',
+        'data': [None],
+    }
+
+    await communicator.send_json_to({'type': 'no.such.type'})
+    assert 'error' in await communicator.receive_json_from()
+    # a handler that raises does not take the consumer down
+    await communicator.send_json_to({'id': 2, 'type': 'role.info'})
+    reply = await communicator.receive_json_from()
+    assert reply['id'] == 2 and 'role_id' in reply['error']
+    await communicator.send_json_to({'type': 'account.profiles', 'data': [1]})
+    assert 'error' in await communicator.receive_json_from()
+    await communicator.send_json_to(
+        {'id': 3, 'type': 'account.profiles', 'data': {'user_ids': []}}
+    )
+    assert (await communicator.receive_json_from())['data'] == []
+    await communicator.disconnect()
+
+
+async def test_invalid_frames(transactional_db, settings):
+    settings.ACCESS_FANOUT = {'window_ms': 0}
+    communicator = WebsocketCommunicator(application, '/ws/access/room/')
+    await communicator.connect()
+    await communicator.receive_json_from()
+
+    for frame in ('{', '[1]', '{"data": 1}', '{"message": 1, "key": 2}'):
+        await communicator.send_to(text_data=frame)
+        reply = await communicator.receive_json_from()
+        assert reply['type'] is None and reply['error'].startswith('invalid frame')
+    # no msgpack form, rejected before it is published
+    await communicator.send_json_to({'message': 2**64})
+    assert 'msgpack' in (await communicator.receive_json_from())['error']
+    # the consumer is still up
+    await communicator.send_json_to({'message': 'hello'})
+    assert await communicator.receive_json_from() == {'message': 'hello'}
+    await communicator.disconnect()
+
+    binary = WebsocketCommunicator(
+        application, '/ws/access/room/', subprotocols=['metamap.msgpack']
+    )
+    await binary.connect()
+    await binary.receive_from()
+    await binary.send_to(bytes_data=b'\x09')
+    reply = await binary.receive_from()
+    assert (
+        reply[0] == OP_DISPATCH
+        and 'unknown operation' in msgpack.unpackb(reply[1:])['error']
+    )
+    await binary.disconnect()
+
+
+class RecordingLayer:
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+
+async def test_fanout_coalesces_group_messages():
+    layer = RecordingLayer()
+    fanout = GroupFanout(window=0.01)
+    for i in range(100):
+        await fanout.publish(layer, 'group_a', i)
+    await fanout.publish(layer, 'group_b', 'alone')
+    assert layer.sent == []
+
+    await asyncio.sleep(0.05)
+    frames = dict(layer.sent)
+    assert len(layer.sent) == 2
+    assert json.loads(batch_frame_of(frames['group_a'], binary=False)) == {
+        'messages': list(range(100))
+    }
+    assert json.loads(batch_frame_of(frames['group_b'], binary=False)) == {
+        'message': 'alone'
+    }
+
+    fanout = GroupFanout(window=10, max_batch=3)
+    for i in range(7):
+        await fanout.publish(layer, 'group_c', i)
+    assert len(layer.sent) == 4
+    await fanout.flush_all()
+    assert json.loads(batch_frame_of(layer.sent[-1][1], binary=False)) == {'message': 6}
+
+
+async def test_fanout_flushes_in_order():
+    class SlowLayer(RecordingLayer):
+        calls = 0
+
+        async def group_send(self, group, message):
+            self.calls += 1
+            # the first batch is still being sent when max_batch flushes the next one
+            if self.calls == 1:
+                await asyncio.sleep(0.05)
+            await super().group_send(group, message)
+
+    layer = SlowLayer()
+    fanout = GroupFanout(window=0.01, max_batch=3)
+    await fanout.publish(layer, 'group_a', 0)
+    await asyncio.sleep(0.02)
+    for i in range(1, 4):
+        await fanout.publish(layer, 'group_a', i)
+    await fanout.flush_all()
+    await asyncio.gather(*fanout.tasks)
+    frames = [
+        json.loads(batch_frame_of(message, binary=False)) for _, message in layer.sent
+    ]
+    assert frames == [{'message': 0}, {'messages': [1, 2, 3]}]
+    assert fanout.locks == {}
+
+
+async def test_broadcast_batch(transactional_db, settings):
+    settings.ACCESS_FANOUT = {'window_ms': 50}
+    sender = WebsocketCommunicator(application, '/ws/access/room/')
+    await sender.connect()
+    await sender.receive_json_from()
+
+    await sender.send_json_to({'message': 'one'})
+    await sender.send_json_to({'message': 'two'})
+    assert await sender.receive_json_from() == {'messages': ['one', 'two']}
+    await sender.disconnect()
+
+
+async def test_local_sharded_layer(tmp_path):
+    socket_dir = tmp_path / 'channels'
+    first = LocalShardedChannelLayer(socket_dir=str(socket_dir), host='web1')
+    second = LocalShardedChannelLayer(socket_dir=str(socket_dir), host='web1')
+    # two processes of one host
+    first.pid, second.pid = '1001', '1002'
+
+    channel_1 = await first.new_channel()
+    await first.group_add('room', channel_1)
+    channel_2 = await second.new_channel()
+    await second.group_add('room', channel_2)
+    await asyncio.sleep(0.05)
+    assert first.peer_groups == {'1002': {'room'}}
+    assert second.peer_groups == {'1001': {'room'}}
+
+    await first.group_send('room', {'type': 'handle_message', 'message': 'hello'})
+    assert (await second.receive(channel_2))['message'] == 'hello'
+    assert (await first.receive(channel_1))['message'] == 'hello'
+
+    await first.send(channel_2, {'type': 'handle_message', 'message': 'direct'})
+    assert (await second.receive(channel_2))['message'] == 'direct'
+
+    await second.group_discard('room', channel_2)
+    await asyncio.sleep(0.05)
+    assert first.peer_groups == {'1002': set()}
+    await first.group_send('room', {'type': 'handle_message', 'message': 'again'})
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(second.receive(channel_2), 0.05)
+
+    await second.close()
+    await asyncio.sleep(0.05)
+    assert first.peer_groups == {} and first.peer_writers == {}
+    await first.close()
+    assert list(socket_dir.iterdir()) == []
+    assert socket_dir.stat().st_mode & 0o777 == 0o700
+
+
+async def test_local_sharded_layer_private_socket_dir(tmp_path):
+    shared = tmp_path / 'shared'
+    shared.mkdir(mode=0o777)
+    shared.chmod(0o777)
+    layer = LocalShardedChannelLayer(socket_dir=str(shared))
+    with pytest.raises(ImproperlyConfigured):
+        await layer.new_channel()
+    assert list(shared.iterdir()) == []
+
+
+async def test_local_sharded_layer_refreshes_remote_groups(tmp_path):
+    layer = LocalShardedChannelLayer(
+        socket_dir=str(tmp_path / 'channels'),
+        host='web1',
+        remote={
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {'group_expiry': 2},
+        },
+    )
+    layer.pid = '1001'
+    channel = await layer.new_channel()
+    await layer.group_add('room', channel)
+    joined = layer.remote.groups['room'][layer.remote_channel]
+
+    # the heartbeat of a member still connected, after half the remote group_expiry
+    await asyncio.sleep(1.1)
+    await layer.group_add('room', channel)
+    assert layer.remote.groups['room'][layer.remote_channel] > joined + 1
+    await layer.close()
+
+
+class InMemoryRingLayer(HashRingChannelLayer):
+    def make_layer(self, host):
+        return InMemoryChannelLayer()
+
+
+async def test_hash_ring_layer():
+    layer = InMemoryRingLayer(hosts=['a', 'b'], rebalance_grace=0.02)
+    channel = await layer.new_channel()
+    groups = [f'group_{i}' for i in range(1000)]
+    moved = [
+        group
+        for group in groups
+        if layer.ring.get_node(group) != HashRing(nodes=['a', 'b', 'c']).get_node(group)
+    ]
+    # about 1/3 of the groups move to the new node, none between the old ones
+    assert 200 < len(moved) < 450
+
+    group = moved[0]
+    old = layer.ring.get_node(group)
+    await layer.group_add(group, channel)
+    assert [name for name, node in layer.layers.items() if group in node.groups] == [
+        old
+    ]
+    await layer.group_send(group, {'type': 'handle_message', 'message': 1})
+    assert (await layer.receive(channel))['message'] == 1
+
+    await asyncio.sleep(0)
+    await layer.announce_rebalance(['a', 'b', 'c'])
+    await asyncio.sleep(0.01)
+    # both nodes have the members while the senders switch
+    assert layer.previous is not None
+    assert group in layer.layers['c'].groups and group in layer.layers[old].groups
+    await layer.group_send(group, {'type': 'handle_message', 'message': 2})
+    await layer.rebalancing
+    await layer.group_send(group, {'type': 'handle_message', 'message': 3})
+
+    # no order between the nodes while moving
+    received = {(await layer.receive(channel))['message'] for _ in range(2)}
+    assert received == {2, 3}
+    assert group not in layer.layers[old].groups
+    assert layer.ring.get_node(group) == 'c'
+    await layer.close()
+
+
+async def test_hash_ring_layer_refreshes_control_group():
+    layer = InMemoryRingLayer(hosts=['a'], group_expiry=0.2)
+    await layer.new_channel()
+    await asyncio.sleep(0)
+    members = layer.layers['a'].groups[layer.control_group]
+    (channel,) = members
+    joined = members[channel]
+
+    # joined again before its membership expires
+    await asyncio.sleep(0.15)
+    assert members[channel] > joined
+    await layer.close()
+
+
+async def test_msgpack_subprotocol(transactional_db, settings):
+    settings.ACCESS_FANOUT = {'window_ms': 0}
+    binary = WebsocketCommunicator(
+        application, '/ws/access/room/', subprotocols=['metamap.msgpack']
+    )
+    connected, subprotocol = await binary.connect()
+    assert subprotocol == 'metamap.msgpack'
+    joined = await binary.receive_from()
+    assert joined[0] == OP_MESSAGE and b'joined' in joined
+
+    text = WebsocketCommunicator(application, '/ws/access/room/')
+    await text.connect()
+    await text.receive_json_from()
+    await binary.receive_from()
+
+    payload = msgpack.packb({'x': 1, 'blob': b'\x00'})
+    await binary.send_to(bytes_data=bytes((OP_MESSAGE,)) + payload)
+    # forwarded without a re-encode
+    assert await binary.receive_from() == bytes((OP_MESSAGE,)) + payload
+    assert await text.receive_json_from() == {'message': {'x': 1, 'blob': 'AA=='}}
+
+    await binary.send_to(
+        bytes_data=bytes((OP_DISPATCH,))
+        + msgpack.packb({'id': 7, 'type': 'account.profiles', 'data': {'user_ids': []}})
+    )
+    reply = await binary.receive_from()
+    assert reply[0] == OP_DISPATCH
+    assert msgpack.unpackb(reply[1:]) == {
+        'id': 7,
+        'type': 'account.profiles',
+        'data': [],
+    }
+    await binary.disconnect()
+    await text.disconnect()
+
+
+def test_binary_batch_frame():
+    frame = binary_frame([Payload('a'), Payload(raw=msgpack.packb([1, 2]))])
+    assert frame[0] == OP_BATCH
+    (size,) = LENGTH.unpack(frame[1:5])
+    assert msgpack.unpackb(frame[5 : 5 + size]) == 'a'
+    assert msgpack.unpackb(frame[5 + size + 4 :]) == [1, 2]
+
+
+def test_json_frame_skips_payloads_without_json():
+    # a msgpack map with integer keys, and a payload that is not msgpack at all
+    bad = [Payload(raw=msgpack.packb({1: 'a'})), Payload(raw=b'\xc1')]
+    assert json.loads(json_frame([Payload('a'), *bad, Payload('b')], seq=3)) == {
+        'messages': ['a', 'b'],
+        'seq': 3,
+    }
+    assert json_frame(bad[:1]) is None
+    event = {'id': 'batch', 'payloads': [Payload('a').raw, bad[0].raw]}
+    assert json.loads(batch_frame_of(event, binary=False)) == {'messages': ['a']}
+    assert batch_frame_of(event, binary=True)[0] == OP_BATCH
+
+
+async def test_presence(transactional_db, rf, settings):
+    from asgiref.sync import sync_to_async
+    from django.contrib.auth.models import AnonymousUser
+    from django.urls import resolve
+
+    settings.ACCESS_PRESENCE = {**settings.ACCESS_PRESENCE, 'notice_interval_ms': 300}
+
+    communicators = [
+        WebsocketCommunicator(application, '/ws/access/lobby/') for _ in range(5)
+    ]
+    for communicator in communicators:
+        await communicator.connect()
+    notices = [await communicator.receive_json_from() for communicator in communicators]
+    # one notice for the whole burst of joins
+    assert all(len(notice['message']['joined']) == 5 for notice in notices)
+    assert notices[0]['message']['count'] == 5
+
+    store = get_presence()
+    assert store.count('group_lobby') == 5
+    members = store.members('group_lobby')
+    assert members == sorted(members, key=lambda member: member['channel'])
+    # heartbeats reorder nothing, pages do not overlap
+    await store.heartbeat('group_lobby', members[0])
+    assert store.members('group_lobby', offset=1, limit=3) == members[1:4]
+
+    view = resolve('/api-extra/presence/lobby/count').func
+    response = view(rf.get('/api-extra/presence/lobby/count'), name='lobby')
+    assert json.loads(response.content) == {'group': 'group_lobby', 'count': 5}
+    # who is connected is not for anonymous users
+    request = rf.get('/api-extra/presence/lobby/members')
+    request.user = AnonymousUser()
+    view = resolve('/api-extra/presence/lobby/members').func
+    assert (await sync_to_async(view)(request, name='lobby')).status_code == 403
+
+    await communicators[0].disconnect()
+    notice = await communicators[1].receive_json_from()
+    (left,) = notice['message']['left']
+    assert left not in store.members('group_lobby')
+    assert notice['message']['count'] == 4
+    for communicator in communicators[1:]:
+        await communicator.disconnect()
+    assert store.count('group_lobby') == 0
+
+
+async def test_outbox_policies():
+    from prometheus_client import REGISTRY
+
+    sent, closed = [], []
+    release = asyncio.Event()
+
+    async def slow_send(**kwargs):
+        await release.wait()
+        sent.append(kwargs['text_data'])
+
+    async def close(code):
+        closed.append(code)
+
+    def dropped(policy, action):
+        return (
+            REGISTRY.get_sample_value(
+                'access_outbox_overflow_total', {'policy': policy, 'action': action}
+            )
+            or 0
+        )
+
+    before = dropped('drop_oldest', 'dropped')
+    outbox = Outbox(slow_send, close, maxsize=3)
+    outbox.put(text_data='0')
+    await asyncio.sleep(0)
+    for i in range(1, 6):
+        outbox.put(text_data=str(i))
+    # '0' is held by the client, 1 and 2 were dropped
+    assert [entry[1]['text_data'] for entry in outbox.frames] == ['3', '4', '5']
+    assert dropped('drop_oldest', 'dropped') - before == 2
+    release.set()
+    await asyncio.sleep(0.01)
+    assert sent == ['0', '3', '4', '5']
+    await outbox.stop()
+
+    release.clear()
+    sent.clear()
+    outbox = Outbox(slow_send, close, maxsize=3, policy='coalesce')
+    outbox.put(text_data='a')
+    await asyncio.sleep(0)
+    for i in range(10):
+        outbox.put('cursor', text_data=f'cursor {i}')
+    outbox.put(text_data='b')
+    release.set()
+    await asyncio.sleep(0.01)
+    assert sent == ['a', 'cursor 9', 'b']
+    await outbox.stop()
+
+    release.clear()
+    outbox = Outbox(slow_send, close, maxsize=1, policy='disconnect')
+    assert outbox.put(text_data='x')
+    await asyncio.sleep(0)
+    assert outbox.put(text_data='y')
+    assert not outbox.put(text_data='z')
+    await asyncio.sleep(0)
+    assert closed == [1008] and len(outbox) == 0
+    await outbox.stop()
+
+
+async def test_fanout_keeps_latest_keyed_message():
+    layer = RecordingLayer()
+    fanout = GroupFanout(window=10)
+    await fanout.publish(layer, 'group_a', 'chat')
+    for i in range(3):
+        await fanout.publish(layer, 'group_a', {'x': i}, message_key='cursor')
+    await fanout.flush_all()
+    events = [event for _, event in layer.sent]
+    assert json.loads(batch_frame_of(events[0], binary=False)) == {'message': 'chat'}
+    assert json.loads(batch_frame_of(events[1], binary=False)) == {'message': {'x': 2}}
+    assert events[1]['key'] == 'cursor'
+
+
+async def test_memory_history_is_bounded():
+    history = MemoryHistory(maxlen=3, max_bytes=10)
+    assert await history.append('group', [b'a', b'b']) == 2
+    assert await history.append('group', [b'c', b'd']) == 4
+    # over maxlen, the first message is dropped
+    assert await history.since('group', 0, limit=10) == ([b'b', b'c', b'd'], 4, False)
+    assert await history.since('group', 1, limit=10) == ([b'b', b'c', b'd'], 4, True)
+    assert await history.since('group', 1, limit=1) == ([b'b'], 2, False)
+    assert await history.since('group', 4, limit=10) == ([], 4, True)
+
+    assert await history.append('group', [b'123456789']) == 5
+    # over max_bytes
+    assert await history.since('group', 3, limit=10) == ([b'd', b'123456789'], 5, True)
+    assert await history.since('group', 2, limit=10) == ([b'd', b'123456789'], 5, False)
+    # the counter went back, the client's state is from an expired history
+    assert await history.since('other', 7, limit=10) == ([], 0, False)
+
+
+async def test_resume_replays_missed_messages(transactional_db, settings):
+    settings.ACCESS_FANOUT = {'window_ms': 0}
+    settings.ACCESS_HISTORY = {'backend': 'memory', 'maxlen': 100}
+    get_history.cache_clear()
+
+    sender = WebsocketCommunicator(application, '/ws/access/history/')
+    await sender.connect()
+    assert (await sender.receive_json_from())['seq'] == 1
+    for message in ('one', 'two', 'three'):
+        await sender.send_json_to({'message': message})
+    assert await sender.receive_json_from() == {'message': 'one', 'seq': 2}
+    await sender.receive_json_from()
+    await sender.receive_json_from()
+
+    resumed = WebsocketCommunicator(application, '/ws/access/history/?resume=2')
+    await resumed.connect()
+    assert await resumed.receive_json_from() == {
+        'messages': ['two', 'three'],
+        'seq': 4,
+        'replay': True,
+        'complete': True,
+    }
+    binary = WebsocketCommunicator(
+        application, '/ws/access/history/?resume=3', subprotocols=['metamap.msgpack']
+    )
+    await binary.connect()
+    frame = await binary.receive_from()
+    assert frame[0] == OP_SEQUENCED
+    assert SEQUENCE.unpack(frame[1:10]) == (4, 0x01)
+    assert frame[10] == OP_BATCH and frame.endswith(msgpack.packb('three'))
+
+    # live frames go on after the replay
+    joined = await resumed.receive_json_from()
+    assert 'joined' in joined['message']
+    await sender.send_json_to({'message': 'four'})
+    assert await resumed.receive_json_from() == {
+        'message': 'four',
+        'seq': joined['seq'] + 1,
+    }
+    for communicator in (sender, resumed, binary):
+        await communicator.disconnect()
+
+
+def test_token_bucket():
+    now = [0.0]
+    bucket = TokenBucket(rate=2, burst=3, clock=lambda: now[0])
+    assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+    assert bucket.take() == 0.5
+    now[0] = 0.5
+    assert bucket.take() == 0
+    now[0] = 100
+    assert [bucket.take() for _ in range(4)] == [0, 0, 0, 0.5]
+
+
+async def test_admission_control(transactional_db):
+    guarded = AdmissionMiddleware(application, max_connections=1, retry_after=3)
+    first = WebsocketCommunicator(guarded, '/ws/access/admission/')
+    assert (await first.connect())[0]
+
+    second = WebsocketCommunicator(guarded, '/ws/access/admission/')
+    assert (await second.connect())[0]
+    assert await second.receive_json_from() == {
+        'type': 'rejected',
+        'reason': 'full',
+        'retry_after': 3,
+    }
+    assert (await second.receive_output())['code'] == 1013
+    assert guarded.connections == 1
+
+    await first.disconnect()
+    assert guarded.connections == 0
+
+    limited = AdmissionMiddleware(application, rate=1, burst=1)
+    third = WebsocketCommunicator(limited, '/ws/access/admission/')
+    assert (await third.connect())[0]
+    fourth = WebsocketCommunicator(limited, '/ws/access/admission/')
+    await fourth.connect()
+    assert (await fourth.receive_json_from())['reason'] == 'rate'
+    await third.disconnect()
+
+
+async def test_admission_draining(transactional_db, monkeypatch):
+    import os
+    import signal
+
+    from access import admission
+
+    monkeypatch.setattr(admission, '_draining', False)
+    previous = signal.getsignal(admission.DRAIN_SIGNAL)
+    admission.install_drain_handler()
+    try:
+        os.kill(os.getpid(), admission.DRAIN_SIGNAL)
+    finally:
+        signal.signal(admission.DRAIN_SIGNAL, previous)
+    assert admission._draining
+
+    guarded = AdmissionMiddleware(application)
+    communicator = WebsocketCommunicator(guarded, '/ws/access/admission/')
+    assert (await communicator.connect())[0]
+    assert await communicator.receive_json_from() == {
+        'type': 'rejected',
+        'reason': 'draining',
+        'retry_after': 0,
+    }
+    assert guarded.connections == 0
+
+
+def test_connection_counts_plugin(tmp_path, settings):
+    import io
+    import socket
+
+    from django.core.management import call_command
+
+    from access.plugins import ConnectionCounts
+
+    stats_file = tmp_path / 'run' / 'connections.json'
+    plugin = ConnectionCounts(
+        'tcp://127.0.0.1:0', 'tcp://127.0.0.1:0', 5, None, port=0, stats_file=stats_file
+    )
+    plugin.handle_init()
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            sender.sendto(b'41;7;100', plugin.sock.getsockname())
+            sender.sendto(b'42;3;', plugin.sock.getsockname())
+            sender.sendto(b'garbage', plugin.sock.getsockname())
+        plugin.receive(None, None)
+        plugin.handle_recv((b'watcher.daphne.reap', b'{"process_pid": 42}'))
+        plugin.write()
+    finally:
+        plugin.handle_stop()
+
+    stats = json.loads(stats_file.read_text())
+    assert list(stats) == ['41']
+    assert stats['41']['connections'] == 7
+    assert stats['41']['max_connections'] == 100
+
+    settings.CIRCUS_PLUGINS = [
+        {
+            'name': 'connection_counts',
+            'settings': {
+                'use': 'access.plugins.ConnectionCounts',
+                'stats_file': str(stats_file),
+            },
+        }
+    ]
+    out = io.StringIO()
+    call_command('circusd', 'connections', stdout=out)
+    assert out.getvalue().splitlines()[:2] == ['? 41: 7/100', 'total: 7']
+
+
+def test_asgi_application_imports():
+    import os
+    import subprocess
+    import sys
+
+    # a fresh interpreter, as daphne imports it, not one pytest-django set up already
+    env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'metamap.settings'}
+    env.pop('SERVICE_ADDRESS', None)
+    result = subprocess.run(
+        [sys.executable, '-c', 'import metamap.asgi'],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+
+
+def test_connection_token():
+    token = make_token(TokenUser(7, 'alice'), ttl=60)
+    assert verify_token(token) == (7, 'alice')
+    assert verify_token(token.replace('alice', 'mallory')) is None
+    assert verify_token(make_token(TokenUser(7, 'alice'), ttl=-1)) is None
+    assert verify_token('garbage') is None
+
+
+async def test_token_authentication(transactional_db):
+    token = make_token(TokenUser(7, 'alice'))
+    communicator = WebsocketCommunicator(
+        application, f'/ws/access/tokens/?token={token}'
+    )
+    assert (await communicator.connect())[0]
+    # the user never was in the database
+    notice = (await communicator.receive_json_from())['message']
+    assert notice['joined'][0]['user'] == 'alice'
+    await communicator.disconnect()
+
+    anonymous = WebsocketCommunicator(application, '/ws/access/tokens/?token=7:0:x:y')
+    assert (await anonymous.connect())[0]
+    notice = (await anonymous.receive_json_from())['message']
+    assert notice['joined'][0]['user'] is None
+    await anonymous.disconnect()
+
+
+async def test_user_cache(transactional_db):
+    from channels.db import database_sync_to_async
+    from django.contrib.auth import get_user_model
+
+    user = await database_sync_to_async(get_user_model().objects.create_user)(
+        'alice@example.com', 'alice'
+    )
+    cache = UserCache(maxsize=1)
+    loads = []
+    load = cache.load
+
+    async def counted_load(user_id):
+        loads.append(user_id)
+        return await load(user_id)
+
+    cache.load = counted_load
+    assert (await cache.get(user.pk)).username == 'alice'
+    assert (await cache.get(user.pk)).username == 'alice'
+    assert not (await cache.get(user.pk + 1)).is_authenticated
+    assert loads == [user.pk, user.pk + 1]
+    # evicted by the last one
+    await cache.get(user.pk)
+    assert loads[-1] == user.pk
+
+
+def test_token_api(db, rf):
+    from django.contrib.auth import get_user_model
+    from django.urls import resolve
+
+    user = get_user_model().objects.create_user('bob@example.com', 'bob')
+    request = rf.post('/api-extra/access/token')
+    request.user = user
+    response = resolve('/api-extra/access/token').func(request)
+    data = json.loads(response.content)
+    assert verify_token(data['token']) == (user.pk, 'bob')
+    assert data['expires_in'] == 300
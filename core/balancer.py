@@ -0,0 +1,150 @@
+"""
+Client-side load balancing over the service registry
+
+    balancer = get_balancer('asgi')
+    balancer.route(user_id)         # the address of the endpoint owning the key
+    balancer.route('room:lobby')
+    balancer.pick()                 # the less loaded of two random endpoints
+
+    address = balancer.pick()
+    with balancer.track(address):
+        ...                         # counted as in flight to that endpoint
+
+The workers of a host share its listening socket and register the same address (see
+core.registry), the balancer spreads calls over those addresses, the endpoints, not over
+the worker processes behind them. An endpoint weighs the sum of the `weight` of its
+workers (1 each by default).
+
+route() hashes the key on a uhashring ring of the live endpoints of the service, the same
+user or group keeps landing on the host whose caches already hold it. The ring follows
+the watch of core.registry one node at a time (add_node / remove_node): an endpoint that
+comes up or whose last worker goes away moves only its own share of the keys, the caches
+of the others stay warm.
+
+pick() is for the calls without a key: of two endpoints drawn at random, the one with
+fewer calls in flight from this process plus the `load` its workers published in their
+registrations (ServiceRegistration.update(load=...)).
+"""
+import random
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from uhashring import HashRing
+
+from core.registry import ServiceDirectory, get_directory
+
+
+def address_of(instance: str, value: dict) -> str:
+    # instances registered without an address are endpoints of their own
+    return value.get('address') or instance
+
+
+class ServiceBalancer:
+    def __init__(self, directory: ServiceDirectory, service: str):
+        self.directory = directory
+        self.service = service
+        self.ring = HashRing(nodes=[])
+        # address -> {instance: value registered}
+        self.endpoints: Dict[str, Dict[str, dict]] = {}
+        # instance -> address, to find the endpoint of a worker gone
+        self.addresses: Dict[str, str] = {}
+        # address -> calls in flight from this process
+        self.in_flight: Dict[str, int] = {}
+        # the watch updates from the thread of the registry
+        self.lock = threading.Lock()
+        with self.lock:
+            directory.add_listener(self.on_change)
+            for instance, value in directory.instances(service).items():
+                self.add(instance, value)
+
+    def weight(self, address: str) -> int:
+        return sum(value.get('weight', 1) for value in self.endpoints[address].values())
+
+    def add(self, instance: str, value: dict):
+        address = address_of(instance, value)
+        if self.addresses.get(instance, address) != address:
+            self.remove(instance)
+        previous = self.weight(address) if address in self.endpoints else None
+        self.endpoints.setdefault(address, {})[instance] = value
+        self.addresses[instance] = address
+        self.update_node(address, previous)
+
+    def remove(self, instance: str):
+        address = self.addresses.pop(instance, None)
+        if address is None:
+            return
+        weight = self.weight(address)
+        del self.endpoints[address][instance]
+        if not self.endpoints[address]:
+            del self.endpoints[address]
+        self.update_node(address, weight)
+
+    def update_node(self, address: str, previous_weight: Optional[int]):
+        """Put the endpoint on the ring with its current weight, or take it off"""
+        weight = self.weight(address) if address in self.endpoints else None
+        if weight == previous_weight:
+            return
+        if previous_weight is not None:
+            self.ring.remove_node(address)
+        if weight is not None:
+            self.ring.add_node(address, {'weight': weight})
+
+    def on_change(self, service: str, instance: str, value: Optional[dict]):
+        if service != self.service:
+            return
+        with self.lock:
+            if value is None:
+                self.remove(instance)
+            else:
+                self.add(instance, value)
+
+    def route(self, key) -> Optional[str]:
+        """The address of the endpoint owning the key, None while the service has none"""
+        with self.lock:
+            if not self.endpoints:
+                return None
+            return self.ring.get_node(str(key))
+
+    def load(self, address: str) -> float:
+        published = sum(
+            value.get('load', 0) for value in self.endpoints[address].values()
+        )
+        return self.in_flight.get(address, 0) + published
+
+    def pick(self) -> Optional[str]:
+        """The address of the less loaded of two endpoints drawn at random"""
+        with self.lock:
+            candidates = random.sample(
+                list(self.endpoints), min(2, len(self.endpoints))
+            )
+            if not candidates:
+                return None
+            return min(candidates, key=self.load)
+
+    @contextmanager
+    def track(self, address: str) -> Iterator[None]:
+        with self.lock:
+            self.in_flight[address] = self.in_flight.get(address, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight[address] -= 1
+                if not self.in_flight[address]:
+                    del self.in_flight[address]
+
+
+_balancers: Dict[str, ServiceBalancer] = {}
+_balancers_lock = threading.Lock()
+
+
+def get_balancer(service: str) -> ServiceBalancer:
+    """The balancer of the service in this process, on the directory of core.registry"""
+    directory = get_directory()
+    with _balancers_lock:
+        balancer = _balancers.get(service)
+        # a forked worker has a directory of its own
+        if balancer is None or balancer.directory is not directory:
+            balancer = _balancers[service] = ServiceBalancer(directory, service)
+        return balancer
@@ -0,0 +1,292 @@
+"""
+Two tier read-through cache for model instances
+
+    good_table_cache = ModelCache(GoodTable, lookups=('name',))
+    good_table_cache.get(name='name1')  # process LRU -> Redis (CACHES) -> database
+    good_table_cache.get(pk=1)
+
+Tier one is a size bounded LRU with a TTL inside the process, tier two is the Django cache
+(Redis, see settings.CACHES). Instances are stored by primary key, other lookups only map
+to the primary key, so a renamed row never answers its old name.
+
+Cached instances are shared by every thread of the process, treat them as read only.
+
+post_save/post_delete drop the instance from both tiers and publish the invalidation on a
+Redis pub/sub channel, every process listening on it drops its own LRU entry. That happens
+once the transaction commits, a reader running before would put the old row back. A
+process is subscribed before its first cached read returns, it never keeps an entry whose
+invalidation went by unheard.
+
+bulk_update, bulk_create and QuerySet.update send no signals, their callers invalidate the
+rows they wrote with `invalidate_rows(Server, pks)`.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+_MISSING = object()
+
+LOGGER = logging.getLogger('django')
+
+
+class LRUCache:
+    """Thread safe LRU with a per entry time to live"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expire_at = self.data[key]
+            except KeyError:
+                return default
+            if expire_at < time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class ModelCache:
+    # model label -> ModelCache, used by the invalidation subscriber
+    registry: Dict[str, 'ModelCache'] = {}
+
+    def __init__(self, model, lookups: Tuple[str, ...] = ()):
+        options = self.options()
+        self.model = model
+        self.label = model._meta.label_lower
+        self.lookups = tuple(lookups)
+        self.local = LRUCache(
+            maxsize=options.get('local_maxsize', 1024),
+            ttl=options.get('local_ttl', 60),
+        )
+        self.alias = options.get('cache', 'default')
+        self.timeout = options.get('timeout', 300)
+        self.registry[self.label] = self
+
+        post_save.connect(
+            self.handle_change, sender=model, weak=False, dispatch_uid=self.label
+        )
+        post_delete.connect(
+            self.handle_change, sender=model, weak=False, dispatch_uid=self.label
+        )
+
+    @staticmethod
+    def options() -> dict:
+        return getattr(settings, 'MODEL_CACHE', {})
+
+    @property
+    def remote(self):
+        return caches[self.alias]
+
+    def key(self, field: str, value) -> str:
+        return f'model_cache:{self.label}:{field}:{value}'
+
+    def get(self, **kwargs):
+        """Like `Model.objects.get` with one lookup, pk or one of `lookups`"""
+        start_invalidation_subscriber()
+        ((field, value),) = kwargs.items()
+        if field == 'pk':
+            return self.get_by_pk(value)
+        if field not in self.lookups:
+            raise ValueError(f'{self.label} is not cached by {field}')
+
+        key = self.key(field, value)
+        pk = self.local.get(key, _MISSING)
+        if pk is _MISSING:
+            pk = self.remote.get(key, _MISSING)
+        if pk is not _MISSING:
+            try:
+                instance = self.get_by_pk(pk)
+            except self.model.DoesNotExist:
+                instance = None
+            if instance is not None and getattr(instance, field) == value:
+                self.local.set(key, pk)
+                return instance
+            # the row changed or disappeared since the key was written
+            self.local.delete(key)
+            self.remote.delete(key)
+
+        instance = self.model._default_manager.get(**{field: value})
+        self.store(instance)
+        return instance
+
+    def get_by_pk(self, pk):
+        start_invalidation_subscriber()
+        pk = self.model._meta.pk.to_python(pk)
+        key = self.key('pk', pk)
+        instance = self.local.get(key)
+        if instance is not None:
+            return instance
+
+        instance = self.remote.get(key)
+        if instance is None:
+            instance = self.model._default_manager.get(pk=pk)
+            self.remote.set(key, instance, self.timeout)
+        self.local.set(key, instance)
+        return instance
+
+    def store(self, instance):
+        entries = {self.key('pk', instance.pk): instance}
+        entries.update(
+            {
+                self.key(field, getattr(instance, field)): instance.pk
+                for field in self.lookups
+            }
+        )
+        self.remote.set_many(entries, self.timeout)
+        for key, value in entries.items():
+            self.local.set(key, value)
+
+    def invalidate(self, pk):
+        """Drop the instance in this process only"""
+        self.local.delete(self.key('pk', self.model._meta.pk.to_python(pk)))
+
+    def drop(self, pks: Iterable):
+        """Drop the instances from both tiers, in every process"""
+        pks = [self.model._meta.pk.to_python(pk) for pk in pks]
+        for pk in pks:
+            self.invalidate(pk)
+        try:
+            self.remote.delete_many([self.key('pk', pk) for pk in pks])
+        except Exception as e:
+            # the write itself succeeded, the Redis entry expires after `timeout`
+            LOGGER.warning('model cache entry not invalidated', exc_info=e)
+        for pk in pks:
+            publish_invalidation(self.label, pk)
+
+    def handle_change(self, sender, instance, using=None, **kwargs):
+        pk = instance.pk
+        transaction.on_commit(lambda: self.drop([pk]), using=using)
+
+
+def invalidate_rows(model, pks: Iterable, using: Optional[str] = None):
+    """Invalidate rows written without signals, once the transaction commits"""
+    model_cache = ModelCache.registry.get(model._meta.label_lower)
+    pks = list(pks)
+    if model_cache is not None and pks:
+        transaction.on_commit(lambda: model_cache.drop(pks), using=using)
+
+
+_publisher = None
+_subscriber: Optional[threading.Thread] = None
+_subscriber_pid = None
+
+
+def invalidation_channel() -> Optional[str]:
+    return ModelCache.options().get('invalidation_channel')
+
+
+def redis_client():
+    import redis
+
+    return redis.Redis.from_url(ModelCache.options()['invalidation_redis_url'])
+
+
+def publish_invalidation(label: str, pk):
+    global _publisher
+
+    channel = invalidation_channel()
+    if channel is None:
+        return
+    try:
+        if _publisher is None:
+            _publisher = redis_client()
+        _publisher.publish(channel, f'{label} {pk}')
+    except Exception as e:
+        # other processes fall back to the LRU TTL
+        LOGGER.warning('model cache invalidation not published', exc_info=e)
+
+
+def handle_invalidation(data: bytes):
+    label, pk = data.decode().split(' ', 1)
+    model_cache = ModelCache.registry.get(label)
+    if model_cache is not None:
+        model_cache.invalidate(pk)
+
+
+def subscribe(channel: str, timeout: float = 5):
+    """A pubsub on `channel` once Redis confirmed it, nothing published later is missed"""
+    pubsub = redis_client().pubsub()
+    pubsub.subscribe(channel)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        message = pubsub.get_message(timeout=deadline - time.monotonic())
+        if message is not None and message['type'] == 'subscribe':
+            return pubsub
+    pubsub.close()
+    raise TimeoutError(f'subscription to {channel} not confirmed')
+
+
+def start_invalidation_subscriber():
+    """
+    Subscribe to invalidations from other processes, then listen to them in a daemon
+    thread, once per process. Started lazily since threads do not survive the fork of
+    preloading servers, by the first cached read, which waits for the subscription.
+    """
+    global _subscriber, _subscriber_pid
+
+    if _subscriber_pid == os.getpid():
+        return
+    channel = invalidation_channel()
+    if channel is None:
+        return
+
+    try:
+        pubsub = subscribe(channel)
+    except Exception as e:
+        # the thread keeps trying, the LRU is cleared once it is subscribed
+        LOGGER.warning('model cache subscriber not connected', exc_info=e)
+        pubsub = None
+
+    def listen(pubsub):
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = subscribe(channel)
+                    # entries cached while disconnected may have missed invalidations
+                    for model_cache in ModelCache.registry.values():
+                        model_cache.local.clear()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        handle_invalidation(message['data'])
+            except Exception as e:
+                LOGGER.warning('model cache subscriber reconnecting', exc_info=e)
+                pubsub = None
+                time.sleep(1)
+
+    _subscriber_pid = os.getpid()
+    _subscriber = threading.Thread(
+        target=listen, args=(pubsub,), name='model-cache-invalidation', daemon=True
+    )
+    _subscriber.start()
@@ -0,0 +1,256 @@
+"""
+etcd clients
+
+    client = etcd_client()          # aetcd3, configured by settings.ETCD_KWARGS
+    client = get_client()           # the one of the running loop
+
+A client is bound to the event loop it first talks in. MemoryEtcd is a stand-in for tests
+and single process development, it speaks the part of the aetcd3 client used by
+core.registry and core.locks, with the same events, leases, transactions and revisions,
+kept in the memory of one event loop.
+"""
+import asyncio
+import itertools
+import math
+import time
+import weakref
+from typing import Dict, Optional
+
+import aetcd3
+from aetcd3 import events, exceptions, transactions
+from aetcd3.client import KVMetadata
+from aetcd3.rpc import kv_pb2
+from aetcd3.utils import lease_to_id, prefix_range_end, to_bytes
+from django.conf import settings
+
+
+def etcd_client():
+    return aetcd3.client(**getattr(settings, 'ETCD_KWARGS', {}))
+
+
+_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aetcd3.Etcd3Client]' = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = etcd_client()
+    return client
+
+
+class MemoryEtcd:
+    def __init__(self):
+        self.transactions = aetcd3.Transactions()
+        self.revision = 1
+        self.store: Dict[bytes, kv_pb2.KeyValue] = {}
+        # lease id -> [ttl, expire at, timer]
+        self.leases: Dict[int, list] = {}
+        self.lease_ids = itertools.count(1)
+        # [start, end, queue]
+        self.watchers = []
+
+    def header(self):
+        return aetcd3.rpc.ResponseHeader(revision=self.revision)
+
+    def notify(self, event_type, kv: kv_pb2.KeyValue):
+        event = events.new_event(kv_pb2.Event(type=event_type, kv=kv))
+        for start, end, queue in self.watchers:
+            if start <= kv.key < end:
+                queue.put_nowait(event)
+
+    def set(self, key, value, lease=None, revision: Optional[int] = None):
+        """revision: of the transaction the put is part of, the next one otherwise"""
+        key = to_bytes(key)
+        lease_id = lease_to_id(lease) if lease is not None else 0
+        if lease_id and lease_id not in self.leases:
+            raise exceptions.PreconditionFailedError('lease not found')
+        self.revision = revision or self.revision + 1
+        previous = self.store.get(key)
+        kv = kv_pb2.KeyValue(
+            key=key,
+            value=to_bytes(value),
+            create_revision=previous.create_revision if previous else self.revision,
+            mod_revision=self.revision,
+            version=previous.version + 1 if previous else 1,
+            lease=lease_id,
+        )
+        self.store[key] = kv
+        self.notify(kv_pb2.Event.PUT, kv)
+
+    def remove(self, key, range_end=None, revision: Optional[int] = None) -> int:
+        key = to_bytes(key)
+        if range_end is None:
+            keys = [key] if key in self.store else []
+        else:
+            end = to_bytes(range_end)
+            keys = [k for k in self.store if key <= k < end]
+        if keys:
+            self.revision = revision or self.revision + 1
+        for k in keys:
+            del self.store[k]
+            self.notify(
+                kv_pb2.Event.DELETE, kv_pb2.KeyValue(key=k, mod_revision=self.revision)
+            )
+        return len(keys)
+
+    def metadata(self, kv):
+        return KVMetadata(kv, self.header())
+
+    def range(self, key, range_end=None) -> list:
+        key = to_bytes(key)
+        if range_end is None:
+            kvs = [self.store[key]] if key in self.store else []
+        else:
+            end = to_bytes(range_end)
+            kvs = [self.store[k] for k in sorted(self.store) if key <= k < end]
+        return [(kv.value, self.metadata(kv)) for kv in kvs]
+
+    async def get(self, key, serializable=False):
+        found = self.range(key)
+        return found[0] if found else (None, None)
+
+    async def get_prefix(self, key_prefix, **kwargs):
+        prefix = to_bytes(key_prefix)
+        for item in self.range(prefix, prefix_range_end(prefix)):
+            yield item
+
+    async def put(self, key, value, lease=None, prev_kv=False):
+        self.set(key, value, lease=lease)
+        return aetcd3.rpc.PutResponse(header=self.header())
+
+    async def delete(self, key, prev_kv=False, return_response=False):
+        return self.remove(key) > 0
+
+    async def delete_prefix(self, prefix):
+        prefix = to_bytes(prefix)
+        self.remove(prefix, prefix_range_end(prefix))
+
+    async def watch(self, key, **kwargs):
+        key = to_bytes(key)
+        return self.watch_range(key, key + b'\0')
+
+    async def watch_prefix(self, key_prefix, **kwargs):
+        prefix = to_bytes(key_prefix)
+        return self.watch_range(prefix, prefix_range_end(prefix))
+
+    def watch_range(self, start: bytes, end: bytes):
+        queue = asyncio.Queue()
+        watcher = [start, end, queue]
+        self.watchers.append(watcher)
+
+        async def cancel():
+            if watcher in self.watchers:
+                self.watchers.remove(watcher)
+                queue.put_nowait(None)
+
+        async def iterator():
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+
+        return iterator(), cancel
+
+    def compare(self, compare) -> bool:
+        kv = self.store.get(to_bytes(compare.key))
+        if isinstance(compare, transactions.Value):
+            actual, expected = (kv.value if kv else None), to_bytes(compare.value)
+        else:
+            field = {
+                transactions.Version: 'version',
+                transactions.Create: 'create_revision',
+                transactions.Mod: 'mod_revision',
+            }[type(compare)]
+            actual, expected = (getattr(kv, field) if kv else 0), int(compare.value)
+        if actual is None:
+            return compare.op == aetcd3.rpc.Compare.NOT_EQUAL
+        return {
+            aetcd3.rpc.Compare.EQUAL: actual == expected,
+            aetcd3.rpc.Compare.NOT_EQUAL: actual != expected,
+            aetcd3.rpc.Compare.LESS: actual < expected,
+            aetcd3.rpc.Compare.GREATER: actual > expected,
+        }[compare.op]
+
+    async def transaction(self, compare, success=None, failure=None):
+        """Every operation of a transaction shares one revision, as in etcd"""
+        succeeded = all(self.compare(item) for item in compare)
+        responses = []
+        revision = self.revision + 1
+        for op in (success if succeeded else failure) or ():
+            if isinstance(op, transactions.Put):
+                self.set(op.key, op.value, lease=op.lease, revision=revision)
+                responses.append(
+                    aetcd3.rpc.ResponseOp(
+                        response_put=aetcd3.rpc.PutResponse(header=self.header())
+                    )
+                )
+            elif isinstance(op, transactions.Delete):
+                self.remove(op.key, op.range_end, revision=revision)
+                responses.append(
+                    aetcd3.rpc.ResponseOp(
+                        response_delete_range=aetcd3.rpc.DeleteRangeResponse(
+                            header=self.header()
+                        )
+                    )
+                )
+            elif isinstance(op, transactions.Get):
+                responses.append(self.range(op.key, op.range_end))
+        return succeeded, responses
+
+    async def lease(self, ttl, lease_id=None):
+        lease_id = lease_id or next(self.lease_ids)
+        self.leases[lease_id] = [ttl, 0, None]
+        self.keep(lease_id)
+        return aetcd3.Lease(lease_id=lease_id, ttl=ttl, etcd_client=self)
+
+    def keep(self, lease_id: int):
+        lease = self.leases[lease_id]
+        if lease[2] is not None:
+            lease[2].cancel()
+        lease[1] = time.monotonic() + lease[0]
+        lease[2] = asyncio.get_running_loop().call_later(
+            lease[0], self.expire, lease_id
+        )
+
+    def expire(self, lease_id: int):
+        lease = self.leases.pop(lease_id, None)
+        if lease is None:
+            return
+        if lease[2] is not None:
+            lease[2].cancel()
+        for key, kv in list(self.store.items()):
+            if kv.lease == lease_id:
+                self.remove(key)
+
+    async def revoke_lease(self, lease_id):
+        self.expire(lease_id)
+
+    async def refresh_lease(self, lease_id):
+        if lease_id not in self.leases:
+            return [aetcd3.rpc.LeaseKeepAliveResponse(ID=lease_id, TTL=0)]
+        self.keep(lease_id)
+        ttl = self.leases[lease_id][0]
+        return [aetcd3.rpc.LeaseKeepAliveResponse(ID=lease_id, TTL=ttl)]
+
+    async def get_lease_info(self, lease_id, *, keys=True):
+        lease = self.leases.get(lease_id)
+        if lease is None:
+            return aetcd3.rpc.LeaseTimeToLiveResponse(ID=lease_id, TTL=-1)
+        return aetcd3.rpc.LeaseTimeToLiveResponse(
+            ID=lease_id,
+            TTL=max(math.ceil(lease[1] - time.monotonic()), 0),
+            grantedTTL=lease[0],
+            keys=[key for key, kv in self.store.items() if kv.lease == lease_id],
+        )
+
+    async def close(self):
+        for lease in self.leases.values():
+            if lease[2] is not None:
+                lease[2].cancel()
+        for watcher in list(self.watchers):
+            watcher[2].put_nowait(None)
+        self.watchers.clear()
@@ -0,0 +1,218 @@
+"""
+Distributed locks on etcd
+
+A lock is a key under SERVICE_LOCK_ROOT, created by a transaction that only succeeds when
+the key does not exist yet, attached to a lease so the locks of a holder that died go
+away after SERVICE_LEASE_DEFAULT_SECONDS:
+
+    with lock('stats_vendor/1', 'stats_vendor/7', timeout=10) as held:
+        ...
+        held.check_threadsafe()     # LockLost once another holder may have them
+
+    async with alock('room/lobby') as held:
+        ...
+        await held.check()
+
+All the names of a lock are taken in one transaction, all or none, in sorted order. More
+than SERVICE_LOCK_BATCH_SIZE of them (the --max-txn-ops of etcd) take several, still in
+sorted order, so holders of overlapping names never wait on each other in a cycle.
+
+held.token is the fencing token, the etcd revision the locks were taken at. It grows with
+every acquisition, a store that remembers the highest token it accepted rejects the
+writes of a holder that stalled past its lease (StatsVendor.fence, see server.stats).
+check() alone does not: a holder can stall between the check and its write.
+"""
+import asyncio
+import json
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+import aetcd3
+from django.conf import settings
+
+from core.etcd import get_client
+from core.registry import get_registry_thread, instance_name
+
+LOGGER = logging.getLogger('django')
+
+
+class LockLost(RuntimeError):
+    """The lease of the lock ran out, another holder may have it"""
+
+
+class LockTimeout(TimeoutError):
+    pass
+
+
+class Lock:
+    def __init__(
+        self,
+        client,
+        *names: str,
+        timeout: Optional[float] = None,
+        root: Optional[str] = None,
+        ttl: Optional[int] = None,
+        refresh_when_smaller_than: Optional[int] = None,
+        batch_size: Optional[int] = None,
+    ):
+        self.client = client
+        root = root or settings.SERVICE_LOCK_ROOT
+        self.keys = [f'{root}{name}' for name in sorted(set(names))]
+        self.timeout = timeout
+        self.ttl = ttl or settings.SERVICE_LEASE_DEFAULT_SECONDS
+        self.refresh_when_smaller_than = (
+            refresh_when_smaller_than
+            or settings.SERVICE_LEASE_REFRESH_WHEN_SMALLER_THAN
+        )
+        self.batch_size = batch_size or getattr(
+            settings, 'SERVICE_LOCK_BATCH_SIZE', 128
+        )
+        self.value = json.dumps({'holder': instance_name()})
+        # key -> revision it was taken at
+        self.revisions: Dict[str, int] = {}
+        self.lease = None
+        self.task = None
+        self.loop = None
+        self.lost = False
+
+    @property
+    def token(self) -> Optional[int]:
+        return max(self.revisions.values()) if self.revisions else None
+
+    def batches(self) -> Iterator[List[str]]:
+        for start in range(0, len(self.keys), self.batch_size):
+            yield self.keys[start : start + self.batch_size]
+
+    async def acquire(self, timeout: Optional[float] = None) -> int:
+        """The fencing token, LockTimeout when not all were taken within timeout"""
+        if timeout is None:
+            timeout = self.timeout
+        self.loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else self.loop.time() + timeout
+        self.lost = False
+        self.lease = await self.client.lease(self.ttl)
+        self.task = asyncio.ensure_future(self.keep_alive())
+        try:
+            for keys in self.batches():
+                await self.acquire_batch(keys, deadline)
+        except BaseException:
+            await self.release()
+            raise
+        return self.token
+
+    async def acquire_batch(self, keys: List[str], deadline: Optional[float]):
+        transactions = self.client.transactions
+        while True:
+            succeeded, responses = await self.client.transaction(
+                compare=[transactions.create(key) == 0 for key in keys],
+                success=[transactions.put(key, self.value, self.lease) for key in keys],
+                failure=[transactions.get(key) for key in keys],
+            )
+            if succeeded:
+                revision = responses[0].response_put.header.revision
+                self.revisions.update(dict.fromkeys(keys, revision))
+                return
+            # the first one held, in the order every holder takes them
+            held = next((key for key, found in zip(keys, responses) if found), None)
+            if held is not None:
+                await self.wait_released(held, deadline)
+
+    async def wait_released(self, key: str, deadline: Optional[float]):
+        # watching first, a release right before the wait is not missed
+        events, cancel = await self.client.watch(key)
+        try:
+            value, _ = await self.client.get(key)
+            if value is None:
+                return
+            timeout = None if deadline is None else deadline - self.loop.time()
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self.deleted(events), timeout)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await cancel()
+        raise LockTimeout(f'{key} still held')
+
+    @staticmethod
+    async def deleted(events):
+        async for event in events:
+            if isinstance(event, aetcd3.DeleteEvent):
+                return
+
+    async def keep_alive(self):
+        while True:
+            await asyncio.sleep(max(self.ttl - self.refresh_when_smaller_than, 1))
+            try:
+                responses = await self.lease.refresh()
+            except Exception as e:
+                LOGGER.warning('lock lease not refreshed', exc_info=e)
+                continue
+            if not responses or responses[0].TTL <= 0:
+                LOGGER.warning('lock lease of %s expired', self.keys)
+                self.lost = True
+                return
+
+    async def check(self) -> int:
+        """The fencing token while all the locks are held, LockLost otherwise"""
+        if self.lost or not self.revisions:
+            raise LockLost(self.keys)
+        transactions = self.client.transactions
+        for keys in self.batches():
+            succeeded, _ = await self.client.transaction(
+                compare=[transactions.mod(key) == self.revisions[key] for key in keys],
+                success=[],
+                failure=[],
+            )
+            if not succeeded:
+                self.lost = True
+                raise LockLost(self.keys)
+        return self.token
+
+    def check_threadsafe(self) -> int:
+        """check() from another thread than the one of the loop it was taken in"""
+        return asyncio.run_coroutine_threadsafe(self.check(), self.loop).result()
+
+    async def release(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.revisions.clear()
+        if self.lease is not None:
+            lease, self.lease = self.lease, None
+            try:
+                await lease.revoke()
+            except Exception as e:
+                LOGGER.warning(
+                    'lock lease not revoked, %s held up to %ss',
+                    self.keys,
+                    self.ttl,
+                    exc_info=e,
+                )
+
+    async def __aenter__(self) -> 'Lock':
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.release()
+
+
+def alock(*names: str, **kwargs) -> Lock:
+    """A lock for the running loop, `async with alock('a', 'b') as held:`"""
+    return Lock(get_client(), *names, **kwargs)
+
+
+@contextmanager
+def lock(*names: str, **kwargs) -> Iterator[Lock]:
+    """A lock for sync code, taken in the loop of core.registry"""
+    thread = get_registry_thread()
+    held = thread.call(lambda: Lock(thread.client, *names, **kwargs))
+    thread.call(held.acquire)
+    try:
+        yield held
+    finally:
+        thread.call(held.release)
@@ -1,3 +1,4 @@
+import json
 import os
 import subprocess
 from typing import List
@@ -8,6 +9,34 @@ from django.core.management.base import CommandError
 from core.management.commands._base import MetaCommand
 
 
+def circus_endpoint() -> str:
+    circus_static_conf_list = getattr(settings, 'CIRCUSD_STATIC_CONFIG_LIST')
+    circus_section = None
+    for item in circus_static_conf_list:
+        if item['name'] == 'circus':
+            circus_section = item
+    return circus_section['settings']['endpoint']
+
+
+def read_connection_counts() -> dict:
+    """Websocket connections by pid, as written by access.plugins.ConnectionCounts"""
+    plugin = next(
+        (
+            item
+            for item in getattr(settings, 'CIRCUS_PLUGINS', [])
+            if item['settings']['use'] == 'access.plugins.ConnectionCounts'
+        ),
+        None,
+    )
+    if plugin is None:
+        raise CommandError("the connection_counts circus plugin is not configured")
+    try:
+        with open(plugin['settings']['stats_file']) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise CommandError("no connection counts yet, is circusd running?")
+
+
 class Command(MetaCommand):
     help = "Manage the circusd service"
 
@@ -41,15 +70,8 @@ class Command(MetaCommand):
 
     @classmethod
     def run_circusctl_cmd(cls, cmd_name=None, action_parameters: List[str] = None):
-        circus_static_conf_list = getattr(settings, 'CIRCUSD_STATIC_CONFIG_LIST')
-        circus_section = None
-        for item in circus_static_conf_list:
-            if item['name'] == 'circus':
-                circus_section = item
-        circus_section_settings = circus_section['settings']
-        circus_endpoint = circus_section_settings['endpoint']
         cmd = ["circusctl"]
-        cmd.extend(['--endpoint', circus_endpoint])
+        cmd.extend(['--endpoint', circus_endpoint()])
         if cmd_name:
             cmd.append(cmd_name)
             cmd.extend(action_parameters if action_parameters is not None else [])
@@ -95,3 +117,16 @@ class Command(MetaCommand):
     def action_reload(cls, *args, **options):
         action_parameters = options.get('action_parameters', [])
         cls.run_circusctl_cmd('reload', action_parameters)
+
+    def action_connections(self, *args, **options):
+        """Websocket connections of each daphne worker, see access.plugins"""
+        stats = read_connection_counts()
+        for pid, report in sorted(stats.items()):
+            capacity = report['max_connections'] or '-'
+            self.stdout.write(
+                f"{report['watcher'] or '?'} {pid}: "
+                f"{report['connections']}/{capacity}"
+            )
+        self.stdout.write(
+            f"total: {sum(report['connections'] for report in stats.values())}"
+        )
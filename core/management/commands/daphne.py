@@ -3,9 +3,11 @@ import os
 import signal
 import subprocess
 
+from django.conf import settings
 from django.core.management.base import CommandError
 
 from core.management.commands._base import MetaCommand
+from core.registry import SERVICE_ADDRESS_ENV
 
 
 class Command(MetaCommand):
@@ -63,10 +65,15 @@ class Command(MetaCommand):
         fd = options['fd']
         if fd:
             cmd = ['daphne', '--fd', fd]
+            # the socket circus listens on for all the workers of this host, registered
+            # with the host other hosts reach it at, see core.registry
+            socket_settings = settings.CIRCUS_SOCKETS[0]['settings']
+            address = f"{socket_settings['host']}:{socket_settings['port']}"
         else:
             bind = options['bind']
             port = options['port']
             cmd = ['daphne', '--bind', bind, '--port', port]
+            address = f'{bind}:{port}'
 
         endpoint = options['endpoint']
         if endpoint:
@@ -77,7 +84,8 @@ class Command(MetaCommand):
         try:
             # subprocess.run(cmd)
             # close_fds should be False, won't close the socket inherit from the parent process.
-            cls.P = subprocess.Popen(cmd, close_fds=False)
+            env = dict(os.environ, **{SERVICE_ADDRESS_ENV: address})
+            cls.P = subprocess.Popen(cmd, close_fds=False, env=env)
             cls.P.wait()
         except KeyboardInterrupt:
             pass
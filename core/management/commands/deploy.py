@@ -0,0 +1,203 @@
+"""
+Rolling reload of the circus watchers
+
+    python manage.py deploy rollout [watcher ...]
+
+Replaces the processes of each watcher one at a time, the oldest first:
+
+1. `incr`: a new process starts next to the old one, running the code deployed, the
+   rollout goes on once it registered under SERVICE_ROOT (core.registry)
+2. the old process is deregistered, clients of core.balancer stop sending it work, and
+   gets the drain signal of its registration: daphne turns new websockets away from then
+   on (access.admission), the other processes of the socket take them
+3. its websocket sessions (access.plugins.ConnectionCounts) get the graceful_timeout of
+   the watcher to finish, the whole of it when the counts can not be read
+4. `decr`: circus stops its oldest process, the old one, with the stop_signal of the
+   watcher, on TERM gunicorn closes its listener and lets the requests in flight finish
+
+A watcher never runs fewer processes than configured: gunicorn masters share their port
+with reuse_port, daphne processes the socket of circus.
+"""
+import os
+import socket
+import time
+from typing import List, Optional, Set, Tuple
+
+import psutil
+from circus.client import CircusClient
+from circus.exc import CallError
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from core.management.commands._base import MetaCommand
+from core.management.commands.circusd import circus_endpoint, read_connection_counts
+from core.registry import deregister_instance, get_directory, get_registry_thread
+
+
+class Command(MetaCommand):
+    help = "Deploy without downtime"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "action", nargs="?", help="specify the action you want to run", type=str
+        )
+        parser.add_argument(
+            "watchers", nargs="*", help="the circus watchers, all by default", type=str
+        )
+        parser.add_argument(
+            "--ready-timeout",
+            dest="ready_timeout",
+            type=float,
+            help="seconds a new process gets to register",
+        )
+
+    @staticmethod
+    def options() -> dict:
+        return getattr(settings, "DEPLOY_ROLLOUT", {})
+
+    @staticmethod
+    def watcher_setting(watcher: str, key: str) -> str:
+        for item in settings.CIRCUS_WATCHERS:
+            if item["name"] == watcher and key in item["settings"]:
+                return item["settings"][key]
+        return settings.CIRCUS_WATCHER_DEFAULT_SETTINGS[key]
+
+    @staticmethod
+    def circus_call(command: str, timeout: float = 5, **properties) -> dict:
+        client = CircusClient(endpoint=circus_endpoint(), timeout=timeout)
+        try:
+            response = client.send_message(command, **properties)
+        except CallError as e:
+            raise CommandError(f"circus {command}: {e}, is circusd running?") from e
+        finally:
+            client.stop()
+        if response.get("status") != "ok":
+            raise CommandError(f"circus {command}: {response.get('reason')}")
+        return response
+
+    def watcher_pids(self, watcher: str) -> List[int]:
+        """The oldest first, the order circus stops them in"""
+
+        def started(pid):
+            try:
+                return psutil.Process(pid).create_time()
+            except psutil.NoSuchProcess:
+                return 0
+
+        return sorted(self.circus_call("list", name=watcher)["pids"], key=started)
+
+    @staticmethod
+    def family(pid: int) -> Set[int]:
+        """The pid and its descendants, gunicorn and daphne run under manage.py"""
+        try:
+            children = psutil.Process(pid).children(recursive=True)
+        except psutil.NoSuchProcess:
+            return set()
+        return {pid, *(child.pid for child in children)}
+
+    @staticmethod
+    def registered(pids: Set[int]) -> List[Tuple[str, str, dict]]:
+        """(service, instance, value) of the registrations of these processes"""
+        directory = get_directory()
+        hostname = socket.gethostname()
+        # read in the loop the watch updates it from
+        return get_registry_thread().call(
+            lambda: [
+                (service, instance, value)
+                for service, instances in directory.services.items()
+                for instance, value in instances.items()
+                if value.get("host") == hostname and value.get("pid") in pids
+            ]
+        )
+
+    @staticmethod
+    def open_sessions(pids: Set[int]) -> Optional[int]:
+        """None when the counts can not be read"""
+        try:
+            counts = read_connection_counts()
+        except CommandError:
+            return None
+        return sum(
+            report["connections"] for pid, report in counts.items() if int(pid) in pids
+        )
+
+    def wait_ready(self, watcher: str, pid: int, timeout: float, poll_interval: float):
+        deadline = time.monotonic() + timeout
+        while not self.registered(self.family(pid)):
+            if time.monotonic() > deadline:
+                raise CommandError(
+                    f"{watcher}: {pid} not registered within {timeout}s, rollout "
+                    f"stopped with one process more, `circusctl decr {watcher}` to "
+                    f"drop the oldest"
+                )
+            time.sleep(poll_interval)
+
+    def drain(self, watcher: str, pid: int, timeout: float, poll_interval: float):
+        pids = self.family(pid)
+        draining = set()
+        for service, instance, value in self.registered(pids):
+            deregister_instance(service, instance)
+            # deregistered it still gets the connections of the socket it shares
+            if value.get("drain_signal"):
+                try:
+                    os.kill(value["pid"], value["drain_signal"])
+                except ProcessLookupError:
+                    continue
+                draining.add(value["pid"])
+        if not draining:
+            # no websocket sessions, gunicorn stops accepting on the stop_signal
+            return
+
+        deadline = time.monotonic() + timeout
+        sessions = self.open_sessions(draining)
+        if sessions is None:
+            self.stderr.write(
+                f"{watcher}: connection counts of {pid} unavailable, "
+                f"its sessions get the whole {timeout}s"
+            )
+        while sessions != 0 and time.monotonic() < deadline:
+            time.sleep(poll_interval)
+            sessions = self.open_sessions(draining)
+        if sessions:
+            self.stdout.write(
+                f"{watcher}: {pid} stopped with {sessions} websocket sessions open"
+            )
+
+    def roll(self, watcher: str, ready_timeout: float, poll_interval: float):
+        graceful_timeout = float(self.watcher_setting(watcher, "graceful_timeout"))
+        pids = self.watcher_pids(watcher)
+        self.stdout.write(f"{watcher}: replacing {len(pids)} processes")
+        for pid in pids:
+            before = set(self.watcher_pids(watcher))
+            self.circus_call("incr", name=watcher, timeout=ready_timeout)
+            started = set(self.watcher_pids(watcher)) - before
+            if not started:
+                raise CommandError(f"{watcher}: no process started")
+            new_pid = started.pop()
+            self.wait_ready(watcher, new_pid, ready_timeout, poll_interval)
+
+            self.drain(watcher, pid, graceful_timeout, poll_interval)
+            # circus waits graceful_timeout for the process to stop, then kills it
+            self.circus_call("decr", name=watcher, timeout=graceful_timeout + 10)
+            if pid in self.watcher_pids(watcher):
+                raise CommandError(
+                    f"{watcher}: circus stopped another process than {pid}"
+                )
+            self.stdout.write(f"{watcher}: {pid} replaced by {new_pid}")
+
+    def action_rollout(self, *args, **options):
+        watchers = (
+            options["watchers"]
+            or self.options().get("watchers")
+            or [item["name"] for item in settings.CIRCUS_WATCHERS]
+        )
+        for watcher in watchers:
+            if self.watcher_setting(watcher, "singleton") == "True":
+                raise CommandError(f"{watcher} is a singleton, it can not be rolled")
+
+        ready_timeout = options["ready_timeout"] or self.options().get(
+            "ready_timeout", 60
+        )
+        poll_interval = self.options().get("poll_interval", 0.5)
+        for watcher in watchers:
+            self.roll(watcher, ready_timeout, poll_interval)
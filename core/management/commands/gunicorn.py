@@ -42,15 +42,18 @@ class Command(MetaCommand):
     @classmethod
     def action_start(cls, *args, **options):
         def handle_quit_signal(signum, stack):
+            # TERM stops gracefully, gunicorn lets its workers finish their requests
+            sig_number = signal.SIGTERM if signum == signal.SIGTERM else signal.SIGINT
             # We must execute this action in a separate process.
             p = multiprocessing.Process(
-                target=cls.send_signal_to_process, args=(cls.P.pid, signal.SIGINT)
+                target=cls.send_signal_to_process, args=(cls.P.pid, sig_number)
             )
             p.start()
             p.join()
 
         signal.signal(signal.SIGQUIT, handle_quit_signal)
         signal.signal(signal.SIGINT, handle_quit_signal)
+        signal.signal(signal.SIGTERM, handle_quit_signal)
 
         cls.prepare_configuration_files()
 
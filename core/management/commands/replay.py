@@ -0,0 +1,66 @@
+from collections import defaultdict
+
+from django.core.management.base import CommandError
+
+from core.management.commands._base import MetaCommand
+from server.replay import RecordingWriter, ReplayDivergence, ReplayDriver
+
+
+class Command(MetaCommand):
+    help = 'Replay recorded generator handlers (see settings.SERVER_RECORD_FILENAME)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "action", nargs="?", help="specify the action you want to run", type=str
+        )
+        parser.add_argument('filename', help='the file recordings were written to')
+        parser.add_argument(
+            '--number',
+            dest='number',
+            type=int,
+            default=100,
+            help='how many times to replay each recording when benchmarking',
+        )
+
+    def action_check(self, *args, **options):
+        """Replay every recording and report the ones diverging from the capture"""
+        failed = 0
+        for index, recording in enumerate(RecordingWriter.read(options['filename'])):
+            try:
+                result = ReplayDriver(recording).run()
+            except ReplayDivergence as e:
+                failed += 1
+                self.stderr.write(f'#{index} {e}')
+                continue
+            except Exception as e:
+                if type(e) is not type(recording.error):
+                    failed += 1
+                    self.stderr.write(
+                        f'#{index} {recording.handler} raised {e!r}, '
+                        f'recorded {recording.error!r}'
+                    )
+                continue
+            if result != recording.result:
+                failed += 1
+                self.stderr.write(
+                    f'#{index} {recording.handler} returned {result!r}, '
+                    f'recorded {recording.result!r}'
+                )
+        if failed:
+            raise CommandError(f'{failed} recordings diverged')
+
+    def action_bench(self, *args, **options):
+        """Pure logic CPU cost per handler, no I/O involved"""
+        number = options['number']
+        costs = defaultdict(list)
+        for recording in RecordingWriter.read(options['filename']):
+            costs[recording.handler].append(
+                ReplayDriver(recording).benchmark(number=number)
+            )
+
+        for handler, handler_costs in sorted(costs.items()):
+            average = sum(handler_costs) / len(handler_costs)
+            self.stdout.write(
+                f'{handler}: {len(handler_costs)} recordings, '
+                f'{average * 1e6:.1f} us per run'
+            )
@@ -3,11 +3,14 @@ import json
 import logging
 import threading
 
+from asgiref.sync import sync_to_async
 from channels.http import AsgiRequest
 from django.http import JsonResponse
 from django.utils.decorators import sync_and_async_middleware
 from django.utils.deprecation import MiddlewareMixin
 
+from server.identity import IdentityMap, activate, deactivate
+
 
 class PureMiddleware:
     sync_capable = True
@@ -142,3 +145,38 @@ def simple_middleware(get_response):
             return response
 
     return middleware
+
+
+@sync_and_async_middleware
+def identity_map_middleware(get_response):
+    """
+    One `server.identity.IdentityMap` per request, dirty objects are written in one batch
+    when the response is a success or a redirect, a 4xx or 5xx leaves nothing half done.
+    """
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            identity_map = IdentityMap()
+            token = activate(identity_map)
+            try:
+                response = await get_response(request)
+                if response.status_code < 400:
+                    await sync_to_async(identity_map.flush)()
+            finally:
+                deactivate(token)
+            return response
+
+    else:
+
+        def middleware(request):
+            identity_map = IdentityMap()
+            token = activate(identity_map)
+            try:
+                response = get_response(request)
+                if response.status_code < 400:
+                    identity_map.flush()
+            finally:
+                deactivate(token)
+            return response
+
+    return middleware
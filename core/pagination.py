@@ -0,0 +1,76 @@
+"""
+Keyset (seek) pagination
+
+OFFSET pagination makes the database walk and drop every skipped row, so page N costs O(N).
+Keyset pagination remembers the sort key of the last row and seeks past it with an index on
+(sort field, id), every page costs the same:
+
+    WHERE (name > 'x') OR (name = 'x' AND id > 42) ORDER BY name, id LIMIT 21
+
+The cursor handed to clients is an opaque, url safe encoding of that last (value, id).
+"""
+import base64
+import json
+from typing import List, Optional, Tuple
+
+from django.db.models import Q, QuerySet
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(value, pk) -> str:
+    raw = json.dumps([value, pk], default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[object, object]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(cursor) from e
+    return value, pk
+
+
+def keyset_paginate(
+    queryset: QuerySet,
+    field: str,
+    descending: bool = False,
+    cursor: Optional[str] = None,
+    limit: int = 20,
+) -> Tuple[List, Optional[str]]:
+    """Return one page of the queryset ordered by (field, pk) and the next page cursor"""
+    model = queryset.model
+    pk_name = model._meta.pk.name
+    compare = 'lt' if descending else 'gt'
+    sign = '-' if descending else ''
+
+    if cursor is not None:
+        value, pk = decode_cursor(cursor)
+        try:
+            pk = model._meta.pk.to_python(pk)
+            if field == pk_name:
+                seek = Q(**{f'{pk_name}__{compare}': pk})
+            else:
+                value = model._meta.get_field(field).to_python(value)
+                seek = Q(**{f'{field}__{compare}': value}) | Q(
+                    **{field: value, f'{pk_name}__{compare}': pk}
+                )
+        except Exception as e:
+            raise InvalidCursor(cursor) from e
+        queryset = queryset.filter(seek)
+
+    if field == pk_name:
+        ordering = (f'{sign}{pk_name}',)
+    else:
+        ordering = (f'{sign}{field}', f'{sign}{pk_name}')
+    items = list(queryset.order_by(*ordering)[: limit + 1])
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, field), last.pk)
+    return items, next_cursor
@@ -0,0 +1,339 @@
+"""
+Service registry on etcd
+
+Every gunicorn and daphne worker registers itself under SERVICE_ROOT with a lease of
+SERVICE_LEASE_DEFAULT_SECONDS:
+
+    /metamap/services/<service>/<hostname>:<pid>   {"address": "web1:8000", ...}
+
+The workers of a host share its listening socket, they all register the address other
+hosts reach that socket at: a wildcard or loopback host is replaced by
+SERVICE_ADVERTISE_HOST, the hostname by default.
+
+The lease is refreshed once less than SERVICE_LEASE_REFRESH_WHEN_SMALLER_THAN seconds are
+left. A worker that dies drops out when its lease runs out, one that exits revokes it.
+
+ServiceDirectory is the registry as clients see it: loaded once, then kept current by a
+single watch stream on SERVICE_ROOT, so a lookup is a dict read instead of a round trip:
+
+    get_directory().instances('http')      # {'web1:4242': {'address': ...}, ...}
+
+Both run in one thread of each process, with an event loop and an etcd client of their
+own, sync views and async consumers use them alike.
+"""
+import asyncio
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import aetcd3
+from django.conf import settings
+
+from core.etcd import etcd_client
+
+LOGGER = logging.getLogger('django')
+
+# the address a daphne worker registers with, set by `manage.py daphne start`
+SERVICE_ADDRESS_ENV = 'SERVICE_ADDRESS'
+
+
+def instance_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def advertised_address(address: Optional[str]) -> Optional[str]:
+    """host:port of a listener bound to `address`, as other hosts reach it"""
+    if not address or address.startswith('unix:'):
+        return address
+    host, _, port = address.rpartition(':')
+    if host.strip('[]') in ('', '0.0.0.0', '::', '127.0.0.1', '::1', 'localhost'):
+        host = getattr(settings, 'SERVICE_ADVERTISE_HOST', None) or socket.gethostname()
+    return f'{host}:{port}'
+
+
+def parse_key(root: str, key: bytes) -> Optional[Tuple[str, str]]:
+    """(service, instance) of a registry key"""
+    service, _, instance = key.decode()[len(root) :].partition('/')
+    if not service or not instance:
+        return None
+    return service, instance
+
+
+class ServiceRegistration:
+    def __init__(
+        self,
+        client,
+        service: str,
+        value: Optional[dict] = None,
+        instance: Optional[str] = None,
+        root: Optional[str] = None,
+        ttl: Optional[int] = None,
+        refresh_when_smaller_than: Optional[int] = None,
+    ):
+        self.client = client
+        self.service = service
+        self.instance = instance or instance_name()
+        self.root = root or settings.SERVICE_ROOT
+        self.key = f'{self.root}{service}/{self.instance}'
+        self.value = {
+            'service': service,
+            'instance': self.instance,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'started_at': time.time(),
+            **(value or {}),
+        }
+        self.ttl = ttl or settings.SERVICE_LEASE_DEFAULT_SECONDS
+        self.refresh_when_smaller_than = (
+            refresh_when_smaller_than
+            or settings.SERVICE_LEASE_REFRESH_WHEN_SMALLER_THAN
+        )
+        self.lease = None
+        self.task = None
+
+    async def register(self):
+        self.lease = await self.client.lease(self.ttl)
+        await self.client.put(self.key, json.dumps(self.value), lease=self.lease)
+
+    async def update(self, **value):
+        """Change the registered value, under the same lease"""
+        self.value.update(value)
+        if self.lease is not None:
+            await self.client.put(self.key, json.dumps(self.value), lease=self.lease)
+
+    async def keep_alive(self):
+        remaining = 0
+        while True:
+            try:
+                if self.lease is not None:
+                    remaining = await self.lease.remaining_ttl()
+                if remaining <= 0:
+                    if self.lease is not None:
+                        LOGGER.warning(
+                            'lease of %s expired, registering again', self.key
+                        )
+                    await self.register()
+                    remaining = self.ttl
+                elif remaining <= self.refresh_when_smaller_than:
+                    await self.lease.refresh()
+                    remaining = self.ttl
+            except Exception as e:
+                LOGGER.warning('registration of %s not refreshed', self.key, exc_info=e)
+                remaining = self.refresh_when_smaller_than + 1
+            await asyncio.sleep(max(remaining - self.refresh_when_smaller_than, 1))
+
+    def start(self):
+        """Registers in the background, and keeps registered"""
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.keep_alive())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.lease is not None:
+            # the key goes with the lease right away, not ttl seconds later
+            await self.lease.revoke()
+            self.lease = None
+
+
+class ServiceDirectory:
+    def __init__(self, client, root: Optional[str] = None):
+        self.client = client
+        self.root = root or settings.SERVICE_ROOT
+        # service -> {instance: value}
+        self.services: Dict[str, Dict[str, dict]] = {}
+        # key -> mod revision of the value we have
+        self.revisions: Dict[bytes, int] = {}
+        self.listeners: List[Callable] = []
+        self.synced = threading.Event()
+        self.task = None
+
+    def instances(self, service: str) -> Dict[str, dict]:
+        return dict(self.services.get(service, {}))
+
+    def instance(self, service: str, instance: str) -> Optional[dict]:
+        return self.services.get(service, {}).get(instance)
+
+    def add_listener(self, callback: Callable):
+        """callback(service, instance, value) on every change, value None when gone"""
+        self.listeners.append(callback)
+
+    def apply(self, key: bytes, value: Optional[bytes], revision: int):
+        # events queued while the snapshot was read may be older than it
+        if revision <= self.revisions.get(key, 0):
+            return
+        parsed = parse_key(self.root, key)
+        if parsed is None:
+            return
+        if value is None:
+            self.remove(key)
+            return
+        try:
+            decoded = json.loads(value)
+        except ValueError:
+            LOGGER.warning('invalid registration %s', key)
+            return
+        self.revisions[key] = revision
+        service, instance = parsed
+        self.services.setdefault(service, {})[instance] = decoded
+        self.notify(service, instance, decoded)
+
+    def remove(self, key: bytes):
+        self.revisions.pop(key, None)
+        service, instance = parse_key(self.root, key)
+        instances = self.services.get(service, {})
+        if instances.pop(instance, None) is None:
+            return
+        if not instances:
+            del self.services[service]
+        self.notify(service, instance, None)
+
+    def notify(self, service: str, instance: str, value: Optional[dict]):
+        for listener in self.listeners:
+            try:
+                listener(service, instance, value)
+            except Exception as e:
+                LOGGER.warning('registry listener failed', exc_info=e)
+
+    async def sync(self):
+        """Read the registry once, then follow its changes"""
+        # watching first, nothing changed while the snapshot is read is missed
+        events, cancel = await self.client.watch_prefix(self.root)
+        try:
+            seen = set()
+            async for value, metadata in self.client.get_prefix(self.root):
+                seen.add(metadata.key)
+                self.apply(metadata.key, value, metadata.mod_revision)
+            for key in [key for key in self.revisions if key not in seen]:
+                self.remove(key)
+            self.synced.set()
+            async for event in events:
+                deleted = isinstance(event, aetcd3.DeleteEvent)
+                self.apply(
+                    event.key, None if deleted else event.value, event.mod_revision
+                )
+        finally:
+            await cancel()
+
+    async def run(self):
+        while True:
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                LOGGER.warning('registry watch lost, reading it again', exc_info=e)
+                await asyncio.sleep(1)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+
+class RegistryThread(threading.Thread):
+    """The event loop and the etcd client of the registry in this process"""
+
+    def __init__(self):
+        super().__init__(name='service-registry', daemon=True)
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def call(self, function: Callable, timeout: Optional[float] = None):
+        """function() in the loop of the thread, awaited when it returns an awaitable"""
+
+        async def call():
+            if self.client is None:
+                self.client = etcd_client()
+            result = function()
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result(timeout)
+
+
+_thread: Optional[RegistryThread] = None
+_thread_lock = threading.Lock()
+_registrations: List[ServiceRegistration] = []
+_directory: Optional[ServiceDirectory] = None
+
+
+def get_registry_thread() -> RegistryThread:
+    global _thread, _directory
+    with _thread_lock:
+        # threads do not survive a fork, the workers of a preloaded app start their own
+        if _thread is None or _thread.pid != os.getpid():
+            _thread = RegistryThread()
+            _thread.start()
+            _registrations.clear()
+            _directory = None
+        return _thread
+
+
+def register_worker(
+    service: str, address: Optional[str] = None, **value
+) -> ServiceRegistration:
+    """Register this process under SERVICE_ROOT until it exits"""
+    value['address'] = advertised_address(address)
+    thread = get_registry_thread()
+    registration = thread.call(
+        lambda: ServiceRegistration(thread.client, service, value)
+    )
+    thread.call(registration.start)
+    if not _registrations:
+        atexit.register(deregister_worker)
+    _registrations.append(registration)
+    return registration
+
+
+def deregister_worker(timeout: float = 5):
+    """Take this process out of the registry, clients stop routing to it"""
+    if _thread is None or _thread.pid != os.getpid():
+        return
+    while _registrations:
+        registration = _registrations.pop()
+        try:
+            _thread.call(registration.stop, timeout=timeout)
+        except Exception as e:
+            LOGGER.warning('%s not deregistered', registration.key, exc_info=e)
+
+
+def deregister_instance(service: str, instance: str):
+    """
+    Take another process out of the registry, its lease lives on and it is not registered
+    again unless the lease runs out
+    """
+    thread = get_registry_thread()
+    thread.call(
+        lambda: thread.client.delete(f'{settings.SERVICE_ROOT}{service}/{instance}')
+    )
+
+
+def get_directory(timeout: float = 5) -> ServiceDirectory:
+    """The directory of this process, waits up to timeout for its first read"""
+    global _directory
+    thread = get_registry_thread()
+    with _thread_lock:
+        if _directory is None:
+            _directory = thread.call(lambda: ServiceDirectory(thread.client))
+            thread.call(_directory.start)
+    _directory.synced.wait(timeout)
+    return _directory
@@ -1,3 +1,460 @@
-from django.test import TestCase
+import asyncio
+import functools
+import gc
+import json
 
-# Create your tests here.
+import pytest
+from django.http import HttpResponse
+
+from core.balancer import ServiceBalancer
+from core.cache import LRUCache, ModelCache, handle_invalidation
+from core.etcd import MemoryEtcd
+from core.locks import Lock, LockLost, LockTimeout
+from core.middleware import identity_map_middleware
+from core.registry import (
+    ServiceDirectory,
+    ServiceRegistration,
+    advertised_address,
+)
+from core.utils.ws_client import WebsocketClient, backoff_delay, resume_uri
+from core.utils.ws_load import LatencyHistogram, LoadConfig, run_load
+from server.identity import current
+from server.models import GoodTable, Server
+
+
+@pytest.fixture(autouse=True)
+def set_test_settings(settings):
+    settings.DEBUG = True
+    settings.CACHES = {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    }
+    settings.MODEL_CACHE = {**settings.MODEL_CACHE, 'invalidation_channel': None}
+    yield
+    for model_cache in ModelCache.registry.values():
+        model_cache.local.clear()
+
+
+def test_identity_map_middleware(transactional_db, rf):
+    good = GoodTable.objects.create(name='good')
+
+    def view(request, content='flushed', status=200):
+        identity_map = current()
+        loaded = identity_map.get(GoodTable, good.pk)
+        loaded.content = content
+        identity_map.mark_dirty(loaded, 'content')
+        return HttpResponse(status=status)
+
+    identity_map_middleware(view)(rf.get('/'))
+    assert current() is None
+    assert GoodTable.objects.get(pk=good.pk).content == 'flushed'
+
+    # an error response leaves the unit of work unwritten
+    failing = functools.partial(view, content='half done', status=400)
+    identity_map_middleware(failing)(rf.get('/'))
+    assert GoodTable.objects.get(pk=good.pk).content == 'flushed'
+
+
+def test_lru_cache():
+    lru = LRUCache(maxsize=2, ttl=60)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1
+    lru.set('c', 3)
+    # b is the least recently used
+    assert lru.get('b') is None
+    assert len(lru) == 2
+
+    lru.ttl = -1
+    lru.set('d', 4)
+    assert lru.get('d') is None
+
+
+def test_model_cache(transactional_db):
+    from django.db import connection
+
+    from server.caches import good_table_cache
+
+    good = GoodTable.objects.create(name='cached', content='v1')
+    sql_count = len(connection.queries)
+    assert good_table_cache.get(name='cached').content == 'v1'
+    assert good_table_cache.get(name='cached').content == 'v1'
+    assert good_table_cache.get(pk=good.pk).content == 'v1'
+    assert len(connection.queries) == sql_count + 1
+
+    # only the Redis tier left
+    good_table_cache.local.clear()
+    assert good_table_cache.get(pk=good.pk).content == 'v1'
+    assert len(connection.queries) == sql_count + 1
+
+    good.content = 'v2'
+    good.name = 'renamed'
+    good.save()
+    assert good_table_cache.get(name='renamed').content == 'v2'
+    with pytest.raises(GoodTable.DoesNotExist):
+        good_table_cache.get(name='cached')
+
+
+def test_model_cache_invalidated_on_commit(transactional_db):
+    from django.db import transaction
+
+    from server.caches import good_table_cache
+    from server.identity import identity_map_scope
+
+    good = GoodTable.objects.create(name='cached', content='v1')
+    good_table_cache.get(pk=good.pk)
+    with transaction.atomic():
+        good.content = 'v2'
+        good.save()
+        # a reader before the commit still gets the committed row
+        assert good_table_cache.get(pk=good.pk).content == 'v1'
+        good_table_cache.get(pk=good.pk)
+    assert good_table_cache.get(pk=good.pk).content == 'v2'
+
+    # bulk_update sends no post_save
+    with identity_map_scope() as identity_map:
+        loaded = identity_map.get(GoodTable, good.pk)
+        loaded.content = 'v3'
+        identity_map.mark_dirty(loaded, 'content')
+    assert good_table_cache.get(pk=good.pk).content == 'v3'
+
+
+def test_model_cache_invalidation_message(transactional_db):
+    from server.caches import server_cache
+
+    server = Server.objects.create(name='s1', ip='127.0.0.1')
+    server_cache.get(pk=server.pk)
+    assert len(server_cache.local) == 1
+    handle_invalidation(f'server.server {server.pk}'.encode())
+    assert len(server_cache.local) == 0
+
+
+def test_invalidation_subscriber_subscribes_first(settings, monkeypatch):
+    import threading
+
+    from core import cache
+
+    events = []
+
+    class PubSub:
+        def subscribe(self, channel):
+            events.append('subscribe')
+
+        def get_message(self, timeout=0):
+            events.append('confirmed')
+            return {'type': 'subscribe', 'data': 1}
+
+        def listen(self):
+            threading.Event().wait()
+            yield
+
+    class Client:
+        def pubsub(self):
+            return PubSub()
+
+    settings.MODEL_CACHE = {**settings.MODEL_CACHE, 'invalidation_channel': 'test'}
+    monkeypatch.setattr(cache, 'redis_client', Client)
+    monkeypatch.setattr(cache, '_subscriber_pid', None)
+    cache.start_invalidation_subscriber()
+    # before the first cached read is served
+    assert events == ['subscribe', 'confirmed']
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    for millisecond in range(1, 1001):
+        histogram.record(millisecond / 1000)
+    assert len(histogram) == 1000
+    assert histogram.percentile(50) == pytest.approx(0.5, rel=0.03)
+    assert histogram.percentile(99) == pytest.approx(0.99, rel=0.03)
+    assert histogram.percentile(99.9) <= histogram.maximum == 1
+
+    other = LatencyHistogram()
+    other.record(5)
+    histogram.merge(other)
+    assert histogram.percentile(100) == 5
+
+
+async def test_load_generator():
+    import websockets
+
+    groups = {}
+
+    async def broadcast(ws, path):
+        members = groups.setdefault(path, set())
+        members.add(ws)
+        await ws.send('hello, not JSON')
+        try:
+            async for frame in ws:
+                websockets.broadcast(members, frame)
+        finally:
+            members.discard(ws)
+
+    async with websockets.serve(broadcast, '127.0.0.1', 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        config = LoadConfig(
+            host='127.0.0.1',
+            port=port,
+            connections=20,
+            group_prefix='room',
+            groups=3,
+            distribution='zipf',
+            join_rate=200,
+            message_rate=20,
+            duration=1,
+        )
+        stats = await run_load(config, config.connections, config.join_rate)
+
+    assert stats.connected == 20 and stats.failed == 0
+    assert stats.invalid == 20
+    assert {path.rsplit('/', 2)[1][:4] for path in groups} == {'room'}
+    assert len(stats.connect) == 20
+    assert len(stats.round_trip) > 0 and len(stats.fanout) > 0
+    assert stats.received >= stats.sent
+    assert 'p999' in stats.report()
+
+
+def test_backoff_delay():
+    assert backoff_delay(0, 0.5, 30, uniform=lambda low, high: high) == 0.5
+    assert backoff_delay(3, 0.5, 30, uniform=lambda low, high: high) == 4
+    assert backoff_delay(10, 0.5, 30, uniform=lambda low, high: high) == 30
+    assert 0 <= backoff_delay(10, 0.5, 30) <= 30
+    assert resume_uri('ws://h/ws/access/a/?x=1&resume=1', 7) == (
+        'ws://h/ws/access/a/?x=1&resume=7'
+    )
+
+
+async def test_client_reconnects_with_resume_token(monkeypatch):
+    import websockets
+    from websockets.datastructures import Headers
+    from websockets.exceptions import InvalidStatusCode
+
+    paths = []
+    refused = []
+
+    async def flaky(ws, path):
+        paths.append(path)
+        await ws.send(json.dumps({'message': 'hi', 'seq': 4 + len(paths)}))
+        if len(paths) < 3:
+            await ws.close()
+        else:
+            # stays connected, the client is not cancelled halfway through a handshake
+            await ws.wait_closed()
+
+    connect = websockets.connect
+
+    def refuse_once(uri, **kwargs):
+        # a handshake turned away, by the admission middleware for instance
+        if len(paths) == 1 and not refused:
+            refused.append(uri)
+            raise InvalidStatusCode(503, Headers())
+        return connect(uri, **kwargs)
+
+    monkeypatch.setattr(websockets, 'connect', refuse_once)
+    async with websockets.serve(flaky, '127.0.0.1', 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        messages = []
+        client = WebsocketClient(
+            uri=f'ws://127.0.0.1:{port}/ws/access/room/',
+            on_message=messages.append,
+            backoff_base=0.01,
+        )
+        task = asyncio.ensure_future(client._run())
+        while len(messages) < 3:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        client.user_input_task.cancel()
+        await asyncio.gather(task, client.user_input_task, return_exceptions=True)
+        # nothing left for the loop exception handler, which shuts the client down
+        gc.collect()
+        await asyncio.sleep(0)
+        assert client.shutdown_reason is None
+
+    assert refused == [f'ws://127.0.0.1:{port}/ws/access/room/?resume=5']
+    assert paths == [
+        '/ws/access/room/',
+        '/ws/access/room/?resume=5',
+        '/ws/access/room/?resume=6',
+    ]
+    assert client.last_seq == 7
+
+
+def test_advertised_address(settings):
+    settings.SERVICE_ADVERTISE_HOST = '10.0.0.7'
+    assert advertised_address('0.0.0.0:8000') == '10.0.0.7:8000'
+    assert advertised_address('127.0.0.1:20000') == '10.0.0.7:20000'
+    assert advertised_address('[::]:8000') == '10.0.0.7:8000'
+    assert advertised_address('web2:8000') == 'web2:8000'
+    assert advertised_address('unix:/run/gunicorn.sock') == 'unix:/run/gunicorn.sock'
+    assert advertised_address(None) is None
+
+
+async def test_service_registration():
+    etcd = MemoryEtcd()
+    registration = ServiceRegistration(
+        etcd,
+        'http',
+        {'address': '127.0.0.1:8000'},
+        instance='web1:1',
+        root='/test/services/',
+        ttl=2,
+        refresh_when_smaller_than=1,
+    )
+    registration.start()
+    await asyncio.sleep(0.01)
+    value, _ = await etcd.get('/test/services/http/web1:1')
+    assert json.loads(value)['address'] == '127.0.0.1:8000'
+
+    # refreshed before the lease runs out
+    await asyncio.sleep(3)
+    assert (await etcd.get('/test/services/http/web1:1'))[0] is not None
+
+    # gone with its lease, and registered again by the keepalive
+    etcd.expire(registration.lease.id)
+    assert (await etcd.get('/test/services/http/web1:1'))[0] is None
+    await asyncio.sleep(1.1)
+    assert (await etcd.get('/test/services/http/web1:1'))[0] is not None
+
+    await registration.stop()
+    assert (await etcd.get('/test/services/http/web1:1'))[0] is None
+    await etcd.close()
+
+
+async def test_service_directory():
+    etcd = MemoryEtcd()
+    root = '/test/services/'
+    await etcd.put(f'{root}http/web1:1', json.dumps({'address': 'a'}))
+    directory = ServiceDirectory(etcd, root=root)
+    changes = []
+    directory.add_listener(lambda *change: changes.append(change))
+    directory.start()
+    await asyncio.sleep(0.01)
+    assert directory.synced.is_set()
+    assert directory.instances('http') == {'web1:1': {'address': 'a'}}
+
+    lease = await etcd.lease(10)
+    await etcd.put(f'{root}http/web2:1', json.dumps({'address': 'b'}), lease=lease)
+    await etcd.put(f'{root}asgi/web1:2', json.dumps({'address': 'c'}))
+    await etcd.delete(f'{root}http/web1:1')
+    await asyncio.sleep(0.01)
+    assert directory.instances('http') == {'web2:1': {'address': 'b'}}
+    assert directory.instance('asgi', 'web1:2') == {'address': 'c'}
+
+    await lease.revoke()
+    await asyncio.sleep(0.01)
+    assert directory.instances('http') == {}
+    assert changes[-1] == ('http', 'web2:1', None)
+
+    # a resync drops what was deleted while the watch was lost
+    await directory.stop()
+    await etcd.delete(f'{root}asgi/web1:2')
+    directory.start()
+    await asyncio.sleep(0.01)
+    assert directory.services == {}
+    await directory.stop()
+    await etcd.close()
+
+
+async def test_locks():
+    etcd = MemoryEtcd()
+    first = Lock(etcd, 'b', 'a', root='/test/locks/')
+    token = await first.acquire()
+    assert await first.check() == token
+
+    # overlapping on b, taken in one transaction or not at all
+    with pytest.raises(LockTimeout):
+        await Lock(etcd, 'c', 'b', root='/test/locks/').acquire(timeout=0.05)
+    assert (await etcd.get('/test/locks/c'))[0] is None
+
+    second = Lock(etcd, 'c', 'b', root='/test/locks/', batch_size=1)
+    waiting = asyncio.ensure_future(second.acquire())
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+    await first.release()
+    # fencing tokens grow with every acquisition
+    assert await asyncio.wait_for(waiting, 1) > token
+    assert second.revisions['/test/locks/b'] < second.revisions['/test/locks/c']
+    with pytest.raises(LockLost):
+        await first.check()
+
+    etcd.expire(second.lease.id)
+    with pytest.raises(LockLost):
+        await second.check()
+    await second.release()
+    await etcd.close()
+
+
+async def test_service_balancer():
+    etcd = MemoryEtcd()
+    root = '/test/services/'
+    for name in ('a', 'b', 'c'):
+        await etcd.put(f'{root}asgi/{name}:1', json.dumps({'address': f'{name}:80'}))
+    # the workers of a host share its address, one endpoint on the ring
+    await etcd.put(f'{root}asgi/a:2', json.dumps({'address': 'a:80'}))
+    directory = ServiceDirectory(etcd, root=root)
+    directory.start()
+    await asyncio.sleep(0.01)
+    balancer = ServiceBalancer(directory, 'asgi')
+    assert sorted(balancer.ring.get_nodes()) == ['a:80', 'b:80', 'c:80']
+    assert balancer.ring.nodes['a:80']['weight'] == 2
+
+    keys = [f'user:{i}' for i in range(300)]
+    owners = {key: balancer.route(key) for key in keys}
+    assert set(owners.values()) == {'a:80', 'b:80', 'c:80'}
+
+    # one worker of a host gone, the endpoint stays
+    await etcd.delete(f'{root}asgi/a:2')
+    await asyncio.sleep(0.01)
+    assert balancer.ring.nodes['a:80']['weight'] == 1
+    owners = {key: balancer.route(key) for key in keys}
+
+    # only the keys of the endpoint gone move, and come back with it
+    await etcd.delete(f'{root}asgi/b:1')
+    await asyncio.sleep(0.01)
+    moved = {key for key in keys if balancer.route(key) != owners[key]}
+    assert moved == {key for key in keys if owners[key] == 'b:80'}
+    await etcd.put(f'{root}asgi/b:1', json.dumps({'address': 'b:80'}))
+    await asyncio.sleep(0.01)
+    assert {key: balancer.route(key) for key in keys} == owners
+
+    # the least loaded of two
+    await etcd.delete(f'{root}asgi/c:1')
+    await asyncio.sleep(0.01)
+    with balancer.track('a:80'):
+        assert {balancer.pick() for _ in range(20)} == {'b:80'}
+    assert balancer.in_flight == {}
+
+    await directory.stop()
+    await etcd.close()
+
+
+def test_deploy_drain(monkeypatch):
+    import io
+    import signal
+
+    from core.management.commands import deploy
+
+    command = deploy.Command(stdout=io.StringIO(), stderr=io.StringIO())
+    registrations = [
+        ('asgi', 'web1:11', {'pid': 11, 'drain_signal': int(signal.SIGUSR1)}),
+        ('http', 'web1:12', {'pid': 12}),
+    ]
+    deregistered, killed = [], []
+    monkeypatch.setattr(command, 'family', lambda pid: {10, 11, 12})
+    monkeypatch.setattr(command, 'registered', lambda pids: registrations)
+    monkeypatch.setattr(
+        deploy, 'deregister_instance', lambda *key: deregistered.append(key)
+    )
+    monkeypatch.setattr(deploy.os, 'kill', lambda *args: killed.append(args))
+    sessions = iter([2, 1, 0])
+    monkeypatch.setattr(command, 'open_sessions', lambda pids: next(sessions))
+
+    command.drain('daphne', 10, timeout=5, poll_interval=0)
+    assert deregistered == [('asgi', 'web1:11'), ('http', 'web1:12')]
+    # new websockets are turned away before the sessions are waited for
+    assert killed == [(11, signal.SIGUSR1)]
+    assert next(sessions, None) is None
+
+    # no counts to wait on, the whole timeout and a word about it
+    monkeypatch.setattr(command, 'open_sessions', lambda pids: None)
+    command.drain('daphne', 10, timeout=0.05, poll_interval=0.01)
+    assert 'unavailable' in command.stderr.getvalue()
@@ -2,28 +2,56 @@ import argparse
 import asyncio
 import json
 import logging
+import random
 import signal
 import sys
-import time
-from typing import Callable
-from urllib.parse import urljoin, urlencode, parse_qsl, urlunsplit
+from typing import Callable, Optional
+from urllib.parse import urljoin, urlencode, parse_qsl, urlsplit, urlunsplit
 
 import attr
 import websockets
-from websockets.exceptions import ConnectionClosedError
+from websockets.exceptions import (
+    ConnectionClosed,
+    ConnectionClosedError,
+    WebSocketException,
+)
 from websockets.legacy.protocol import WebSocketCommonProtocol
 
 
+def backoff_delay(attempt: int, base: float, cap: float, uniform=random.uniform):
+    """
+    Exponential backoff with full jitter, clients restarted together spread their
+    reconnects over the whole window instead of retrying in lockstep
+    """
+    return uniform(0, min(cap, base * 2**attempt))
+
+
+def resume_uri(uri: str, last_seq: Optional[int]) -> str:
+    """Ask the server to replay what was sent to the group after last_seq"""
+    if last_seq is None:
+        return uri
+    scheme, netloc, path, query, fragment = urlsplit(uri)
+    args = [(key, value) for key, value in parse_qsl(query) if key != 'resume']
+    args.append(('resume', str(last_seq)))
+    return urlunsplit((scheme, netloc, path, urlencode(args), fragment))
+
+
 @attr.s
 class WebsocketClient:
-    CONN_TRIED_TIMES = 0
-
     uri = attr.ib(type=str)
     extra_headers = attr.ib(type=list[tuple[str, str]], default=attr.Factory(list))
     on_open = attr.ib(type=Callable, default=None)
     on_message = attr.ib(type=Callable, default=None)
     on_error = attr.ib(type=Callable, default=None)
     on_close = attr.ib(type=Callable, default=None)
+    max_retry_times = attr.ib(type=int, default=10)
+    backoff_base = attr.ib(type=float, default=0.5)
+    backoff_cap = attr.ib(type=float, default=30)
+    # the highest sequence number received, resumed from after a reconnect
+    last_seq = attr.ib(type=int, default=None)
+    retry_times = attr.ib(type=int, default=0, init=False)
+    # seconds the server asked to wait when it turned the connection away
+    retry_after = attr.ib(type=float, default=0, init=False)
     input_q = attr.ib(type=asyncio.Queue, init=False)
     event_loop = attr.ib(default=None, type=asyncio.BaseEventLoop, init=False)
     ws = attr.ib(type=WebSocketCommonProtocol, default=None, init=False)
@@ -112,27 +140,43 @@ class WebsocketClient:
     async def handle_ws_recv(self):
         if self.ws_recv_task.done():
             exception = self.ws_recv_task.exception()
-            if exception is not None and isinstance(exception, ConnectionClosedError):
+            if exception is not None and isinstance(exception, ConnectionClosed):
                 self.do_callback(self.on_close, exception)
                 raise exception
 
             data = self.ws_recv_task.result()
             data_dict: dict = json.loads(data)
+            seq = data_dict.get('seq') if isinstance(data_dict, dict) else None
+            if isinstance(seq, int) and (self.last_seq is None or seq > self.last_seq):
+                self.last_seq = seq
+            if isinstance(data_dict, dict) and data_dict.get('type') == 'rejected':
+                self.retry_after = data_dict.get('retry_after') or 0
             self.do_callback(self.on_message, data_dict)
             # schedule a new recv task
             self.ws_recv_task = self.get_recv_task()
 
-    async def _run(self):
-        async with websockets.connect(
-            self.uri, extra_headers=self.extra_headers
-        ) as client_side_ws:
-            # increment connect tried times
-            self.__class__.CONN_TRIED_TIMES = 0
+    def drop_recv_task(self):
+        """The recv task of a connection left, its ConnectionClosed is expected"""
+        task = self.ws_recv_task
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            task.exception()
+
+    async def _connect(self):
+        client_side_ws = await websockets.connect(
+            resume_uri(self.uri, self.last_seq), extra_headers=self.extra_headers
+        )
+        try:
+            self.retry_times = 0
 
             self.do_callback(self.on_open)
             self.ws = client_side_ws
             self.ws_recv_task = self.get_recv_task()
-            self.user_input_task = self.get_input_task()
+            if self.user_input_task is None:
+                self.user_input_task = self.get_input_task()
 
             while True:
                 await asyncio.wait(
@@ -141,6 +185,32 @@ class WebsocketClient:
                 )
                 await self.handle_user_input()
                 await self.handle_ws_recv()
+        finally:
+            self.drop_recv_task()
+            # the closing handshake swallows a cancel landing in it, shielded the
+            # cancel reaches this task and the handshake finishes on its own
+            await asyncio.shield(client_side_ws.close())
+
+    async def _run(self):
+        """Reconnect in the same loop until max_retry_times attempts in a row failed"""
+        while True:
+            try:
+                await self._connect()
+            except (WebSocketException, OSError, asyncio.TimeoutError) as e:
+                # refused handshakes (InvalidStatusCode, ...) are retried as well
+                self.do_callback(self.on_error, e)
+                if self.retry_times >= self.max_retry_times:
+                    await self.shutdown(loop=self.event_loop, reason=e)
+                    return
+                delay = self.retry_after + backoff_delay(
+                    self.retry_times, self.backoff_base, self.backoff_cap
+                )
+                self.retry_after = 0
+                self.retry_times += 1
+                logging.warning(
+                    'Reconnecting in %.2fs, attempt %s', delay, self.retry_times
+                )
+                await asyncio.sleep(delay)
 
     def run(self):
         self.event_loop.add_reader(sys.stdin, self.get_stdin, self.input_q)
@@ -170,23 +240,11 @@ class WebsocketClient:
 
     @classmethod
     def start_with_retry(cls, *args, **kwargs):
-        try:
-            max_retry_times = kwargs.pop('max_retry_times')
-        except KeyError:
-            max_retry_times = 10
-
-        while True:
-            cls.CONN_TRIED_TIMES += 1
-            shutdown_normal = cls.start(*args, **kwargs)
-            if shutdown_normal or cls.CONN_TRIED_TIMES > max_retry_times:
-                break
-            else:
-                logging.warning('Reconnecting')
-                time.sleep(1)
+        """Kept for callers of the old API, start() reconnects by itself"""
+        return cls.start(*args, **kwargs)
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
+def add_connection_arguments(parser: argparse.ArgumentParser):
     parser.add_argument(
         '--host', action='store', dest='host', type=str, default='localhost'
     )
@@ -201,17 +259,28 @@ if __name__ == '__main__':
         '--query-args', action='store', dest='query_args', type=str, default=''
     )
     parser.add_argument('--use-ssl', action='store_true', dest='use_ssl', default=False)
-    ns = parser.parse_args()
 
-    scheme = 'wss' if ns.use_ssl else 'ws'
-    netloc = f'{ns.host}:{ns.port}'
-    path = urljoin(ns.path, ns.group)
-    if ns.query_args:
-        query = urlencode(parse_qsl(ns.query_args))
+
+def build_uri(host, port, path, group, query_args='', use_ssl=False) -> str:
+    scheme = 'wss' if use_ssl else 'ws'
+    netloc = f'{host}:{port}'
+    path = urljoin(path, group)
+    if query_args:
+        query = urlencode(parse_qsl(query_args))
     else:
         query = ''
     fragment = ''
-    uri = urlunsplit((scheme, netloc, path, query, fragment))
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_connection_arguments(parser)
+    ns = parser.parse_args()
+
+    uri = build_uri(
+        ns.host, ns.port, ns.path, ns.group, ns.query_args, use_ssl=ns.use_ssl
+    )
     logging.warning('Connect to %s', uri)
     WebsocketClient.start_with_retry(
         uri=uri,
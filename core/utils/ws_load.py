@@ -0,0 +1,364 @@
+"""
+Websocket load generator
+
+    python core/utils/ws_load.py --connections 5000 --processes 4 --groups 100 \\
+        --distribution zipf --join-rate 500 --message-rate 0.5 --duration 60
+
+Connections are spread over the processes, each process holds its share in one event
+loop. They join `--groups` groups named after `--group` (`--group room` gives room0/,
+room1/, ...), uniform or zipf distributed, at `--join-rate` connections per second
+overall, then every connection sends `--message-rate` messages per second to its group,
+with exponential gaps. Measured:
+
+    connect     from the TCP connect to the accepted websocket handshake
+    round trip  a message coming back to its sender through the group fan-out
+    fan-out     a message reaching the other members of the group
+    throughput  messages sent and received per second
+
+A frame that is not a JSON message is counted as invalid, the connection goes on.
+
+Latencies are kept in log buckets of 2%, merged across the processes, and reported as
+p50/p99/p999. Raise the open files limit (ulimit -n) of the shell for large runs.
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import logging
+import math
+import random
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import attr
+import websockets
+from websockets.exceptions import ConnectionClosed
+
+try:
+    from core.utils.ws_client import add_connection_arguments, build_uri
+except ImportError:
+    # run as a script from core/utils
+    from ws_client import add_connection_arguments, build_uri
+
+BUCKET_BASE = 1.02
+
+
+@attr.s(slots=True)
+class LatencyHistogram:
+    """Latencies in log buckets of 2% wide, mergeable across processes"""
+
+    counts = attr.ib(type=Dict[int, int], factory=dict)
+    total = attr.ib(type=int, default=0)
+    maximum = attr.ib(type=float, default=0)
+
+    def record(self, seconds: float):
+        microseconds = max(seconds * 1e6, 1)
+        bucket = int(math.log(microseconds, BUCKET_BASE))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.maximum = max(self.maximum, seconds)
+
+    def merge(self, other: 'LatencyHistogram'):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """Upper bound of the bucket holding the percentile, in seconds"""
+        if not self.total:
+            return None
+        rank = math.ceil(self.total * percent / 100)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(BUCKET_BASE ** (bucket + 1) / 1e6, self.maximum)
+        return self.maximum
+
+    def __len__(self):
+        return self.total
+
+
+@attr.s(slots=True)
+class LoadStats:
+    connect = attr.ib(factory=LatencyHistogram)
+    round_trip = attr.ib(factory=LatencyHistogram)
+    fanout = attr.ib(factory=LatencyHistogram)
+    connected = attr.ib(type=int, default=0)
+    failed = attr.ib(type=int, default=0)
+    dropped = attr.ib(type=int, default=0)
+    invalid = attr.ib(type=int, default=0)
+    sent = attr.ib(type=int, default=0)
+    received = attr.ib(type=int, default=0)
+    elapsed = attr.ib(type=float, default=0)
+
+    def merge(self, other: 'LoadStats'):
+        self.connect.merge(other.connect)
+        self.round_trip.merge(other.round_trip)
+        self.fanout.merge(other.fanout)
+        self.connected += other.connected
+        self.failed += other.failed
+        self.dropped += other.dropped
+        self.invalid += other.invalid
+        self.sent += other.sent
+        self.received += other.received
+        self.elapsed = max(self.elapsed, other.elapsed)
+
+    def report(self) -> str:
+        def latencies(histogram: LatencyHistogram) -> str:
+            if not histogram.total:
+                return 'none'
+            points = [
+                f'{name} {histogram.percentile(percent) * 1000:.2f}ms'
+                for name, percent in (('p50', 50), ('p99', 99), ('p999', 99.9))
+            ]
+            maximum = histogram.maximum * 1000
+            return (
+                f'{histogram.total} samples, {", ".join(points)}, max {maximum:.2f}ms'
+            )
+
+        elapsed = self.elapsed or 1
+        return '\n'.join(
+            [
+                f'connections: {self.connected} connected, {self.failed} failed, '
+                f'{self.dropped} dropped by the server, {self.invalid} invalid frames',
+                f'connect:     {latencies(self.connect)}',
+                f'round trip:  {latencies(self.round_trip)}',
+                f'fan-out:     {latencies(self.fanout)}',
+                f'throughput:  {self.sent / elapsed:.1f} sent/s, '
+                f'{self.received / elapsed:.1f} received/s over {self.elapsed:.1f}s',
+            ]
+        )
+
+
+@attr.s(slots=True, frozen=True, kw_only=True)
+class LoadConfig:
+    host = attr.ib(type=str, default='localhost')
+    port = attr.ib(type=int, default=8000)
+    path = attr.ib(type=str, default='/ws/access/')
+    query_args = attr.ib(type=str, default='')
+    use_ssl = attr.ib(type=bool, default=False)
+    connections = attr.ib(type=int, default=100)
+    group_prefix = attr.ib(type=str, default='load')
+    groups = attr.ib(type=int, default=10)
+    distribution = attr.ib(type=str, default='uniform')
+    zipf_s = attr.ib(type=float, default=1.1)
+    join_rate = attr.ib(type=float, default=100)
+    message_rate = attr.ib(type=float, default=1)
+    payload_size = attr.ib(type=int, default=0)
+    duration = attr.ib(type=float, default=30)
+    connect_timeout = attr.ib(type=float, default=10)
+
+    def uri(self, group: str) -> str:
+        return build_uri(
+            self.host,
+            self.port,
+            self.path,
+            f'{group}/',
+            self.query_args,
+            use_ssl=self.use_ssl,
+        )
+
+
+def group_names(config: LoadConfig, count: int, seed: int) -> List[str]:
+    """The group of each of `count` connections"""
+    generator = random.Random(seed)
+    if config.distribution == 'zipf':
+        weights = [1 / (rank**config.zipf_s) for rank in range(1, config.groups + 1)]
+        cumulative = list(itertools.accumulate(weights))
+        return [
+            f'{config.group_prefix}'
+            f'{bisect.bisect(cumulative, generator.random() * cumulative[-1])}'
+            for _ in range(count)
+        ]
+    return [
+        f'{config.group_prefix}{generator.randrange(config.groups)}'
+        for _ in range(count)
+    ]
+
+
+def messages_of(frame) -> list:
+    """ValueError when the frame is no JSON object"""
+    data = json.loads(frame)
+    if not isinstance(data, dict):
+        raise ValueError(f'unexpected frame {frame!r:.100}')
+    if 'messages' in data:
+        return data['messages']
+    if 'message' in data:
+        return [data['message']]
+    return []
+
+
+async def send_messages(
+    config: LoadConfig, ws, client_id: str, stats: LoadStats, generator
+):
+    padding = 'x' * config.payload_size
+    while True:
+        await asyncio.sleep(generator.expovariate(config.message_rate))
+        message = {'client': client_id, 'sent_at': time.time()}
+        if padding:
+            message['padding'] = padding
+        await ws.send(json.dumps({'message': message}))
+        stats.sent += 1
+
+
+async def run_connection(
+    config: LoadConfig, group: str, client_id: str, stats: LoadStats, deadline: float
+):
+    started = time.perf_counter()
+    try:
+        ws = await asyncio.wait_for(
+            websockets.connect(config.uri(group), max_queue=None),
+            config.connect_timeout,
+        )
+    except Exception as e:
+        logging.debug('connection %s failed', client_id, exc_info=e)
+        stats.failed += 1
+        return
+    stats.connect.record(time.perf_counter() - started)
+    stats.connected += 1
+
+    sender = None
+    if config.message_rate > 0:
+        generator = random.Random(client_id)
+        sender = asyncio.ensure_future(
+            send_messages(config, ws, client_id, stats, generator)
+        )
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                frame = await asyncio.wait_for(ws.recv(), remaining)
+            except asyncio.TimeoutError:
+                break
+            received_at = time.time()
+            try:
+                messages = messages_of(frame)
+            except ValueError as e:
+                logging.debug('invalid frame on %s', client_id, exc_info=e)
+                stats.invalid += 1
+                continue
+            for message in messages:
+                if not isinstance(message, dict) or 'sent_at' not in message:
+                    # presence notices and the like
+                    continue
+                stats.received += 1
+                latency = received_at - message['sent_at']
+                if message.get('client') == client_id:
+                    stats.round_trip.record(latency)
+                else:
+                    stats.fanout.record(latency)
+    except ConnectionClosed:
+        stats.dropped += 1
+    finally:
+        if sender is not None:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+        await ws.close()
+
+
+async def run_load(
+    config: LoadConfig, count: int, join_rate: float, worker: int = 0
+) -> LoadStats:
+    """`count` connections of one process"""
+    stats = LoadStats()
+    started = time.monotonic()
+    deadline = started + config.duration
+    tasks = []
+    for index, group in enumerate(group_names(config, count, seed=worker)):
+        join_at = started + index / join_rate
+        await asyncio.sleep(max(join_at - time.monotonic(), 0))
+        if time.monotonic() >= deadline:
+            break
+        tasks.append(
+            asyncio.ensure_future(
+                run_connection(config, group, f'{worker}-{index}', stats, deadline)
+            )
+        )
+    await asyncio.gather(*tasks)
+    stats.elapsed = time.monotonic() - started
+    return stats
+
+
+def raise_open_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_worker(config: LoadConfig, count: int, join_rate: float, worker: int):
+    raise_open_files_limit()
+    return asyncio.run(run_load(config, count, join_rate, worker))
+
+
+def run(config: LoadConfig, processes: int = 1) -> LoadStats:
+    if processes <= 1:
+        return run_worker(config, config.connections, config.join_rate, 0)
+
+    shares = [
+        config.connections // processes + (worker < config.connections % processes)
+        for worker in range(processes)
+    ]
+    stats = LoadStats()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(
+                run_worker, config, share, config.join_rate / processes, worker
+            )
+            for worker, share in enumerate(shares)
+            if share
+        ]
+        for future in futures:
+            stats.merge(future.result())
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='websocket load generator')
+    add_connection_arguments(parser)
+    parser.add_argument('--connections', type=int, default=100)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument(
+        '--distribution', choices=('uniform', 'zipf'), default='uniform'
+    )
+    parser.add_argument('--zipf-s', dest='zipf_s', type=float, default=1.1)
+    parser.add_argument(
+        '--join-rate', dest='join_rate', type=float, default=100, help='connections/s'
+    )
+    parser.add_argument(
+        '--message-rate',
+        dest='message_rate',
+        type=float,
+        default=1,
+        help='messages/s of each connection',
+    )
+    parser.add_argument('--payload-size', dest='payload_size', type=int, default=0)
+    parser.add_argument(
+        '--duration', type=float, default=30, help='seconds from the first connect'
+    )
+    ns = parser.parse_args()
+
+    load_config = LoadConfig(
+        host=ns.host,
+        port=ns.port,
+        path=ns.path,
+        query_args=ns.query_args,
+        use_ssl=ns.use_ssl,
+        connections=ns.connections,
+        group_prefix=ns.group.strip('/'),
+        groups=ns.groups,
+        distribution=ns.distribution,
+        zipf_s=ns.zipf_s,
+        join_rate=ns.join_rate,
+        message_rate=ns.message_rate,
+        payload_size=ns.payload_size,
+        duration=ns.duration,
+    )
+    print(run(load_config, processes=ns.processes).report())
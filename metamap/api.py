@@ -1,10 +1,21 @@
+import json
+from datetime import datetime
 from typing import List, Optional
 
 from ninja import NinjaAPI, Schema, Query, Body
+from ninja.errors import HttpError
 from ninja_extra import NinjaExtraAPI, api_controller, http_get, http_post
-from pydantic import Field
-
-from server.models import Server
+from ninja_extra.permissions import IsAuthenticated
+from pydantic import Field, ValidationError, validator
+
+from access.auth import make_token, options as token_options
+from access.consumers import AccessConsumer
+from access.presence import get_presence
+from core.pagination import InvalidCursor, keyset_paginate
+from server.analytics import vendors_summary
+from server.bulk import upsert_servers
+from server.caches import good_table_cache, server_cache
+from server.models import GoodTable, Server
 
 api = NinjaAPI(version="2.0.0")
 api_extra = NinjaExtraAPI()
@@ -63,17 +74,82 @@ class CreateServerArgs(Schema):
 
 
 class SearchServerArgs(Schema):
-    name: str = Field()
+    name: Optional[str] = Field(description="name prefix")
+    ip: Optional[str] = Field()
     city: Optional[str] = Field()
 
 
+# Every sortable field has an index on (field, id), see server.models.Server
+SERVER_SORTABLE_FIELDS = ("id", "name", "ip", "date_added")
+
+
 class SearchServerSortArgs(Schema):
     field: str = Field(default="id")
     order: str = Field(default="ASC")
 
+    @validator("field")
+    def check_field(cls, value):
+        if value not in SERVER_SORTABLE_FIELDS:
+            raise ValueError(f"must be one of {', '.join(SERVER_SORTABLE_FIELDS)}")
+        return value
+
+    @validator("order")
+    def check_order(cls, value):
+        value = value.upper()
+        if value not in ("ASC", "DESC"):
+            raise ValueError("must be ASC or DESC")
+        return value
+
+
+class PageArgs(Schema):
+    cursor: Optional[str] = Field(description="next_cursor of the previous page")
+    limit: int = Field(default=20, ge=1, le=100)
+
 
 class ServerItem(Schema):
+    id: int = Field(...)
     name: str = Field(...)
+    ip: str = Field(...)
+    date_added: datetime = Field(...)
+
+
+class ServerPage(Schema):
+    items: List[ServerItem]
+    next_cursor: Optional[str]
+
+
+class BulkCreateServersResult(Schema):
+    received: int
+    created: int
+    updated: int
+
+
+class RecordErrors(Schema):
+    position: int
+    errors: List[dict]
+
+
+class BulkCreateServersErrors(Schema):
+    detail: List[RecordErrors]
+
+
+def read_records(request):
+    """
+    Yield (position, record) from a JSON array body, parsed in one piece, or from an NDJSON
+    body (one JSON object per line) parsed line by line. Either way every record is kept
+    until all of them are validated, the body is not streamed into the database.
+    """
+    if request.content_type == "application/json":
+        records = json.load(request)
+        if not isinstance(records, list):
+            raise ValueError("expect a JSON array")
+        yield from enumerate(records, 1)
+        return
+
+    for position, line in enumerate(request, 1):
+        line = line.strip()
+        if line:
+            yield position, json.loads(line)
 
 
 @api_controller("/server", tags=["Server"])
@@ -86,18 +162,156 @@ class ServerAPI:
     ):
         return create_server_args
 
-    @http_get("/search_server", response=List[ServerItem])
+    @http_post(
+        "/bulk_create_servers",
+        response={200: BulkCreateServersResult, 422: BulkCreateServersErrors},
+    )
+    def bulk_create_servers(self, request):
+        """
+        Body: CreateServerArgs records as NDJSON (application/x-ndjson) or a JSON array
+        (application/json). Every record is validated before anything is written,
+        servers already registered with the same (name, ip) are updated.
+        """
+        records, errors = [], []
+        try:
+            for position, record in read_records(request):
+                try:
+                    args = CreateServerArgs.parse_obj(record)
+                except ValidationError as e:
+                    errors.append({"position": position, "errors": e.errors()})
+                    continue
+                records.append((args.name, args.ip))
+        except ValueError as e:
+            raise HttpError(400, f"invalid body: {e}")
+        if errors:
+            return 422, {"detail": errors}
+
+        result = upsert_servers(records)
+        return {
+            "received": len(records),
+            "created": result.created,
+            "updated": result.updated,
+        }
+
+    @http_get("/get_server/{server_id}", response=ServerItem)
+    def get_server(self, request, server_id: int):
+        """Served by the process and Redis caches, see server.caches"""
+        try:
+            return server_cache.get(pk=server_id)
+        except Server.DoesNotExist:
+            raise HttpError(404, f"no server {server_id}")
+
+    @http_get("/search_server", response=ServerPage)
     def search_server(
         self,
         request,
         search_args: SearchServerArgs = Query(None),
         sort_args: SearchServerSortArgs = Query(None),
+        page_args: PageArgs = Query(None),
     ):
-        servers = [
-            Server(name=f"s{item}", ip=f"192.168.0.{item}") for item in range(10)
-        ]
-        return servers
+        queryset = Server.objects.all()
+        if search_args.name:
+            queryset = queryset.filter(name__startswith=search_args.name)
+        if search_args.ip:
+            queryset = queryset.filter(ip=search_args.ip)
+
+        try:
+            servers, next_cursor = keyset_paginate(
+                queryset,
+                sort_args.field,
+                descending=sort_args.order == "DESC",
+                cursor=page_args.cursor,
+                limit=page_args.limit,
+            )
+        except InvalidCursor:
+            raise HttpError(400, "invalid cursor")
+        return {"items": servers, "next_cursor": next_cursor}
+
+
+class GoodItem(Schema):
+    id: int
+    name: str
+    content: str
+
+
+@api_controller("/good_table", tags=["GoodTable"])
+class GoodTableAPI:
+    @http_get("/get_good/{name}", response=GoodItem)
+    def get_good(self, request, name: str):
+        """Served by the process and Redis caches, see server.caches"""
+        try:
+            return good_table_cache.get(name=name)
+        except GoodTable.DoesNotExist:
+            raise HttpError(404, f"no good {name}")
+
+
+@api_controller("/stats", tags=["Stats"], permissions=[IsAuthenticated])
+class StatsAPI:
+    @http_get("/vendors/summary", response=dict)
+    def vendors_summary(
+        self,
+        request,
+        top: int = Query(10, ge=1, le=1000),
+        bins: int = Query(10, ge=1, le=1000),
+    ):
+        """
+        Percentiles, histogram, top-K and per vendor aggregations of StatsVendor,
+        computed with NumPy over the columns instead of model instances, of the first
+        STATS_SUMMARY_MAX_ROWS rows.
+        """
+        return vendors_summary(top=top, bins=bins)
+
+
+class PresenceMember(Schema):
+    channel: str
+    user: Optional[str]
+
+
+class PresenceCount(Schema):
+    group: str
+    count: int
+
+
+@api_controller("/presence", tags=["Presence"])
+class PresenceAPI:
+    @http_get("/{name}/count", response=PresenceCount)
+    def count(self, request, name: str):
+        group = AccessConsumer.group_name_of(name)
+        return {"group": group, "count": get_presence().count(group)}
+
+    @http_get(
+        "/{name}/members",
+        response=List[PresenceMember],
+        permissions=[IsAuthenticated],
+    )
+    def members(
+        self,
+        request,
+        name: str,
+        offset: int = Query(0, ge=0),
+        limit: int = Query(100, ge=1, le=1000),
+    ):
+        group = AccessConsumer.group_name_of(name)
+        return get_presence().members(group, offset=offset, limit=limit)
+
+
+class AccessToken(Schema):
+    token: str
+    expires_in: int
+
+
+@api_controller("/access", tags=["Access"], permissions=[IsAuthenticated])
+class AccessTokenAPI:
+    @http_post("/token", response=AccessToken)
+    def token(self, request):
+        """A short lived token to connect websockets with, see access.auth"""
+        ttl = token_options().get("ttl", 300)
+        return {"token": make_token(request.user, ttl=ttl), "expires_in": ttl}
 
 
 api_extra.register_controllers(MathAPI)
 api_extra.register_controllers(ServerAPI)
+api_extra.register_controllers(GoodTableAPI)
+api_extra.register_controllers(StatsAPI)
+api_extra.register_controllers(PresenceAPI)
+api_extra.register_controllers(AccessTokenAPI)
@@ -9,19 +9,41 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
-from channels.auth import AuthMiddlewareStack
-from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 
-import access.routing
-
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'metamap.settings')
 
+# sets Django up, before the imports below load the models
+django_asgi_app = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+import access.routing  # noqa: E402
+from access.admission import (  # noqa: E402
+    DRAIN_SIGNAL,
+    AdmissionMiddleware,
+    install_drain_handler,
+)
+from access.auth import TokenAuthMiddlewareStack  # noqa: E402
+from core.registry import SERVICE_ADDRESS_ENV, register_worker  # noqa: E402
+
 application = ProtocolTypeRouter(
     {
-        'http': get_asgi_application(),
-        'websocket': AuthMiddlewareStack(
-            URLRouter(access.routing.websocket_urlpatterns)
+        'http': django_asgi_app,
+        # turned away before the session and user lookups, see access.admission, and
+        # no lookups at all for the connections with a token, see access.auth
+        'websocket': AdmissionMiddleware(
+            TokenAuthMiddlewareStack(URLRouter(access.routing.websocket_urlpatterns)),
+            **getattr(settings, 'ACCESS_ADMISSION', {}),
         ),
     }
 )
+
+# set by `manage.py daphne start`, every daphne worker registers, see core.registry, and
+# stops admitting websockets on the signal of `manage.py deploy rollout`
+if os.environ.get(SERVICE_ADDRESS_ENV):
+    install_drain_handler()
+    register_worker(
+        'asgi', os.environ[SERVICE_ADDRESS_ENV], drain_signal=int(DRAIN_SIGNAL)
+    )
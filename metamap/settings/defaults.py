@@ -76,6 +76,7 @@ MIDDLEWARE = [
     # "core.middleware.CoreMiddleware",
     # "core.middleware.PureMiddleware",
     # "core.middleware.simple_middleware",
+    "core.middleware.identity_map_middleware",
     "django_data_sdk.middleware.DjangoDataBottomMiddleware",
     "django_prometheus.middleware.PrometheusAfterMiddleware",
 ]
@@ -110,9 +111,11 @@ WSGI_APPLICATION = f"{MAIN_MODULE_NAME}.wsgi.application"
 
 ASGI_APPLICATION = f"{MAIN_MODULE_NAME}.asgi.application"
 
+# Groups are placed on the Redis hosts with a consistent hash ring, see access.layers.
+# Change the hosts live with HashRingChannelLayer.announce_rebalance(hosts).
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "access.layers.HashRingChannelLayer",
         "CONFIG": {
             "hosts": [
                 "redis://127.0.0.1:6379/0",
@@ -122,10 +125,158 @@ CHANNEL_LAYERS = {
             "group_expiry": 86400,
             "capacity": 100,
             "channel_capacity": {},
+            "rebalance_grace": 5,
         },
     },
 }
 
+# All daphne processes on one host: groups are kept by the processes over Unix sockets,
+# Redis ("remote") is only needed to reach other hosts, see access.layers
+# CHANNEL_LAYERS = {
+#     "default": {
+#         "BACKEND": "access.layers.LocalShardedChannelLayer",
+#         "CONFIG": {
+#             # private to the user running daphne, $XDG_RUNTIME_DIR when left out
+#             "socket_dir": os.path.join(BASE_DIR, "run", "channels"),
+#             "expiry": 60,
+#             "group_expiry": 86400,
+#             "capacity": 100,
+#         },
+#     },
+# }
+
+# Broadcasts to a group within window_ms are sent as one frame, see access.fanout.
+# 0 sends every message on its own, max_batch flushes a busy group early.
+ACCESS_FANOUT = {
+    "window_ms": 10,
+    "max_batch": 500,
+}
+
+# Frames waiting to be sent to one websocket connection, and what happens when a client
+# lags maxsize frames behind: "drop_oldest", "coalesce" (frames sent with the same key
+# replace each other) or "disconnect", see access.outbox
+ACCESS_OUTBOX = {
+    "maxsize": 100,
+    "policy": "drop_oldest",
+}
+
+# Websocket group presence, see access.presence. Groups are spread over redis_urls with
+# a consistent hash ring, a member expires ttl seconds (None: three heartbeat intervals)
+# after its last heartbeat.
+ACCESS_PRESENCE = {
+    "backend": "redis",
+    "redis_urls": [
+        "redis://127.0.0.1:6379/4",
+        "redis://127.0.0.1:6379/5",
+    ],
+    "prefix": f"{MAIN_MODULE_NAME}:presence",
+    "ttl": None,
+    "heartbeat_interval": 30,
+    # joins and leaves of a group are announced together once per interval
+    "notice_interval_ms": 500,
+}
+
+# Sequence numbers and recent messages of websocket groups for resuming clients, see
+# access.history. backend "redis" (a capped stream per group), "memory" (one process
+# only) or None to disable. A group keeps its last maxlen messages (and at most
+# max_bytes of them in memory) until ttl seconds after the last one, a resume gets at
+# most max_replay messages.
+ACCESS_HISTORY = {
+    "backend": "redis",
+    "redis_urls": [
+        "redis://127.0.0.1:6379/4",
+        "redis://127.0.0.1:6379/5",
+    ],
+    "prefix": f"{MAIN_MODULE_NAME}:history",
+    "maxlen": 1000,
+    "max_bytes": 1 << 20,
+    "ttl": 3600,
+    "max_replay": 1000,
+}
+
+# Websocket connection tokens, see access.auth: valid for ttl seconds, verified without
+# a database query. With user_cache_size the full users are resolved and kept in an LRU
+# of that size for user_cache_ttl seconds, 0 puts the token's id and username in
+# scope["user"] instead.
+ACCESS_TOKEN = {
+    "ttl": 300,
+    "user_cache_size": 0,
+    "user_cache_ttl": 60,
+}
+
+# Websockets admitted by one daphne worker, see access.admission: at most
+# max_connections at a time, new ones at rate per second with bursts of burst, the
+# others are told to retry after retry_after seconds. Live counts are sent to the
+# circus plugin listening on report_to (None: not reported).
+ACCESS_ADMISSION = {
+    "max_connections": 10000,
+    "rate": 200,
+    "burst": 400,
+    "retry_after": 5,
+    "report_to": "127.0.0.1:1665",
+    "report_interval": 1,
+}
+
+# Redis used by the Redis intents of generator handlers, see server.drivers
+SERVER_IO_REDIS_URL = "redis://127.0.0.1:6379/2"
+
+# Servers written per transaction by the bulk registration endpoint
+SERVER_BULK_CREATE_CHUNK_SIZE = 1000
+
+# Incremental StatsVendor counters, see server.stats
+STATS_AGGREGATION = {
+    # "memory": events queued in each process, "redis": one list shared by all processes
+    "queue": "redis",
+    "redis_url": "redis://127.0.0.1:6379/2",
+    "queue_key": f"{MAIN_MODULE_NAME}:stats_vendor_events",
+    # seconds between two flushes, and events applied per transaction
+    "flush_interval": 1,
+    "batch_size": 10000,
+    # seconds after which the batch claimed by a flusher that died is queued again
+    "claim_timeout": 300,
+    # failures in a row after which a batch goes to the dead letters of the queue, except
+    # for concurrent flushes, lost locks and database outages which are retried forever
+    "max_attempts": 3,
+    # lock the vendors of a batch under SERVICE_LOCK_ROOT while it is applied, flushes of
+    # several aggregators on the same vendors wait for each other instead of MySQL, every
+    # flush then depends on etcd
+    "locks": False,
+    "lock_timeout": 30,
+    # how long idempotency keys are kept to reject replayed events
+    "key_retention_seconds": 7 * 86400,
+}
+
+# Rows of StatsVendor read by /stats/vendors/summary, the summary of a larger table is
+# marked truncated, see server.analytics
+STATS_SUMMARY_MAX_ROWS = 1000000
+
+# Append a recording of every dispatched message to this file, replay them offline with
+# python manage.py replay check|bench <filename>. None disables recording.
+SERVER_RECORD_FILENAME = None
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/#redis
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://127.0.0.1:6379/3",
+    },
+}
+
+# Two tier model cache, see core.cache.ModelCache
+MODEL_CACHE = {
+    "cache": "default",
+    # seconds an instance stays in Redis
+    "timeout": 300,
+    # instances kept in each process, and for how many seconds
+    "local_maxsize": 10000,
+    "local_ttl": 60,
+    # Redis pub/sub channel fanning out invalidations to all processes, None to disable
+    "invalidation_channel": f"{MAIN_MODULE_NAME}:model_cache",
+    "invalidation_redis_url": "redis://127.0.0.1:6379/3",
+}
+
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
@@ -437,6 +588,19 @@ raw_paste_global_conf = []
 
 # Strip spaces present between the header name and the the :.
 strip_header_spaces = False
+
+
+# Every worker registers under SERVICE_ROOT, see core.registry
+def post_fork(server, worker):
+    from core.registry import register_worker
+
+    register_worker("http", server.cfg.bind[0] if server.cfg.bind else None)
+
+
+def worker_exit(server, worker):
+    from core.registry import deregister_worker
+
+    deregister_worker()
 """
 GUNICORN_CONFIG_FILENAME = os.path.join(
     BASE_DIR, "run", f"gunicorn_{MAIN_MODULE_NAME}.py"
@@ -585,8 +749,11 @@ CIRCUS_WATCHERS = [
         "name": f"gunicorn",
         "settings": {
             "cmd": "python manage.py gunicorn start",
-            "stop_signal": "INT",
-            "singleton": "True",
+            # graceful, in-flight requests finish within the graceful_timeout of gunicorn
+            "stop_signal": "TERM",
+            "graceful_timeout": "35",
+            # `deploy rollout` runs a second gunicorn next to it, both bind with reuse_port
+            "singleton": "False",
             "autostart": "True",
             "use_sockets": "False",
         },
@@ -605,6 +772,28 @@ CIRCUS_WATCHERS = [
     },
 ]
 
+# Websocket connection counts of the daphne workers, read them with
+# `python manage.py circusd connections`, see access.plugins. Only when the workers
+# report them (ACCESS_ADMISSION["report_to"]).
+CIRCUS_PLUGINS = []
+if ACCESS_ADMISSION["report_to"]:
+    report_ip, _, report_port = ACCESS_ADMISSION["report_to"].rpartition(":")
+    CIRCUS_PLUGINS.append(
+        {
+            "name": "connection_counts",
+            "settings": {
+                "use": "access.plugins.ConnectionCounts",
+                "ip": report_ip,
+                "port": report_port,
+                "stats_file": os.path.join(
+                    BASE_DIR, "run", f"connections.{MAIN_MODULE_NAME}.json"
+                ),
+                "loop_rate": "1",
+                "max_age": "10",
+            },
+        }
+    )
+
 for CIRCUS_SOCKET in CIRCUS_SOCKETS:
     name = CIRCUS_SOCKET["name"]
     settings = CIRCUS_SOCKET["settings"]
@@ -637,6 +826,16 @@ for CIRCUS_WATCHER in CIRCUS_WATCHERS:
         setting_value = setting_value.format(**render_context)
         CIRCUSD_CONFIG.set(section_name, setting_key, setting_value)
 
+for CIRCUS_PLUGIN in CIRCUS_PLUGINS:
+    name = CIRCUS_PLUGIN["name"]
+    settings = CIRCUS_PLUGIN["settings"]
+    section_name = f"plugin:{name}"
+
+    CIRCUSD_CONFIG.add_section(section_name)
+    for setting_key in settings:
+        setting_value = settings[setting_key]
+        CIRCUSD_CONFIG.set(section_name, setting_key, setting_value)
+
 
 ETCD_KWARGS = {
     "host": "localhost",
@@ -646,9 +845,25 @@ ETCD_KWARGS = {
 # Where to register all types of services
 SERVICE_ROOT = f"/{MAIN_MODULE_NAME}/services/"
 
+# The host other hosts reach the listeners of this one at, registered in place of the
+# wildcard and loopback addresses they bind, the hostname when None
+SERVICE_ADVERTISE_HOST = None
+
 # Distributed locks used in this project
 SERVICE_LOCK_ROOT = f"/{MAIN_MODULE_NAME}/locks/"
 
+# Locks taken per etcd transaction, at most the --max-txn-ops of etcd, see core.locks
+SERVICE_LOCK_BATCH_SIZE = 128
+
+# python manage.py deploy rollout, replaces the processes of the circus watchers one by one
+DEPLOY_ROLLOUT = {
+    # the watchers rolled, in this order, all of CIRCUS_WATCHERS when empty
+    "watchers": [],
+    # seconds a new process gets to register under SERVICE_ROOT
+    "ready_timeout": 60,
+    "poll_interval": 0.5,
+}
+
 # How many seconds a service's lease
 SERVICE_LEASE_DEFAULT_SECONDS = 20
 
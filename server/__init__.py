@@ -26,4 +26,7 @@ from the caller. The caller get chances to affect the inner-state of generator.
 We can use the generator to implement I/O-driven framework, which the real I/O happens at the framework level and the
 generator will just send I/O context information to the caller and the caller will do the real I/O
 and send the I/O result to the generator to push the generator to the next step.
+
+The I/O intents a generator can yield live in `server.intents`, the synchronous and asynchronous
+drivers doing the real I/O live in `server.drivers`.
 """
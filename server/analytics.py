@@ -0,0 +1,144 @@
+"""
+Vectorized StatsVendor analytics
+
+Rows are streamed out of the database with one `values_list(*fields)` query straight into
+a 2D NumPy array, chunk by chunk, no model instance is ever built. The array is split into
+one column per field, so the columns line up row by row whatever the isolation level, all
+aggregations then run vectorized over the columns.
+
+At most settings.STATS_SUMMARY_MAX_ROWS rows are read, with a LIMIT, the summary of a
+larger table covers the rows of the lowest primary keys and says it is truncated.
+"""
+from itertools import islice
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from django.conf import settings
+
+from server.models import StatsVendor
+
+STATS_COLUMNS = {
+    'vendor_id': np.float64,
+    'total_earned': np.float64,
+    'project_count': np.float64,
+    'project_not_complete_count': np.float64,
+    'ongoing_tickets': np.float64,
+}
+
+PERCENTILES = (50, 90, 99)
+
+
+def load_columns(
+    queryset,
+    fields: Iterable[str],
+    chunk_size: int = 20000,
+    limit: Optional[int] = None,
+) -> Dict[str, np.ndarray]:
+    """NULL becomes NaN, the first `limit` rows by primary key only"""
+    fields = list(fields)
+    queryset = queryset.order_by('pk')
+    if limit is not None:
+        queryset = queryset[:limit]
+    rows = queryset.values_list(*fields).iterator(chunk_size=chunk_size)
+    # grown as the rows come, no count() query to size it
+    table = np.empty((chunk_size, len(fields)), dtype=np.float64)
+    size = 0
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        if size + len(chunk) > len(table):
+            table = np.resize(
+                table, (max(2 * len(table), size + len(chunk)), len(fields))
+            )
+        table[size : size + len(chunk)] = np.array(chunk, dtype=np.float64)
+        size += len(chunk)
+    return {
+        field: table[:size, index].astype(STATS_COLUMNS[field], copy=False)
+        for index, field in enumerate(fields)
+    }
+
+
+def summarize_column(column: np.ndarray) -> dict:
+    present = column[~np.isnan(column)]
+    if not present.size:
+        return {'count': 0, 'sum': 0.0, 'mean': None, 'min': None, 'max': None}
+    summary = {
+        'count': int(present.size),
+        'sum': float(present.sum()),
+        'mean': float(present.mean()),
+        'min': float(present.min()),
+        'max': float(present.max()),
+    }
+    for percentile, value in zip(PERCENTILES, np.percentile(present, PERCENTILES)):
+        summary[f'p{percentile}'] = float(value)
+    return summary
+
+
+def histogram(column: np.ndarray, bins: int) -> dict:
+    present = column[~np.isnan(column)]
+    if not present.size:
+        return {'counts': [], 'edges': []}
+    counts, edges = np.histogram(present, bins=bins)
+    return {'counts': counts.tolist(), 'edges': edges.tolist()}
+
+
+def group_by_vendor(columns: Dict[str, np.ndarray], fields: List[str]) -> dict:
+    """Sum the fields per vendor_id, rows without a vendor are left out"""
+    vendor_ids = columns['vendor_id']
+    mask = ~np.isnan(vendor_ids)
+    vendors, inverse = np.unique(vendor_ids[mask], return_inverse=True)
+    grouped = {'vendor_id': vendors}
+    for field in fields:
+        weights = np.nan_to_num(columns[field][mask])
+        grouped[field] = np.bincount(inverse, weights=weights, minlength=vendors.size)
+    return grouped
+
+
+def top_k(grouped: dict, field: str, k: int) -> List[dict]:
+    values = grouped[field]
+    k = min(k, values.size)
+    if not k:
+        return []
+    # O(n) selection, only the k winners get sorted
+    candidates = np.argpartition(-values, k - 1)[:k]
+    winners = candidates[np.argsort(-values[candidates], kind='stable')]
+    return [
+        {'vendor_id': int(grouped['vendor_id'][i]), field: float(values[i])}
+        for i in winners
+    ]
+
+
+def vendors_summary(
+    top: int = 10, bins: int = 10, queryset=None, max_rows: Optional[int] = None
+) -> dict:
+    if queryset is None:
+        queryset = StatsVendor.objects.all()
+    if max_rows is None:
+        max_rows = getattr(settings, 'STATS_SUMMARY_MAX_ROWS', 1000000)
+    fields = [field for field in STATS_COLUMNS if field != 'vendor_id']
+    # one row more tells a truncated table apart
+    columns = load_columns(queryset, STATS_COLUMNS, limit=max_rows + 1)
+    truncated = columns['vendor_id'].size > max_rows
+    if truncated:
+        columns = {field: column[:max_rows] for field, column in columns.items()}
+    grouped = group_by_vendor(columns, fields)
+
+    tickets = grouped['ongoing_tickets']
+    projects = grouped['project_count']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        not_complete_ratio = np.where(
+            projects > 0, grouped['project_not_complete_count'] / projects, np.nan
+        )
+
+    return {
+        'rows': int(columns['vendor_id'].size),
+        'truncated': truncated,
+        'vendors': int(grouped['vendor_id'].size),
+        'columns': {field: summarize_column(columns[field]) for field in fields},
+        'total_earned_histogram': histogram(columns['total_earned'], bins),
+        'top_earners': top_k(grouped, 'total_earned', top),
+        'top_ongoing_tickets': top_k(grouped, 'ongoing_tickets', top),
+        'vendors_with_tickets': int(np.count_nonzero(tickets)),
+        'not_complete_ratio': summarize_column(not_complete_ratio),
+    }
@@ -11,6 +11,8 @@ class ServerConfig(AppConfig):
     name = 'server'
 
     def ready(self):
+        # connect the invalidation signals of the model caches
+        from server import caches  # noqa: F401
         from server import servers
 
         servers_module = inspect.getmodule(servers)
@@ -22,3 +24,7 @@ class ServerConfig(AppConfig):
             full_path = os.path.join(servers_path, item)
             if os.path.isdir(full_path) and not item.startswith('__'):
                 importlib.import_module(f'.{item}', servers_module.__name__)
+
+        from server.registry import registry
+
+        logging.info('registered message types: %s', registry.message_types())
@@ -0,0 +1,96 @@
+"""
+Bulk registration of servers
+
+Servers are unique on (name, ip). `upsert_servers` writes them chunk by chunk, each chunk
+in its own transaction with one SELECT for the rows already there, one bulk INSERT for the
+new ones and one UPDATE touching the existing ones.
+
+Django 4.0 has no `bulk_create(update_conflicts=True)`, so the upsert is done by hand. The
+SELECT locks nothing, the unique constraint on (name, ip) is what keeps two requests from
+inserting the same server: when a concurrent request inserts one of them between the
+SELECT and the INSERT, the transaction of the chunk is rolled back and run again, so
+`created` only counts the rows this call inserted. A deadlock with a concurrent chunk
+(MySQL error 1213) is retried the same way. Each attempt is a transaction of its own and
+reads the latest committed rows under MySQL's REPEATABLE READ, call it outside of one.
+"""
+from typing import Dict, Iterable, List, Tuple
+
+import attr
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, transaction
+from django.utils import timezone
+
+from core.cache import invalidate_rows
+from server.models import Server
+
+# ER_LOCK_DEADLOCK, MySQL rolled the whole transaction back
+DEADLOCK = 1213
+
+
+@attr.s(slots=True)
+class UpsertResult:
+    created = attr.ib(type=int, default=0)
+    updated = attr.ib(type=int, default=0)
+
+
+def chunked(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def upsert_servers(
+    records: Iterable[Tuple[str, str]], chunk_size: int = None, retries: int = 3
+):
+    """records: (name, ip) pairs, duplicates are merged"""
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'SERVER_BULK_CREATE_CHUNK_SIZE', 1000)
+
+    result = UpsertResult()
+    # the same order in every request, concurrent chunks lock rows in the same order
+    keys = sorted(dict.fromkeys(records))
+    for chunk in chunked(keys, chunk_size):
+        for attempt in range(retries + 1):
+            try:
+                created, updated = upsert_chunk(chunk)
+                break
+            except IntegrityError:
+                # inserted by a concurrent request since the SELECT
+                if attempt == retries:
+                    raise
+            except OperationalError as e:
+                if not e.args or e.args[0] != DEADLOCK or attempt == retries:
+                    raise
+        result.created += created
+        result.updated += updated
+    return result
+
+
+def upsert_chunk(chunk: List[Tuple[str, str]]) -> Tuple[int, int]:
+    """(created, updated) in one transaction"""
+    with transaction.atomic():
+        existing = existing_servers(chunk)
+        Server.objects.bulk_create(
+            [
+                Server(name=name, ip=ip)
+                for name, ip in chunk
+                if (name, ip) not in existing
+            ]
+        )
+        if existing:
+            Server.objects.filter(pk__in=existing.values()).update(
+                date_change=timezone.now()
+            )
+            # update() sends no post_save
+            invalidate_rows(Server, existing.values())
+    return len(chunk) - len(existing), len(existing)
+
+
+def existing_servers(chunk: List[Tuple[str, str]]) -> Dict[Tuple[str, str], int]:
+    """{(name, ip): pk} of the servers of the chunk already there"""
+    wanted = set(chunk)
+    # a superset of the wanted pairs, cheaper than OR-ing one condition per pair. Not
+    # locked, the UPDATE locks the rows it writes, by primary key only
+    candidates = Server.objects.filter(
+        name__in={name for name, _ in chunk}, ip__in={ip for _, ip in chunk}
+    ).values_list('pk', 'name', 'ip')
+    return {(name, ip): pk for pk, name, ip in candidates if (name, ip) in wanted}
@@ -0,0 +1,7 @@
+"""Hot model lookups, cached in process and in Redis (see core.cache)"""
+from core.cache import ModelCache
+from server.models import GoodTable, Server
+
+good_table_cache = ModelCache(GoodTable, lookups=('name',))
+
+server_cache = ModelCache(Server)
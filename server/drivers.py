@@ -0,0 +1,276 @@
+"""
+Drivers run generator handlers, they are the only place where real I/O happens.
+
+The same handler runs in a gunicorn/uWSGI worker:
+
+    result = SyncDriver().run(get_good, 'name1')
+
+and in a daphne/uvicorn worker:
+
+    result = await AsyncDriver().run(get_good, 'name1')
+
+When a handler yields a list of intents, `SyncDriver` performs them one by one while
+`AsyncDriver` gathers them. DB intents always go through asgiref's thread-sensitive
+executor because Django connections are bound to threads, so they keep their order there,
+Redis and HTTP intents really overlap.
+
+A `Batch` is first merged into as few round trips as possible (see `server.intents.Batch`),
+then performed like a list. `Get` and `GetMany` are served from the request's identity map
+when there is one (see `server.identity`).
+
+An exception raised while performing an intent is thrown into the handler at its yield
+point, so handlers use plain try/except around I/O.
+"""
+import asyncio
+import inspect
+import urllib.error
+import urllib.request
+from typing import Callable, Dict, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import QuerySet
+
+from server.identity import current as current_identity_map
+from server.intents import (
+    Batch,
+    BulkInsert,
+    Call,
+    Get,
+    GetMany,
+    Http,
+    HttpResult,
+    Insert,
+    Intent,
+    Query,
+    Redis,
+    Save,
+)
+
+
+def perform_query(intent: Query):
+    manager = intent.model._default_manager
+    result = getattr(manager, intent.method)(*intent.args, **intent.kwargs)
+    if isinstance(result, QuerySet):
+        result = list(result)
+    return result
+
+
+def perform_get(intent: Get):
+    identity_map = current_identity_map()
+    if identity_map is not None:
+        return identity_map.get_or_none(intent.model, intent.pk)
+    return intent.model._default_manager.filter(pk=intent.pk).first()
+
+
+def perform_get_many(intent: GetMany):
+    identity_map = current_identity_map()
+    if identity_map is not None:
+        return identity_map.get_many(intent.model, intent.pks)
+    return intent.model._default_manager.in_bulk(intent.pks)
+
+
+def perform_insert(intent: Insert):
+    intent.instance.save(force_insert=True)
+    return intent.instance
+
+
+def perform_bulk_insert(intent: BulkInsert):
+    return intent.model._default_manager.bulk_create(
+        intent.instances, batch_size=intent.batch_size
+    )
+
+
+def perform_save(intent: Save):
+    intent.instance.save(update_fields=intent.update_fields)
+    return intent.instance
+
+
+def perform_call(intent: Call):
+    return intent.func(*intent.args, **intent.kwargs)
+
+
+def perform_http(intent: Http) -> HttpResult:
+    request = urllib.request.Request(
+        intent.url, data=intent.body, headers=intent.headers, method=intent.method
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=intent.timeout) as response:
+            return HttpResult(
+                status=response.status,
+                headers=dict(response.headers),
+                body=response.read(),
+            )
+    except urllib.error.HTTPError as e:
+        # 4xx/5xx are results, not I/O failures
+        return HttpResult(status=e.code, headers=dict(e.headers), body=e.read())
+
+
+class Driver:
+    def __init__(self, performers: Optional[Dict[type, Callable]] = None):
+        self.performers = self.default_performers()
+        if performers:
+            self.performers.update(performers)
+        self._resolved = {}
+
+    def default_performers(self) -> Dict[type, Callable]:
+        raise NotImplementedError
+
+    def get_performer(self, intent: Intent) -> Callable:
+        intent_type = type(intent)
+        try:
+            return self._resolved[intent_type]
+        except KeyError:
+            pass
+
+        for klass in intent_type.__mro__:
+            performer = self.performers.get(klass)
+            if performer is not None:
+                performer = self._resolved[intent_type] = self.wrap_performer(performer)
+                return performer
+        raise TypeError(f'{self.__class__.__name__} cannot perform {intent!r}')
+
+    def wrap_performer(self, performer: Callable) -> Callable:
+        return performer
+
+    @staticmethod
+    def start(handler, *args, **kwargs):
+        """Return a generator from a generator function (or an already started one)"""
+        if inspect.isgenerator(handler):
+            return handler
+        return handler(*args, **kwargs)
+
+    @staticmethod
+    def redis_url():
+        return getattr(settings, 'SERVER_IO_REDIS_URL', 'redis://127.0.0.1:6379/0')
+
+
+class SyncDriver(Driver):
+    def __init__(self, performers=None):
+        self._redis = None
+        super().__init__(performers)
+
+    def default_performers(self):
+        return {
+            Query: perform_query,
+            Get: perform_get,
+            GetMany: perform_get_many,
+            Insert: perform_insert,
+            BulkInsert: perform_bulk_insert,
+            Save: perform_save,
+            Call: perform_call,
+            Redis: self.perform_redis,
+            Http: perform_http,
+            Batch: self.perform_batch,
+        }
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            import redis
+
+            self._redis = redis.Redis.from_url(self.redis_url())
+        return self._redis
+
+    def perform_redis(self, intent: Redis):
+        return self.redis.execute_command(intent.command, *intent.args)
+
+    def perform_batch(self, intent: Batch):
+        merged, scatter = intent.plan()
+        return scatter(self.perform(merged))
+
+    def perform(self, intent):
+        if isinstance(intent, (list, tuple)):
+            return [self.perform(item) for item in intent]
+        return self.get_performer(intent)(intent)
+
+    def run(self, handler, *args, **kwargs):
+        gen = self.start(handler, *args, **kwargs)
+        if not inspect.isgenerator(gen):
+            # a plain function, nothing to drive
+            return gen
+
+        value, error = None, None
+        while True:
+            try:
+                if error is None:
+                    intent = gen.send(value)
+                else:
+                    intent = gen.throw(error)
+            except StopIteration as e:
+                return e.value
+
+            try:
+                value, error = self.perform(intent), None
+            except Exception as e:
+                value, error = None, e
+
+
+class AsyncDriver(Driver):
+    def __init__(self, performers=None):
+        self._redis = None
+        super().__init__(performers)
+
+    def default_performers(self):
+        return {
+            Query: perform_query,
+            Get: perform_get,
+            GetMany: perform_get_many,
+            Insert: perform_insert,
+            BulkInsert: perform_bulk_insert,
+            Save: perform_save,
+            Call: perform_call,
+            Redis: self.perform_redis,
+            Http: self.perform_http,
+            Batch: self.perform_batch,
+        }
+
+    def wrap_performer(self, performer):
+        if asyncio.iscoroutinefunction(performer):
+            return performer
+        # Django ORM is not async safe, blocking performers run where the ORM expects them
+        return sync_to_async(performer, thread_sensitive=True)
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            import redis.asyncio
+
+            self._redis = redis.asyncio.Redis.from_url(self.redis_url())
+        return self._redis
+
+    async def perform_redis(self, intent: Redis):
+        return await self.redis.execute_command(intent.command, *intent.args)
+
+    @staticmethod
+    async def perform_http(intent: Http):
+        return await asyncio.to_thread(perform_http, intent)
+
+    async def perform_batch(self, intent: Batch):
+        merged, scatter = intent.plan()
+        return scatter(await self.perform(merged))
+
+    async def perform(self, intent):
+        if isinstance(intent, (list, tuple)):
+            return list(await asyncio.gather(*[self.perform(item) for item in intent]))
+        return await self.get_performer(intent)(intent)
+
+    async def run(self, handler, *args, **kwargs):
+        gen = self.start(handler, *args, **kwargs)
+        if not inspect.isgenerator(gen):
+            return gen
+
+        value, error = None, None
+        while True:
+            try:
+                if error is None:
+                    intent = gen.send(value)
+                else:
+                    intent = gen.throw(error)
+            except StopIteration as e:
+                return e.value
+
+            try:
+                value, error = await self.perform(intent), None
+            except Exception as e:
+                value, error = None, e
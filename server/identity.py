@@ -0,0 +1,181 @@
+"""
+Request scoped identity map and unit of work
+
+Inside a request (see `core.middleware.identity_map_middleware`) every row is loaded at most
+once, asking for it again returns the very same instance:
+
+    identity_map = current()
+    good = identity_map.get(GoodTable, 1)
+    good is identity_map.get(GoodTable, 1)  # True, no query
+    identity_map.related(good, 'bad_tables')  # one query, then served from memory
+
+    good.content = 'changed'
+    identity_map.mark_dirty(good, 'content')
+    # flushed with one bulk_update per model when the request ends
+
+The map lives in a context variable, so it follows the request through asgiref's
+sync_to_async/async_to_sync and the `Get`/`GetMany` intents of the drivers use it too.
+"""
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional
+
+from django.db import models, transaction
+
+from core.cache import invalidate_rows
+
+_current_identity_map = contextvars.ContextVar('identity_map', default=None)
+
+
+class IdentityMap:
+    def __init__(self, using: Optional[str] = None):
+        self.using = using
+        self.objects: Dict[tuple, models.Model] = {}
+        self.relations: Dict[tuple, list] = {}
+        # (model, pk) -> (instance, fields to write, None means all)
+        self.dirty: Dict[tuple, tuple] = {}
+
+    @staticmethod
+    def key(model, pk):
+        return model._meta.concrete_model, model._meta.pk.to_python(pk)
+
+    def manager(self, model):
+        manager = model._default_manager
+        return manager.using(self.using) if self.using else manager
+
+    def add(self, instance: models.Model) -> models.Model:
+        """Register a loaded instance, return the one already in the map if any"""
+        return self.objects.setdefault(self.key(type(instance), instance.pk), instance)
+
+    def get(self, model, pk) -> models.Model:
+        key = self.key(model, pk)
+        try:
+            return self.objects[key]
+        except KeyError:
+            pass
+        instance = self.manager(model).get(pk=pk)
+        self.objects[key] = instance
+        return instance
+
+    def get_or_none(self, model, pk) -> Optional[models.Model]:
+        try:
+            return self.get(model, pk)
+        except model.DoesNotExist:
+            return None
+
+    def get_many(self, model, pks: Iterable) -> dict:
+        """Same as `QuerySet.in_bulk`, only the missing rows are queried"""
+        found = {}
+        missing = []
+        for pk in pks:
+            key = self.key(model, pk)
+            instance = self.objects.get(key)
+            if instance is None:
+                missing.append(key[1])
+            else:
+                found[key[1]] = instance
+        if missing:
+            for pk, instance in self.manager(model).in_bulk(missing).items():
+                found[pk] = self.add(instance)
+        return found
+
+    def related(self, instance: models.Model, name: str):
+        """
+        Follow a relation by its accessor name, forward relations return an instance,
+        reverse and many to many ones (like `good_table.bad_tables`) a list.
+        """
+        field = instance._meta.get_field(name)
+        if not field.is_relation or field.related_model is None:
+            raise ValueError(
+                f'{name} is not a relation {self.__class__.__name__} follows'
+            )
+        if field.many_to_one or (field.one_to_one and field.concrete):
+            pk = getattr(instance, field.attname)
+            if pk is None:
+                return None
+            return self.get(field.related_model, pk)
+
+        key = (*self.key(type(instance), instance.pk), name)
+        try:
+            return self.relations[key]
+        except KeyError:
+            pass
+
+        if field.many_to_many and field.concrete:
+            # forward, through the join table, whatever the reverse name is
+            queryset = getattr(instance, field.name).all()
+            if self.using:
+                queryset = queryset.using(self.using)
+        else:
+            queryset = self.manager(field.related_model).filter(
+                **{field.remote_field.name: instance.pk}
+            )
+        related = [self.add(item) for item in queryset]
+        if field.one_to_one:
+            related = related[0] if related else None
+        self.relations[key] = related
+        return related
+
+    def mark_dirty(self, instance: models.Model, *fields: str):
+        """Write the instance when the map is flushed, all fields if none given"""
+        key = self.key(type(instance), instance.pk)
+        self.objects.setdefault(key, instance)
+        _, dirty_fields = self.dirty.get(key, (instance, set()))
+        if not fields or dirty_fields is None:
+            dirty_fields = None
+        else:
+            dirty_fields = dirty_fields | set(fields)
+        self.dirty[key] = (instance, dirty_fields)
+
+    def flush(self):
+        """One bulk_update per model and set of dirty fields, in one transaction"""
+        if not self.dirty:
+            return
+
+        batches = defaultdict(list)
+        for (model, _), (instance, fields) in self.dirty.items():
+            if fields is None:
+                fields = [
+                    field.name
+                    for field in model._meta.concrete_fields
+                    if not field.primary_key
+                ]
+            batches[(model, tuple(sorted(fields)))].append(instance)
+
+        with transaction.atomic(using=self.using):
+            for (model, fields), instances in batches.items():
+                self.manager(model).bulk_update(instances, fields)
+                invalidate_rows(
+                    model, [instance.pk for instance in instances], using=self.using
+                )
+        self.dirty.clear()
+
+    def clear(self):
+        self.objects.clear()
+        self.relations.clear()
+        self.dirty.clear()
+
+
+def current() -> Optional[IdentityMap]:
+    return _current_identity_map.get()
+
+
+def activate(identity_map: IdentityMap) -> contextvars.Token:
+    return _current_identity_map.set(identity_map)
+
+
+def deactivate(token: contextvars.Token):
+    _current_identity_map.reset(token)
+
+
+@contextmanager
+def identity_map_scope(using: Optional[str] = None):
+    """Activate a new identity map, flush it when the block exits without error"""
+    identity_map = IdentityMap(using=using)
+    token = activate(identity_map)
+    try:
+        yield identity_map
+        identity_map.flush()
+    finally:
+        deactivate(token)
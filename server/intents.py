@@ -0,0 +1,213 @@
+"""
+I/O intents
+
+An intent is a plain description of one I/O operation, a handler yields it and the driver
+(see `server.drivers`) performs the real I/O and sends the result back into the handler.
+
+    def get_good(name):
+        good = yield Query(GoodTable, 'get', kwargs={'name': name})
+        hits, response = yield [
+            Redis('INCR', f'good:{good.pk}:hits'),
+            Http('GET', f'https://example.com/goods/{good.pk}'),
+        ]
+        return {'name': good.name, 'hits': hits, 'status': response.status}
+
+Yielding a list (or tuple) of intents means "these are independent of each other", the
+driver may perform them concurrently and sends back a list of results in the same order.
+"""
+import attr
+from django.db import connections, router
+
+
+class Intent:
+    """Base class of everything a handler can yield"""
+
+    __slots__ = ()
+
+
+@attr.s(slots=True)
+class Query(Intent):
+    """
+    Call a method of the model's default manager, a lazy QuerySet result is evaluated
+    into a list so that no I/O escapes the driver.
+
+    Query(Server, 'filter', kwargs={'name': 's1'})
+    """
+
+    model = attr.ib()
+    method = attr.ib(type=str, default='get')
+    args = attr.ib(type=tuple, default=(), converter=tuple)
+    kwargs = attr.ib(type=dict, factory=dict)
+
+
+@attr.s(slots=True)
+class Save(Intent):
+    """Save a model instance"""
+
+    instance = attr.ib()
+    update_fields = attr.ib(default=None)
+
+
+@attr.s(slots=True)
+class Call(Intent):
+    """Call a blocking function, for DB work that does not fit Query/Save"""
+
+    func = attr.ib()
+    args = attr.ib(type=tuple, default=(), converter=tuple)
+    kwargs = attr.ib(type=dict, factory=dict)
+
+
+@attr.s(slots=True, init=False)
+class Redis(Intent):
+    """
+    Execute one Redis command
+
+    Redis('SET', 'key', 'value', 'EX', 60)
+    """
+
+    command = attr.ib(type=str)
+    args = attr.ib(type=tuple)
+
+    def __init__(self, command, *args):
+        self.command = command.upper()
+        self.args = args
+
+
+@attr.s(slots=True)
+class Http(Intent):
+    """Send an HTTP request, the result is a `HttpResult`"""
+
+    method = attr.ib(type=str)
+    url = attr.ib(type=str)
+    headers = attr.ib(type=dict, factory=dict)
+    body = attr.ib(type=bytes, default=None)
+    timeout = attr.ib(type=float, default=10)
+
+
+@attr.s(slots=True, frozen=True)
+class HttpResult:
+    status = attr.ib(type=int)
+    headers = attr.ib(type=dict)
+    body = attr.ib(type=bytes)
+
+
+@attr.s(slots=True)
+class Get(Intent):
+    """Primary key lookup, the result is None when the row does not exist"""
+
+    model = attr.ib()
+    pk = attr.ib()
+
+
+@attr.s(slots=True)
+class GetMany(Intent):
+    """Primary key lookups in one `IN (...)` query, the result is a {pk: instance} dict"""
+
+    model = attr.ib()
+    pks = attr.ib(type=tuple, converter=tuple)
+
+
+@attr.s(slots=True)
+class Insert(Intent):
+    """Insert a model instance"""
+
+    instance = attr.ib()
+
+
+@attr.s(slots=True)
+class BulkInsert(Intent):
+    """Insert instances of the same model with `bulk_create`"""
+
+    model = attr.ib()
+    instances = attr.ib(type=list, converter=list)
+    batch_size = attr.ib(type=int, default=None)
+
+
+def bulk_insert_sets_pks(model) -> bool:
+    connection = connections[router.db_for_write(model)]
+    return connection.features.can_return_rows_from_bulk_insert
+
+
+# the result of an intent performed as is, not picked out of a merged one
+_UNMERGED = object()
+
+
+@attr.s(slots=True, init=False)
+class Batch(Intent):
+    """
+    Many intents in one yield, the driver merges what can be merged into one round trip:
+
+    - Get of the same model -> one GetMany (SELECT ... WHERE id IN (...))
+    - Insert of the same model -> one BulkInsert (bulk_create), on databases where it sets
+      the primary keys of the instances (not MySQL), elsewhere they stay one INSERT each
+    - Redis GET -> one Redis MGET
+
+    anything else is performed as if it was yielded in a list. The result is a list in the
+    same order as the intents.
+
+        accounts = yield Batch(Get(User, pk) for pk in pks)
+    """
+
+    intents = attr.ib(type=tuple)
+
+    def __init__(self, intents):
+        self.intents = tuple(intents)
+
+    def plan(self):
+        """
+        Return the merged intents and a function mapping their results (in the same order)
+        back to the results of the original intents.
+        """
+        merged = []
+        groups = {}
+        # for every intent: (index in merged, how to pick its result)
+        picks = []
+
+        for intent in self.intents:
+            if isinstance(intent, Get):
+                key = (Get, intent.model)
+                item = intent.model._meta.pk.to_python(intent.pk)
+            elif isinstance(intent, Insert) and bulk_insert_sets_pks(
+                type(intent.instance)
+            ):
+                key = (Insert, type(intent.instance))
+                item = intent.instance
+            elif isinstance(intent, Redis) and intent.command == 'GET':
+                key = (Redis, 'GET')
+                item = intent.args[0]
+            else:
+                picks.append((len(merged), _UNMERGED))
+                merged.append(intent)
+                continue
+
+            if key not in groups:
+                groups[key] = len(merged)
+                merged.append([])
+            position = groups[key]
+            items = merged[position]
+            # GetMany answers with a {pk: instance} dict, the others with a list
+            picks.append((position, item if key[0] is Get else len(items)))
+            items.append(item)
+
+        for (kind, target), position in groups.items():
+            items = merged[position]
+            if kind is Get:
+                merged[position] = GetMany(target, dict.fromkeys(items))
+            elif kind is Insert:
+                merged[position] = BulkInsert(target, items)
+            else:
+                merged[position] = Redis('MGET', *items)
+
+        def scatter(results):
+            scattered = []
+            for position, pick in picks:
+                result = results[position]
+                if pick is _UNMERGED:
+                    scattered.append(result)
+                elif isinstance(result, dict):
+                    scattered.append(result.get(pick))
+                else:
+                    scattered.append(result[pick])
+            return scattered
+
+        return merged, scatter
@@ -0,0 +1,27 @@
+# Generated by Django 4.0.5 on 2026-10-18 20:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0006_alter_statsvendor_ongoing_tickets_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='server',
+            index=models.Index(fields=['name', 'id'], name='server_name_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='server',
+            index=models.Index(fields=['ip', 'id'], name='server_ip_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='server',
+            index=models.Index(
+                fields=['date_added', 'id'], name='server_date_added_id_idx'
+            ),
+        ),
+    ]
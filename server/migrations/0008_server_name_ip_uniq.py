@@ -0,0 +1,43 @@
+# Generated by Django 4.0.5 on 2026-10-18 20:43
+
+import logging
+
+from django.db import migrations, models
+
+LOGGER = logging.getLogger('django')
+
+
+def delete_duplicate_servers(apps, schema_editor):
+    """Keep the first registered of the servers sharing a (name, ip), log the others"""
+    Server = apps.get_model('server', 'Server')
+    duplicates = (
+        Server.objects.values('name', 'ip')
+        .annotate(keep=models.Min('id'), count=models.Count('id'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        removed = Server.objects.filter(
+            name=duplicate['name'], ip=duplicate['ip']
+        ).exclude(id=duplicate['keep'])
+        for row in removed.values('id', 'name', 'ip', 'date_added', 'date_change'):
+            LOGGER.warning(
+                'deleting duplicate server %s, kept %s', row, duplicate['keep']
+            )
+        removed.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0007_server_search_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_servers, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='server',
+            constraint=models.UniqueConstraint(
+                fields=('name', 'ip'), name='server_name_ip_uniq'
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.5 on 2026-10-18 20:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0008_server_name_ip_uniq'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatsEventKey',
+            fields=[
+                (
+                    'id',
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('date_added', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
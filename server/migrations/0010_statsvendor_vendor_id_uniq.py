@@ -0,0 +1,48 @@
+# Generated by Django 4.0.5 on 2026-10-18 21:55
+
+from django.db import migrations, models
+
+COUNTERS = (
+    'total_earned',
+    'project_count',
+    'project_not_complete_count',
+    'ongoing_tickets',
+)
+
+
+def merge_duplicate_vendors(apps, schema_editor):
+    """Fold the counters of the rows sharing a vendor_id into the first one"""
+    StatsVendor = apps.get_model('server', 'StatsVendor')
+    duplicates = (
+        StatsVendor.objects.exclude(vendor_id=None)
+        .values('vendor_id')
+        .annotate(count=models.Count('id'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        rows = list(
+            StatsVendor.objects.filter(vendor_id=duplicate['vendor_id']).order_by('id')
+        )
+        kept = rows[0]
+        for field in COUNTERS:
+            values = [getattr(row, field) for row in rows]
+            if any(value is not None for value in values):
+                setattr(kept, field, sum(value or 0 for value in values))
+        kept.save(update_fields=COUNTERS)
+        StatsVendor.objects.filter(pk__in=[row.pk for row in rows[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0009_statseventkey'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_vendors, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='statsvendor',
+            name='vendor_id',
+            field=models.IntegerField(null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-18 21:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0010_statsvendor_vendor_id_uniq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statsvendor',
+            name='fence',
+            field=models.BigIntegerField(default=0, null=True),
+        ),
+    ]
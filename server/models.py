@@ -35,13 +35,35 @@ class Server(models.Model):
     date_added = models.DateTimeField(auto_now_add=True)
     date_change = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # keyset pagination of /server/search_server seeks on (sort field, id)
+        indexes = [
+            models.Index(fields=['name', 'id'], name='server_name_id_idx'),
+            models.Index(fields=['ip', 'id'], name='server_ip_id_idx'),
+            models.Index(fields=['date_added', 'id'], name='server_date_added_id_idx'),
+        ]
+        constraints = [
+            # bulk registration upserts on (name, ip), see server.bulk
+            models.UniqueConstraint(fields=['name', 'ip'], name='server_name_ip_uniq'),
+        ]
+
 
 class StatsVendor(models.Model):
-    vendor_id = models.IntegerField(null=True, db_index=True)
+    # one row per vendor, server.stats folds events into it
+    vendor_id = models.IntegerField(null=True, unique=True)
     total_earned = models.FloatField(null=True)
     project_count = models.BigIntegerField(null=True, default=0)
     project_not_complete_count = models.BigIntegerField(null=True, default=0)
     ongoing_tickets = models.BigIntegerField(null=True, default=0)
+    # fencing token of the last locked flush, see server.stats
+    fence = models.BigIntegerField(null=True, default=0)
 
     def __str__(self):
         return f'StatsVendor(vendor_id={self.vendor_id})'
+
+
+class StatsEventKey(models.Model):
+    """Idempotency keys of the events folded into StatsVendor, see server.stats"""
+
+    key = models.CharField(max_length=64, unique=True)
+    date_added = models.DateTimeField(auto_now_add=True, db_index=True)
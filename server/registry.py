@@ -0,0 +1,143 @@
+"""
+Message handlers registry
+
+Every package in `server.servers` registers its generator handlers by message type:
+
+    @registry.handler('account.profile')
+    def profile(message: Message):
+        user = yield Get(User, message.data['user_id'])
+        ...
+
+`ServerConfig.ready` imports all those packages, after that a message type resolves to its
+handler with one dict lookup, no URL pattern is involved. The same handlers are reachable
+over HTTP (`server.views.ServerView`) and websocket (`access.consumers.AccessConsumer`),
+each side drives them with its own driver.
+"""
+import inspect
+import logging
+import sys
+from typing import Callable, Dict, Optional
+
+import attr
+from asgiref.sync import sync_to_async
+
+from server.replay import Recording, record
+
+LOGGER = logging.getLogger('django')
+
+
+class MessageTypeNotFound(LookupError):
+    pass
+
+
+class InvalidMessage(ValueError):
+    """Raised for a message that is not one, or not one its handler can serve"""
+
+
+class NotAllowed(PermissionError):
+    """Raised for a message its sender may not send"""
+
+
+@attr.s(slots=True)
+class Message:
+    type = attr.ib(type=str)
+    data = attr.ib(factory=dict)
+    user = attr.ib(default=None)
+
+
+def parse_message(body, user=None) -> Message:
+    """The Message of a decoded request body, InvalidMessage when it is not one"""
+    if not isinstance(body, dict) or not isinstance(body.get('type'), str):
+        raise InvalidMessage('a message is an object with a string type')
+    data = body.get('data') or {}
+    if not isinstance(data, dict):
+        raise InvalidMessage('the data of a message is an object')
+    return Message(type=body['type'], data=data, user=user)
+
+
+def require_user(message: Message, staff: bool = False):
+    """The user who sent the message, NotAllowed for the anonymous one or a non staff"""
+    user = message.user
+    if not getattr(user, 'is_authenticated', False):
+        raise NotAllowed(f'{message.type} needs a signed in user')
+    if staff and not getattr(user, 'is_staff', False):
+        raise NotAllowed(f'{message.type} is for staff only')
+    return user
+
+
+class Registry:
+    def __init__(self):
+        self.table: Dict[str, Callable] = {}
+
+    def register(self, message_type: str, handler: Callable):
+        if message_type in self.table:
+            raise ValueError(
+                f'message type {message_type} already handled by {self.table[message_type]}'
+            )
+        self.table[sys.intern(message_type)] = handler
+
+    def handler(self, message_type: str):
+        def decorator(f):
+            self.register(message_type, f)
+            return f
+
+        return decorator
+
+    def resolve(self, message_type: str) -> Callable:
+        try:
+            return self.table[message_type]
+        except (KeyError, TypeError):
+            raise MessageTypeNotFound(message_type) from None
+
+    def message_types(self):
+        return sorted(self.table)
+
+
+registry = Registry()
+
+
+class Dispatcher:
+    """
+    Run the handler of a message with a driver, with an `AsyncDriver` the result of
+    `dispatch` must be awaited.
+    """
+
+    def __init__(
+        self,
+        driver,
+        registry: Registry = registry,
+        recorder: Optional[Callable[[Recording], None]] = None,
+    ):
+        self.driver = driver
+        self.registry = registry
+        # receives a `server.replay.Recording` of every dispatched message
+        self.recorder = recorder
+
+    def dispatch(self, message: Message):
+        handler = self.registry.resolve(message.type)
+        if self.recorder is None:
+            return self.driver.run(handler, message)
+
+        recording = Recording.start(handler, message)
+        try:
+            result = self.driver.run(record(handler, recording, message))
+        except Exception:
+            self.save(recording)
+            raise
+        if inspect.isawaitable(result):
+            return self._save_when_done(result, recording)
+        self.save(recording)
+        return result
+
+    def save(self, recording: Recording):
+        try:
+            self.recorder(recording)
+        except Exception as e:
+            LOGGER.warning('recording of %s not saved', recording.handler, exc_info=e)
+
+    async def _save_when_done(self, result, recording: Recording):
+        try:
+            return await result
+        finally:
+            # file I/O, kept out of the event loop
+            await sync_to_async(self.save, thread_sensitive=False)(recording)
@@ -0,0 +1,221 @@
+"""
+Record and replay generator handlers
+
+A handler only talks to the outside world through the intents it yields, so recording every
+intent with the result sent back is enough to re-run it later without any real I/O:
+
+    recording = Recording.start(profile, message)
+    SyncDriver().run(record(profile, recording, message))
+
+    ReplayDriver(recording).run()  # no DB, no Redis, no HTTP
+
+`record` wraps the generator, not the driver, so it works with both drivers. Replaying
+measures the pure logic CPU cost of a handler, and replaying captures of production traffic
+(see `RecordingWriter` and `python manage.py replay`) measures regressions offline.
+
+Strict replays compare the `signature` of the intents, taken when they were yielded: the
+instances of an `Insert` or a `Save` get their pk from the driver afterwards, and model
+instances compare by pk.
+"""
+import inspect
+import pickle
+import threading
+import time
+from typing import Iterator, List, Optional
+
+import attr
+from django.conf import settings
+from django.db import models
+from django.utils.module_loading import import_string
+
+
+class ReplayDivergence(AssertionError):
+    """The handler yielded something else than what was recorded"""
+
+
+def signature(value):
+    """A comparable form of an intent, what it describes at the time it was yielded"""
+    if isinstance(value, models.Model):
+        return (
+            value._meta.label,
+            tuple(
+                (field.attname, signature(field.value_from_object(value)))
+                for field in value._meta.concrete_fields
+                # differs from one run to the next, `timezone.now` for instance
+                if not (field.has_default() and callable(field.default))
+            ),
+        )
+    if isinstance(value, type) and issubclass(value, models.Model):
+        return value._meta.label
+    if attr.has(type(value)):
+        return (
+            type(value).__qualname__,
+            tuple(signature(getattr(value, a.name)) for a in attr.fields(type(value))),
+        )
+    if isinstance(value, (list, tuple)):
+        return tuple(signature(item) for item in value)
+    if isinstance(value, dict):
+        return tuple((key, signature(item)) for key, item in value.items())
+    if callable(value):
+        return f'{value.__module__}.{value.__qualname__}'
+    return value
+
+
+@attr.s(slots=True)
+class Step:
+    intent = attr.ib()
+    result = attr.ib(default=None)
+    error = attr.ib(type=BaseException, default=None)
+    signature = attr.ib(default=None)
+
+
+@attr.s(slots=True)
+class Recording:
+    handler = attr.ib(type=str)
+    args = attr.ib(type=tuple, default=())
+    kwargs = attr.ib(type=dict, factory=dict)
+    steps = attr.ib(type=List[Step], factory=list)
+    result = attr.ib(default=None)
+    # what the handler raised instead of returning
+    error = attr.ib(type=BaseException, default=None)
+
+    @classmethod
+    def start(cls, handler, *args, **kwargs):
+        return cls(
+            handler=f'{handler.__module__}.{handler.__qualname__}',
+            args=args,
+            kwargs=kwargs,
+        )
+
+    def load_handler(self):
+        return import_string(self.handler)
+
+
+def record(handler, recording: Recording, *args, **kwargs):
+    """Run the handler as a generator that writes every step into the recording"""
+    gen = handler(*args, **kwargs)
+    if not inspect.isgenerator(gen):
+        recording.result = gen
+        return gen
+
+    value, error = None, None
+    while True:
+        try:
+            if error is None:
+                intent = gen.send(value)
+            else:
+                intent = gen.throw(error)
+        except StopIteration as e:
+            recording.result = e.value
+            return e.value
+        except Exception as e:
+            recording.error = e
+            raise
+
+        step = Step(intent=intent, signature=signature(intent))
+        try:
+            value, error = (yield intent), None
+        except Exception as e:
+            value, error = None, e
+        step.result, step.error = value, error
+        recording.steps.append(step)
+
+
+class ReplayDriver:
+    """
+    Run a recorded handler again, answering every intent from the recording.
+
+    With strict=True every yielded intent must have the signature of the recorded one,
+    and the handler must raise when it raised, otherwise `ReplayDivergence` is raised.
+    """
+
+    def __init__(self, recording: Recording, strict: bool = True):
+        self.recording = recording
+        self.strict = strict
+        self.handler = recording.load_handler()
+
+    def run(self):
+        recording = self.recording
+        steps = recording.steps
+        gen = self.handler(*recording.args, **recording.kwargs)
+        if not inspect.isgenerator(gen):
+            return gen
+
+        position = 0
+        value, error = None, None
+        while True:
+            try:
+                if error is None:
+                    intent = gen.send(value)
+                else:
+                    intent = gen.throw(error)
+            except StopIteration as e:
+                if self.strict and position != len(steps):
+                    raise ReplayDivergence(
+                        f'{recording.handler} returned after {position} of {len(steps)} steps'
+                    )
+                if self.strict and recording.error is not None:
+                    raise ReplayDivergence(
+                        f'{recording.handler} returned, recorded {recording.error!r}'
+                    )
+                return e.value
+
+            if position >= len(steps):
+                raise ReplayDivergence(
+                    f'{recording.handler} yielded more than {len(steps)} steps: {intent!r}'
+                )
+            step = steps[position]
+            position += 1
+            if self.strict and not self.matches(step, intent):
+                raise ReplayDivergence(
+                    f'{recording.handler} step {position}: '
+                    f'expected {step.intent!r}, got {intent!r}'
+                )
+            value, error = step.result, step.error
+
+    @staticmethod
+    def matches(step: Step, intent) -> bool:
+        if step.signature is None:
+            # recorded before the steps had a signature
+            return intent == step.intent
+        return signature(intent) == step.signature
+
+    def benchmark(self, number: int = 1000) -> float:
+        """Average seconds of CPU spent in the handler logic per run"""
+        start = time.process_time()
+        for _ in range(number):
+            try:
+                self.run()
+            except Exception:
+                if self.recording.error is None:
+                    raise
+        return (time.process_time() - start) / number
+
+
+class RecordingWriter:
+    """Append recordings to a file, one pickle after another, from any thread"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def __call__(self, recording: Recording):
+        data = pickle.dumps(recording, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock, open(self.filename, 'ab') as f:
+            f.write(data)
+
+    @staticmethod
+    def read(filename: str) -> Iterator[Recording]:
+        with open(filename, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+
+def recorder_from_settings() -> Optional[RecordingWriter]:
+    filename = getattr(settings, 'SERVER_RECORD_FILENAME', None)
+    if not filename:
+        return None
+    return RecordingWriter(filename)
@@ -0,0 +1,2 @@
+"""Game account server"""
+from . import handlers  # noqa: F401
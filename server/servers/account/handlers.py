@@ -0,0 +1,52 @@
+from django.contrib.auth import get_user_model
+
+from server.intents import Batch, Get
+from server.registry import InvalidMessage, Message, registry, require_user
+
+
+def dump_account(user, viewer=None):
+    """The email only goes to the user it belongs to"""
+    account = {
+        'id': user.pk,
+        'username': user.username,
+        'date_joined': user.date_joined.isoformat(),
+    }
+    if getattr(viewer, 'is_authenticated', False) and viewer.pk == user.pk:
+        account['email'] = user.email
+    return account
+
+
+def user_id_of(message: Message, user_id):
+    if not isinstance(user_id, int) or isinstance(user_id, bool):
+        raise InvalidMessage(f'{message.type}: user ids are integers')
+    return user_id
+
+
+@registry.handler('account.profile')
+def profile(message: Message):
+    user_id = message.data.get('user_id')
+    if user_id is None:
+        user_id = getattr(message.user, 'pk', None)
+    if user_id is None:
+        return None
+    user_id_of(message, user_id)
+    # the account of another user, for staff only
+    if user_id != getattr(message.user, 'pk', None):
+        require_user(message, staff=True)
+
+    user = yield Get(get_user_model(), user_id)
+    return dump_account(user, message.user) if user is not None else None
+
+
+@registry.handler('account.profiles')
+def profiles(message: Message):
+    user_ids = message.data.get('user_ids', [])
+    if not isinstance(user_ids, list):
+        raise InvalidMessage(f'{message.type} needs a list of user_ids')
+    for user_id in user_ids:
+        user_id_of(message, user_id)
+    user_model = get_user_model()
+    users = yield Batch(Get(user_model, pk) for pk in user_ids)
+    return [
+        dump_account(user, message.user) if user is not None else None for user in users
+    ]
@@ -0,0 +1,2 @@
+"""Game role server, roles live in Redis"""
+from . import handlers  # noqa: F401
@@ -0,0 +1,33 @@
+from server.intents import Redis
+from server.registry import InvalidMessage, Message, registry, require_user
+
+
+def role_key(role_id):
+    return f'role:{role_id}'
+
+
+def role_id_of(message: Message):
+    role_id = message.data.get('role_id')
+    if role_id is None:
+        raise InvalidMessage(f'{message.type} needs a role_id')
+    return role_id
+
+
+@registry.handler('role.info')
+def info(message: Message):
+    role_id = role_id_of(message)
+    name, level = yield Redis('HMGET', role_key(role_id), 'name', 'level')
+    return {
+        'role_id': role_id,
+        'name': name.decode() if name is not None else None,
+        'level': int(level) if level is not None else 0,
+    }
+
+
+@registry.handler('role.level_up')
+def level_up(message: Message):
+    role_id = role_id_of(message)
+    # roles belong to no account, only staff changes them
+    require_user(message, staff=True)
+    level = yield Redis('HINCRBY', role_key(role_id), 'level', 1)
+    return {'role_id': role_id, 'level': level}
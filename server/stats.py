@@ -0,0 +1,484 @@
+"""
+Incremental StatsVendor aggregation
+
+Instead of recomputing counters or locking a vendor row per event, events are appended to a
+write-ahead queue and folded in memory into one delta per vendor and counter. Every flush
+applies all of them with one UPDATE:
+
+    UPDATE server_statsvendor
+    SET project_count = COALESCE(project_count, 0)
+        + CASE WHEN vendor_id = 1 THEN 3 WHEN vendor_id = 7 THEN 1 ELSE 0 END, ...
+    WHERE vendor_id IN (1, 7)
+
+Every event carries an idempotency key, keys are stored in the same transaction as the
+update, so replaying a batch after a crash between the commit and its acknowledgement is
+safe. Flushers claim their batches from the queue, several of them can share it. A batch
+that failed `max_attempts` times for another reason than a concurrent flush or a lost lock
+is moved to the dead letters of the queue, for an operator to look at, instead of blocking
+the events behind it forever.
+
+    aggregator = get_aggregator()
+    aggregator.record(StatsEvent(key='order-42-paid', vendor_id=1, total_earned=9.9))
+    aggregator.start()  # flush every settings.STATS_AGGREGATION['flush_interval'] seconds
+
+With `locks`, the vendors of a batch are locked in etcd while it is applied (core.locks),
+aggregators flushing different queues take turns on the vendors they share. The fencing
+token of the locks is stored in StatsVendor.fence by the UPDATE, which only matches rows
+with a fence up to the token: a flush that stalled past its lease, while another holder
+wrote the vendors, updates fewer rows than it expects, rolls back and is retried.
+"""
+import json
+import logging
+import math
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+import attr
+from django.conf import settings
+from django.db import (
+    IntegrityError,
+    OperationalError,
+    close_old_connections,
+    transaction,
+)
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from core.locks import Lock, LockLost, lock
+from server.models import StatsEventKey, StatsVendor
+
+STATS_FIELDS = (
+    'total_earned',
+    'project_count',
+    'project_not_complete_count',
+    'ongoing_tickets',
+)
+
+LOGGER = logging.getLogger('django')
+
+
+@attr.s(slots=True, frozen=True, kw_only=True)
+class StatsEvent:
+    key = attr.ib(type=str)
+    vendor_id = attr.ib(type=int)
+    total_earned = attr.ib(type=float, default=0)
+    project_count = attr.ib(type=int, default=0)
+    project_not_complete_count = attr.ib(type=int, default=0)
+    ongoing_tickets = attr.ib(type=int, default=0)
+
+
+KEY_MAX_LENGTH = StatsEventKey._meta.get_field('key').max_length
+
+
+def validate_event(event: StatsEvent):
+    """ValueError for an event the flush would fail on, after it was queued"""
+    if not isinstance(event, StatsEvent):
+        raise ValueError(f'{event!r} is not a StatsEvent')
+    if not isinstance(event.key, str) or not 0 < len(event.key) <= KEY_MAX_LENGTH:
+        raise ValueError(f'key must be a string of 1 to {KEY_MAX_LENGTH} characters')
+    if not isinstance(event.vendor_id, int) or isinstance(event.vendor_id, bool):
+        raise ValueError(f'vendor_id must be an integer, not {event.vendor_id!r}')
+    for field in STATS_FIELDS:
+        value = getattr(event, field)
+        number = float if field == 'total_earned' else int
+        if (
+            not isinstance(value, (number, int))
+            or isinstance(value, bool)
+            or not math.isfinite(value)
+        ):
+            raise ValueError(
+                f'{field} must be a finite {number.__name__}, not {value!r}'
+            )
+
+
+def dumps_event(event: StatsEvent) -> bytes:
+    return json.dumps(attr.asdict(event), separators=(',', ':')).encode()
+
+
+def loads_event(data: bytes) -> StatsEvent:
+    return StatsEvent(**json.loads(data))
+
+
+class MemoryQueue:
+    """Write-ahead queue of one process, lost when the process dies"""
+
+    def __init__(self):
+        self.events = deque()
+        # token -> events claimed and not acknowledged yet
+        self.claims: Dict[str, List[StatsEvent]] = {}
+        self.dead_letters: List[StatsEvent] = []
+        self.lock = threading.Lock()
+
+    def append(self, event: StatsEvent):
+        self.events.append(event)
+
+    def claim(self, count: int) -> Tuple[str, List[StatsEvent]]:
+        """Take the `count` oldest events out of the queue, for this flusher only"""
+        with self.lock:
+            events = [
+                self.events.popleft() for _ in range(min(count, len(self.events)))
+            ]
+            token = uuid.uuid4().hex
+            if events:
+                self.claims[token] = events
+            return token, events
+
+    def ack(self, token: str):
+        """The claimed events are applied"""
+        self.claims.pop(token, None)
+
+    def release(self, token: str):
+        """The claimed events were not applied, back to the head of the queue"""
+        with self.lock:
+            self.events.extendleft(reversed(self.claims.pop(token, [])))
+
+    def dead_letter(self, token: str):
+        """The claimed events cannot be applied, out of the queue for good"""
+        with self.lock:
+            self.dead_letters.extend(self.claims.pop(token, []))
+
+    def __len__(self):
+        return len(self.events)
+
+
+class RedisQueue:
+    """
+    Write-ahead queue in a Redis list, shared by the processes recording and flushing
+    events.
+
+    A claim moves a batch to a list of its own in one script, two flushers never get the
+    same events. The claims of a flusher that died are moved back to the queue after
+    `claim_timeout` seconds, replayed events are rejected by their idempotency keys.
+    Events are stored as JSON, dead letters in the list `<key>:dead`.
+    """
+
+    CLAIM = """
+    local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+    if #items == 0 then
+        return items
+    end
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    for i = 1, #items, 1000 do
+        redis.call('RPUSH', KEYS[2], unpack(items, i, math.min(i + 999, #items)))
+    end
+    redis.call('ZADD', KEYS[3], ARGV[3], ARGV[2])
+    return items
+    """
+
+    RELEASE = """
+    local items = redis.call('LRANGE', KEYS[2], 0, -1)
+    for i = #items, 1, -1 do
+        redis.call('LPUSH', KEYS[1], items[i])
+    end
+    redis.call('DEL', KEYS[2])
+    redis.call('ZREM', KEYS[3], ARGV[1])
+    return #items
+    """
+
+    DEAD_LETTER = """
+    local items = redis.call('LRANGE', KEYS[2], 0, -1)
+    for i = 1, #items, 1000 do
+        redis.call('RPUSH', KEYS[4], unpack(items, i, math.min(i + 999, #items)))
+    end
+    redis.call('DEL', KEYS[2])
+    redis.call('ZREM', KEYS[3], ARGV[1])
+    return #items
+    """
+
+    def __init__(self, url: str, key: str, claim_timeout: float = 300):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.key = key
+        self.claims_key = f'{key}:claims'
+        self.dead_letters_key = f'{key}:dead'
+        self.claim_timeout = claim_timeout
+        self.claim_script = self.client.register_script(self.CLAIM)
+        self.release_script = self.client.register_script(self.RELEASE)
+        self.dead_letter_script = self.client.register_script(self.DEAD_LETTER)
+
+    def claim_key(self, token: str) -> str:
+        return f'{self.key}:claim:{token}'
+
+    def append(self, event: StatsEvent):
+        self.client.rpush(self.key, dumps_event(event))
+
+    def claim(self, count: int) -> Tuple[str, List[StatsEvent]]:
+        self.release_stale()
+        token = uuid.uuid4().hex
+        items = self.claim_script(
+            keys=[self.key, self.claim_key(token), self.claims_key],
+            args=[count, token, time.time()],
+        )
+        return token, [loads_event(item) for item in items]
+
+    def ack(self, token: str):
+        pipeline = self.client.pipeline()
+        pipeline.delete(self.claim_key(token))
+        pipeline.zrem(self.claims_key, token)
+        pipeline.execute()
+
+    def release(self, token: str):
+        self.release_script(
+            keys=[self.key, self.claim_key(token), self.claims_key], args=[token]
+        )
+
+    def dead_letter(self, token: str):
+        self.dead_letter_script(
+            keys=[
+                self.key,
+                self.claim_key(token),
+                self.claims_key,
+                self.dead_letters_key,
+            ],
+            args=[token],
+        )
+
+    @property
+    def dead_letters(self) -> List[StatsEvent]:
+        return [
+            loads_event(item)
+            for item in self.client.lrange(self.dead_letters_key, 0, -1)
+        ]
+
+    def release_stale(self):
+        """Requeue the claims of the flushers that died with them"""
+        stale = self.client.zrangebyscore(
+            self.claims_key, 0, time.time() - self.claim_timeout
+        )
+        for token in stale:
+            token = token.decode()
+            LOGGER.warning('stats events of claim %s requeued', token)
+            self.release(token)
+
+    def __len__(self):
+        return self.client.llen(self.key)
+
+
+def fold(events: List[StatsEvent]) -> Dict[int, Dict[str, float]]:
+    """vendor_id -> {field: delta}, events with the same key are counted once"""
+    deltas = defaultdict(lambda: dict.fromkeys(STATS_FIELDS, 0))
+    seen = set()
+    for event in events:
+        if event.key in seen:
+            continue
+        seen.add(event.key)
+        vendor_deltas = deltas[event.vendor_id]
+        for field in STATS_FIELDS:
+            vendor_deltas[field] += getattr(event, field)
+    return dict(deltas)
+
+
+def apply_deltas(deltas: Dict[int, Dict[str, float]], fence: Optional[int] = None):
+    """
+    One INSERT for unknown vendors, then one UPDATE for all of them. With a fencing token
+    the UPDATE only touches rows no later token wrote, LockLost when it missed some.
+    """
+    known = set(
+        StatsVendor.objects.filter(vendor_id__in=deltas).values_list(
+            'vendor_id', flat=True
+        )
+    )
+    # vendor_id is unique, a vendor inserted by a concurrent flush is updated below
+    StatsVendor.objects.bulk_create(
+        [
+            StatsVendor(vendor_id=vendor_id, total_earned=0)
+            for vendor_id in deltas
+            if vendor_id not in known
+        ],
+        ignore_conflicts=True,
+    )
+
+    updates = {}
+    for field in STATS_FIELDS:
+        output_field = StatsVendor._meta.get_field(field)
+        whens = [
+            When(vendor_id=vendor_id, then=Value(vendor_deltas[field]))
+            for vendor_id, vendor_deltas in deltas.items()
+            if vendor_deltas[field]
+        ]
+        if whens:
+            updates[field] = Coalesce(
+                F(field), Value(0), output_field=output_field
+            ) + Case(*whens, default=Value(0), output_field=output_field)
+    queryset = StatsVendor.objects.filter(vendor_id__in=deltas)
+    if fence is not None:
+        updates['fence'] = Value(fence)
+        queryset = queryset.filter(Q(fence__lte=fence) | Q(fence=None))
+    if not updates:
+        return
+    updated = queryset.update(**updates)
+    if fence is not None and updated != len(deltas):
+        raise LockLost(f'vendors written with a fencing token above {fence}')
+
+
+class StatsAggregator:
+    # a concurrent flush, a lock lost or the database going away, worth retrying forever
+    RETRIED = (IntegrityError, OperationalError, LockLost)
+
+    def __init__(
+        self,
+        queue=None,
+        batch_size: int = 10000,
+        flush_interval: float = 1,
+        locks: bool = False,
+        lock_timeout: float = 30,
+        max_attempts: int = 3,
+    ):
+        self.queue = queue if queue is not None else MemoryQueue()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.locks = locks
+        self.lock_timeout = lock_timeout
+        self.max_attempts = max_attempts
+        # keys of the batch that failed last -> how many times in a row
+        self.failures: Tuple[Tuple[str, ...], int] = ((), 0)
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(self, event: StatsEvent):
+        validate_event(event)
+        self.queue.append(event)
+
+    def flush(self) -> int:
+        """Apply the queued events, return how many were applied (duplicates excluded)"""
+        applied = 0
+        with self.lock:
+            while True:
+                token, events = self.queue.claim(self.batch_size)
+                if not events:
+                    return applied
+                try:
+                    if self.locks:
+                        applied += self.apply_locked(events)
+                    else:
+                        applied += self.apply(events)
+                except self.RETRIED:
+                    self.queue.release(token)
+                    raise
+                except Exception as e:
+                    if self.failed(events) < self.max_attempts:
+                        self.queue.release(token)
+                        raise
+                    LOGGER.error(
+                        'stats events %s..%s moved to the dead letters',
+                        events[0].key,
+                        events[-1].key,
+                        exc_info=e,
+                    )
+                    self.queue.dead_letter(token)
+                    self.failures = ((), 0)
+                    continue
+                except BaseException:
+                    self.queue.release(token)
+                    raise
+                self.failures = ((), 0)
+                self.queue.ack(token)
+
+    def failed(self, events: List[StatsEvent]) -> int:
+        """How many times in a row this batch failed"""
+        keys = tuple(event.key for event in events)
+        last, count = self.failures
+        self.failures = (keys, count + 1 if keys == last else 1)
+        return self.failures[1]
+
+    def apply_locked(self, events: List[StatsEvent]) -> int:
+        names = [
+            f'stats_vendor/{vendor_id}' for vendor_id in {e.vendor_id for e in events}
+        ]
+        with lock(*names, timeout=self.lock_timeout) as held:
+            return self.apply(events, held)
+
+    @staticmethod
+    def apply(events: List[StatsEvent], held: Optional[Lock] = None) -> int:
+        keys = {event.key for event in events}
+        with transaction.atomic():
+            done = set(
+                StatsEventKey.objects.filter(key__in=keys).values_list('key', flat=True)
+            )
+            events = [event for event in events if event.key not in done]
+            if not events:
+                return 0
+            # unique keys: a concurrent flush of the same events rolls this one back
+            StatsEventKey.objects.bulk_create(
+                [StatsEventKey(key=key) for key in keys - done]
+            )
+            if held is None:
+                apply_deltas(fold(events))
+            else:
+                # fails early, the fenced UPDATE is what rejects a holder that stalled
+                held.check_threadsafe()
+                apply_deltas(fold(events), fence=held.token)
+        return len(keys - done)
+
+    def run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except self.RETRIED as e:
+                LOGGER.info('stats events not flushed this time, retrying', exc_info=e)
+            except Exception as e:
+                LOGGER.warning('stats aggregation flush failed', exc_info=e)
+            finally:
+                close_old_connections()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self.run, name='stats-aggregator', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, flush: bool = True):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if flush:
+            self.flush()
+
+
+def prune_event_keys(older_than: timedelta = None) -> int:
+    """Replays older than this are not expected anymore"""
+    if older_than is None:
+        options = getattr(settings, 'STATS_AGGREGATION', {})
+        older_than = timedelta(seconds=options.get('key_retention_seconds', 7 * 86400))
+    deleted, _ = StatsEventKey.objects.filter(
+        date_added__lt=timezone.now() - older_than
+    ).delete()
+    return deleted
+
+
+_aggregator: Optional[StatsAggregator] = None
+
+
+def get_aggregator() -> StatsAggregator:
+    """The aggregator of this process, configured by settings.STATS_AGGREGATION"""
+    global _aggregator
+
+    if _aggregator is None:
+        options = getattr(settings, 'STATS_AGGREGATION', {})
+        queue = None
+        if options.get('queue') == 'redis':
+            queue = RedisQueue(
+                options['redis_url'],
+                options['queue_key'],
+                claim_timeout=options.get('claim_timeout', 300),
+            )
+        _aggregator = StatsAggregator(
+            queue=queue,
+            batch_size=options.get('batch_size', 10000),
+            flush_interval=options.get('flush_interval', 1),
+            locks=options.get('locks', False),
+            lock_timeout=options.get('lock_timeout', 30),
+            max_attempts=options.get('max_attempts', 3),
+        )
+    return _aggregator
@@ -1,15 +1,30 @@
+import asyncio
+import json
+import time
+
 import pytest
 from django.db import IntegrityError, transaction, connections
 from django.db.models import IntegerField
 from django.db.models.functions import Cast
 from pydantic import ValidationError
 
+from core.locks import LockLost
+from .drivers import AsyncDriver, SyncDriver
+from .identity import identity_map_scope
+from .intents import Batch, Get, Insert, Query, Redis
 from .models import GoodTable, BadTable, StatsVendor, Server
+from .registry import Dispatcher, Message, MessageTypeNotFound, Registry
+from .stats import STATS_FIELDS, StatsAggregator, StatsEvent, apply_deltas
+from .replay import Recording, RecordingWriter, ReplayDivergence, ReplayDriver, record
 
 
 @pytest.fixture(autouse=True)
 def set_test_settings(settings):
     settings.DEBUG = True
+    settings.CACHES = {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    }
+    settings.MODEL_CACHE = {**settings.MODEL_CACHE, 'invalidation_channel': None}
 
 
 @pytest.fixture
@@ -159,3 +174,635 @@ def test_annotate(transactional_db):
 
     for query in connection.queries:
         print(query['sql'])
+
+
+def get_good_and_peers(name):
+    good = yield Query(GoodTable, 'get', kwargs={'name': name})
+    peers = yield Query(GoodTable, 'exclude', kwargs={'pk': good.pk})
+    return good.content, [peer.name for peer in peers]
+
+
+def test_sync_driver(transactional_db, sample_good):
+    GoodTable.objects.create(name='peer', content='')
+
+    content, peers = SyncDriver().run(get_good_and_peers, 'name_sample')
+    assert content == 'content_sample'
+    assert peers == ['peer']
+
+
+def test_driver_throws_into_handler(transactional_db):
+    def handler():
+        try:
+            yield Query(GoodTable, 'get', kwargs={'name': 'missing'})
+        except GoodTable.DoesNotExist:
+            return 'not found'
+
+    assert SyncDriver().run(handler) == 'not found'
+
+
+async def test_async_driver(transactional_db, sample_good):
+    content, peers = await AsyncDriver().run(get_good_and_peers, 'name_sample')
+    assert content == 'content_sample'
+    assert peers == []
+
+
+async def test_async_driver_gather():
+    async def slow_redis(intent):
+        await asyncio.sleep(0.1)
+        return intent.args[0]
+
+    def handler():
+        values = yield [Redis('GET', f'key{i}') for i in range(5)]
+        return values
+
+    driver = AsyncDriver(performers={Redis: slow_redis})
+    start = time.monotonic()
+    assert await driver.run(handler) == [f'key{i}' for i in range(5)]
+    assert time.monotonic() - start < 0.3
+
+
+def test_batch_merges_round_trips(transactional_db):
+    from django.db import connection
+
+    goods = [GoodTable.objects.create(name=f'good{i}') for i in range(5)]
+    mget_calls = []
+
+    def fake_redis(intent):
+        mget_calls.append(intent)
+        return [key.upper() for key in intent.args]
+
+    def handler():
+        results = yield Batch(
+            [Get(GoodTable, good.pk) for good in goods]
+            + [Get(GoodTable, '10000'), Redis('GET', 'a'), Redis('GET', 'b')]
+            + [Insert(GoodTable(name=f'new{i}')) for i in range(3)]
+        )
+        return results
+
+    sql_count = len(connection.queries)
+    results = SyncDriver(performers={Redis: fake_redis}).run(handler)
+    # one IN (...) query and one bulk INSERT
+    sqls = [q['sql'] for q in connection.queries[sql_count:] if q['sql'] != 'BEGIN']
+    assert len(sqls) == 2
+    assert mget_calls == [Redis('MGET', 'a', 'b')]
+
+    assert [r.name for r in results[:5]] == [good.name for good in goods]
+    assert results[5] is None
+    assert results[6:8] == ['A', 'B']
+    assert [r.name for r in results[8:]] == ['new0', 'new1', 'new2']
+    assert GoodTable.objects.count() == 8
+
+    # a None pk picks nothing out of the merged lookup
+    assert SyncDriver().run(lambda: (yield Batch([Get(GoodTable, None)]))) == [None]
+
+
+def test_batch_inserts_without_bulk_pks(transactional_db, monkeypatch):
+    from django.db import connection
+
+    # MySQL: bulk_create leaves the pks unset, the inserts are not merged
+    monkeypatch.setattr(
+        type(connection.features), 'can_return_rows_from_bulk_insert', False
+    )
+    merged, _ = Batch([Insert(GoodTable(name=f'new{i}')) for i in range(2)]).plan()
+    assert [type(intent) for intent in merged] == [Insert, Insert]
+
+    goods = SyncDriver().run(
+        lambda: (yield Batch([Insert(GoodTable(name=f'new{i}')) for i in range(2)]))
+    )
+    assert all(good.pk is not None for good in goods)
+
+
+async def test_async_batch(transactional_db, sample_good):
+    def handler():
+        return (yield Batch([Get(GoodTable, sample_good.pk), Get(GoodTable, 10000)]))
+
+    good, missing = await AsyncDriver().run(handler)
+    assert good == sample_good
+    assert missing is None
+
+
+def test_registry():
+    registry = Registry()
+
+    @registry.handler('echo')
+    def echo(message):
+        return message.data
+        yield
+
+    assert registry.resolve('echo') is echo
+    with pytest.raises(MessageTypeNotFound):
+        registry.resolve('missing')
+    with pytest.raises(ValueError):
+        registry.register('echo', echo)
+
+    dispatcher = Dispatcher(SyncDriver(), registry)
+    assert dispatcher.dispatch(Message('echo', {'a': 1})) == {'a': 1}
+
+
+def test_server_view_dispatch(transactional_db, rf, monkeypatch):
+    from django.contrib.auth.models import AnonymousUser
+
+    from account.models import User
+    from .views import ServerView
+
+    user = User.objects.create_user(email='a@example.com', username='a')
+
+    def post(body, as_user=None):
+        request = rf.post('/servers/', body, content_type='application/json')
+        request.user = as_user or AnonymousUser()
+        return ServerView.as_view()(request)
+
+    response = post({'type': 'account.profiles', 'data': {'user_ids': [user.pk, 1000]}})
+    assert response.status_code == 200
+    data = json.loads(response.content)['data']
+    assert data[0]['username'] == 'a' and 'email' not in data[0]
+    assert data[1] is None
+    response = post({'type': 'account.profile'}, as_user=user)
+    assert json.loads(response.content)['data']['email'] == 'a@example.com'
+
+    assert post({'type': 'no.such.type'}).status_code == 404
+    # handler errors are the caller's, the view stays up
+    assert post({'type': 'role.info'}).status_code == 400
+    assert post({'type': 'account.profiles', 'data': [1]}).status_code == 400
+    response = post({'type': 'account.profile', 'data': {'user_id': 'x'}})
+    assert response.status_code == 400
+
+    # a handler failing is not the client's fault
+    def broken(message):
+        raise RuntimeError('database gone')
+        yield
+
+    monkeypatch.setitem(ServerView.dispatcher.registry.table, 'test.broken', broken)
+    assert post({'type': 'test.broken'}).status_code == 500
+
+    # the accounts of others and the roles are for staff only
+    other = User.objects.create_user(email='b@example.com', username='b')
+    message = {'type': 'account.profile', 'data': {'user_id': other.pk}}
+    assert post(message).status_code == 403
+    assert post(message, as_user=user).status_code == 403
+    level_up = {'type': 'role.level_up', 'data': {'role_id': 1}}
+    assert post(level_up).status_code == 403
+    assert post(level_up, as_user=user).status_code == 403
+    user.is_staff = True
+    response = post(message, as_user=user)
+    assert json.loads(response.content)['data']['username'] == 'b'
+
+
+def test_record_and_replay(transactional_db, sample_good, tmp_path):
+    GoodTable.objects.create(name='peer', content='')
+
+    recording = Recording.start(get_good_and_peers, 'name_sample')
+    result = SyncDriver().run(record(get_good_and_peers, recording, 'name_sample'))
+    assert len(recording.steps) == 2
+    assert recording.result == result
+
+    filename = str(tmp_path / 'recordings')
+    RecordingWriter(filename)(recording)
+    (loaded,) = RecordingWriter.read(filename)
+
+    GoodTable.objects.all().delete()
+    # no database involved from here
+    assert ReplayDriver(loaded).run() == result
+    assert ReplayDriver(loaded).benchmark(number=10) > 0
+
+    loaded.args = ('other name',)
+    with pytest.raises(ReplayDivergence):
+        ReplayDriver(loaded).run()
+
+
+def create_good(name):
+    good = GoodTable(name=name)
+    yield Insert(good)
+    if name == 'taken':
+        raise ValueError(name)
+    return good.name
+
+
+def test_replay_inserts(transactional_db, tmp_path):
+    recording = Recording.start(create_good, 'created')
+    SyncDriver().run(record(create_good, recording, 'created'))
+    # the instance got its pk after it was recorded
+    assert recording.steps[0].intent.instance.pk is not None
+    assert ReplayDriver(recording).run() == 'created'
+
+    failed = Recording.start(create_good, 'taken')
+    with pytest.raises(ValueError):
+        SyncDriver().run(record(create_good, failed, 'taken'))
+    assert isinstance(failed.error, ValueError)
+    filename = str(tmp_path / 'recordings')
+    RecordingWriter(filename)(failed)
+    (loaded,) = RecordingWriter.read(filename)
+    with pytest.raises(ValueError):
+        ReplayDriver(loaded).run()
+
+
+async def test_dispatcher_records(transactional_db):
+    recordings = []
+    dispatcher = Dispatcher(AsyncDriver(), recorder=recordings.append)
+    message = Message('account.profiles', {'user_ids': [1, 2]})
+    assert await dispatcher.dispatch(message) == [None, None]
+
+    (recording,) = recordings
+    assert recording.handler == 'server.servers.account.handlers.profiles'
+    assert ReplayDriver(recording).run() == [None, None]
+
+
+def test_identity_map_many_to_many(transactional_db):
+    from django.contrib.auth.models import Group
+
+    from account.models import User
+
+    user = User.objects.create_user(email='a@example.com', username='a')
+    group = Group.objects.create(name='staff')
+    user.groups.add(group)
+    with identity_map_scope() as identity_map:
+        # forward, then reverse
+        (loaded,) = identity_map.related(user, 'groups')
+        assert loaded is identity_map.get(Group, group.pk)
+        assert [u.pk for u in identity_map.related(loaded, 'user')] == [user.pk]
+
+
+def test_identity_map(transactional_db, sample_good):
+    from django.db import connection
+
+    BadTable.objects.create(good_table=sample_good)
+    BadTable.objects.create(good_table=sample_good)
+
+    with identity_map_scope() as identity_map:
+        sql_count = len(connection.queries)
+
+        good = identity_map.get(GoodTable, sample_good.pk)
+        assert identity_map.get(GoodTable, str(sample_good.pk)) is good
+        bads = identity_map.related(good, 'bad_tables')
+        assert identity_map.related(good, 'bad_tables') is bads
+        assert identity_map.related(bads[0], 'good_table') is good
+        with pytest.raises(ValueError):
+            identity_map.related(good, 'name')
+        assert identity_map.get_many(BadTable, [bad.pk for bad in bads]) == {
+            bad.pk: bad for bad in bads
+        }
+        # driver intents go through the same map
+        assert SyncDriver().run(get_good, good.pk) is good
+        assert len(connection.queries) == sql_count + 2
+
+        good.content = 'changed'
+        identity_map.mark_dirty(good, 'content')
+        for bad in bads:
+            bad.good_table_id = good.pk
+            identity_map.mark_dirty(bad, 'good_table')
+        sql_count = len(connection.queries)
+
+    # one UPDATE per model
+    sqls = [q['sql'] for q in connection.queries[sql_count:]]
+    assert len([sql for sql in sqls if sql.startswith('UPDATE')]) == 2
+    assert GoodTable.objects.get(pk=good.pk).content == 'changed'
+
+
+def get_good(pk):
+    return (yield Get(GoodTable, pk))
+
+
+def test_search_server(transactional_db):
+    from ninja_extra.testing import TestClient
+
+    from metamap.api import ServerAPI
+
+    for i in range(25):
+        Server.objects.create(name=f's{i % 5}', ip=f'10.0.0.{i}')
+    Server.objects.create(name='other', ip='10.0.1.1')
+    client = TestClient(ServerAPI)
+
+    def walk(**params):
+        seen, cursor = [], None
+        while True:
+            query = dict(params, limit=4)
+            if cursor:
+                query['cursor'] = cursor
+            response = client.get('/search_server', query=query)
+            assert response.status_code == 200, response.json()
+            page = response.json()
+            seen.extend(page['items'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                return seen
+
+    items = walk(name='s', field='name', order='DESC')
+    assert len(items) == 25
+    keys = [(item['name'], item['id']) for item in items]
+    assert keys == sorted(keys, reverse=True)
+
+    items = walk(field='date_added')
+    assert [item['id'] for item in items] == sorted(item['id'] for item in items)
+    assert len(items) == 26
+
+    assert (
+        client.get('/search_server', query={'field': 'date_change'}).status_code == 422
+    )
+    assert client.get('/search_server', query={'cursor': 'x'}).status_code == 400
+
+
+def test_cached_reads(transactional_db, settings):
+    from django.db import connection
+    from ninja_extra.testing import TestClient
+
+    from metamap.api import GoodTableAPI, ServerAPI
+    from server.caches import good_table_cache, server_cache
+
+    settings.CACHES = {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    }
+    settings.MODEL_CACHE = {**settings.MODEL_CACHE, 'invalidation_channel': None}
+    server = Server.objects.create(name='s1', ip='10.0.0.1')
+    GoodTable.objects.create(name='good', content='v1')
+    servers, goods = TestClient(ServerAPI), TestClient(GoodTableAPI)
+    try:
+        for _ in range(2):
+            sql_count = len(connection.queries)
+            response = servers.get(f'/get_server/{server.pk}')
+            assert response.json()['name'] == 's1'
+            response = goods.get('/get_good/good')
+            assert response.json()['content'] == 'v1'
+        # the second reads skip the database
+        assert len(connection.queries) == sql_count
+        assert servers.get('/get_server/10000').status_code == 404
+        assert goods.get('/get_good/missing').status_code == 404
+    finally:
+        server_cache.local.clear()
+        good_table_cache.local.clear()
+
+
+def test_keyset_pagination_sql(transactional_db):
+    from django.db import connection
+
+    from core.pagination import keyset_paginate
+
+    for i in range(3):
+        Server.objects.create(name='s', ip=f'10.0.0.{i}')
+
+    page, cursor = keyset_paginate(Server.objects.all(), 'name', limit=2)
+    page, cursor = keyset_paginate(Server.objects.all(), 'name', cursor=cursor)
+    assert [server.ip for server in page] == ['10.0.0.2']
+    assert cursor is None
+    assert 'OFFSET' not in connection.queries[-1]['sql']
+
+
+def test_bulk_create_servers(transactional_db, rf):
+    from django.urls import resolve
+
+    Server.objects.create(name='s0', ip='10.0.0.0')
+    view = resolve('/api-extra/server/bulk_create_servers').func
+
+    def post(body, content_type):
+        request = rf.post(
+            '/api-extra/server/bulk_create_servers', body, content_type=content_type
+        )
+        response = view(request)
+        return response.status_code, json.loads(response.content)
+
+    ndjson = '\n'.join(
+        json.dumps({'name': f's{i}', 'ip': f'10.0.0.{i}'}) for i in range(2500)
+    )
+    status, result = post(ndjson + '\n', 'application/x-ndjson')
+    assert status == 200
+    assert result == {'received': 2500, 'created': 2499, 'updated': 1}
+    assert Server.objects.count() == 2500
+
+    status, result = post(
+        json.dumps([{'name': 's1', 'ip': '10.0.0.1'}, {'name': 'new', 'ip': '::1'}]),
+        'application/json',
+    )
+    assert result == {'received': 2, 'created': 1, 'updated': 1}
+
+    status, result = post(
+        json.dumps([{'name': 'bad'}, {'name': 'new2', 'ip': '::2'}]),
+        'application/json',
+    )
+    assert status == 422
+    assert result['detail'][0]['position'] == 1
+    assert not Server.objects.filter(name='new2').exists()
+
+    status, _ = post('not json', 'application/x-ndjson')
+    assert status == 400
+
+
+def test_upsert_servers_race(transactional_db, monkeypatch):
+    from server import bulk
+
+    Server.objects.create(name='raced', ip='10.0.0.1')
+    selects = []
+
+    def existing_servers(chunk):
+        selects.append(chunk)
+        # the first SELECT ran before a concurrent request inserted `raced`
+        return {} if len(selects) == 1 else real_existing_servers(chunk)
+
+    real_existing_servers = bulk.existing_servers
+    monkeypatch.setattr(bulk, 'existing_servers', existing_servers)
+    result = bulk.upsert_servers([('raced', '10.0.0.1'), ('new', '10.0.0.2')])
+    assert (result.created, result.updated) == (1, 1)
+    assert len(selects) == 2
+    assert Server.objects.count() == 2
+
+
+def test_upsert_servers_deadlock(transactional_db, monkeypatch):
+    from django.db import OperationalError
+
+    from server import bulk
+
+    attempts = []
+
+    def upsert_chunk(chunk):
+        attempts.append(chunk)
+        if len(attempts) == 1:
+            raise OperationalError(bulk.DEADLOCK, 'Deadlock found')
+        return real_upsert_chunk(chunk)
+
+    real_upsert_chunk = bulk.upsert_chunk
+    monkeypatch.setattr(bulk, 'upsert_chunk', upsert_chunk)
+    result = bulk.upsert_servers([('s1', '10.0.0.1')])
+    assert (result.created, result.updated) == (1, 0)
+    assert len(attempts) == 2
+
+    # other operational errors are not retried
+    attempts.clear()
+
+    def upsert_chunk(chunk):
+        attempts.append(chunk)
+        raise OperationalError(2006, 'MySQL server has gone away')
+
+    monkeypatch.setattr(bulk, 'upsert_chunk', upsert_chunk)
+    with pytest.raises(OperationalError):
+        bulk.upsert_servers([('s2', '10.0.0.2')])
+    assert len(attempts) == 1
+
+
+def test_stats_aggregation(transactional_db):
+    from django.db import connection
+
+    StatsVendor.objects.create(vendor_id=1, total_earned=None, project_count=10)
+    aggregator = StatsAggregator()
+    for i in range(100):
+        aggregator.record(
+            StatsEvent(
+                key=f'e{i}', vendor_id=1 + i % 3, total_earned=1.5, project_count=1
+            )
+        )
+    # replayed event
+    aggregator.record(
+        StatsEvent(key='e0', vendor_id=1, total_earned=1.5, project_count=1)
+    )
+
+    sql_count = len(connection.queries)
+    assert aggregator.flush() == 100
+    sqls = [q['sql'] for q in connection.queries[sql_count:]]
+    assert len([sql for sql in sqls if sql.startswith('UPDATE')]) == 1
+
+    vendors = {vendor.vendor_id: vendor for vendor in StatsVendor.objects.all()}
+    assert vendors[1].project_count == 10 + 34
+    assert vendors[1].total_earned == 1.5 * 34
+    assert vendors[2].project_count == 33
+    assert vendors[3].ongoing_tickets == 0
+
+    # a replay of already applied events changes nothing
+    aggregator.record(StatsEvent(key='e1', vendor_id=2, project_count=1))
+    assert aggregator.flush() == 0
+    assert StatsVendor.objects.get(vendor_id=2).project_count == 33
+    assert len(aggregator.queue) == 0
+
+    # a failed batch goes back to the queue, in order
+    aggregator.record(StatsEvent(key='e200', vendor_id=4, project_count=1))
+    aggregator.record(StatsEvent(key='e201', vendor_id=4, project_count=1))
+    aggregator.apply = lambda events: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        aggregator.flush()
+    del aggregator.apply
+    assert [event.key for event in aggregator.queue.events] == ['e200', 'e201']
+    assert aggregator.queue.claims == {}
+    assert aggregator.flush() == 2
+
+    # a batch that keeps failing ends in the dead letters, the events behind it are flushed
+    aggregator = StatsAggregator(batch_size=1, max_attempts=2)
+    aggregator.record(StatsEvent(key='poison', vendor_id=5, project_count=1))
+    aggregator.record(StatsEvent(key='e300', vendor_id=5, project_count=1))
+    real_apply = aggregator.apply
+    aggregator.apply = lambda events: (
+        1 / 0 if events[0].key == 'poison' else real_apply(events)
+    )
+    with pytest.raises(ZeroDivisionError):
+        aggregator.flush()
+    assert aggregator.flush() == 1
+    assert [event.key for event in aggregator.queue.dead_letters] == ['poison']
+    assert len(aggregator.queue) == 0
+    assert StatsVendor.objects.get(vendor_id=5).project_count == 1
+
+    # rejected when recorded, not when flushed
+    for event in (
+        StatsEvent(key='k' * 65, vendor_id=1),
+        StatsEvent(key='', vendor_id=1),
+        StatsEvent(key='e400', vendor_id='1'),
+        StatsEvent(key='e400', vendor_id=1, project_count=1.5),
+        StatsEvent(key='e400', vendor_id=1, total_earned=float('nan')),
+    ):
+        with pytest.raises(ValueError):
+            aggregator.record(event)
+    assert len(aggregator.queue) == 0
+
+
+def test_stats_event_serialization():
+    from .stats import dumps_event, loads_event
+
+    event = StatsEvent(key='e1', vendor_id=1, total_earned=1.5, project_count=2)
+    assert loads_event(dumps_event(event)) == event
+    # JSON, nothing read back from Redis is unpickled
+    assert json.loads(dumps_event(event))['vendor_id'] == 1
+
+
+@pytest.fixture
+def memory_etcd(monkeypatch):
+    """The registry thread of the process on a MemoryEtcd, for this test only"""
+    from core.etcd import MemoryEtcd
+    from core.registry import get_registry_thread
+
+    thread = get_registry_thread()
+    previous = thread.client
+    monkeypatch.setattr('core.registry.etcd_client', MemoryEtcd)
+    thread.client = None
+    yield thread
+    if thread.client is not None:
+        thread.call(thread.client.close)
+    thread.client = previous
+
+
+def test_stats_aggregation_locks(transactional_db, memory_etcd):
+    aggregator = StatsAggregator(locks=True, lock_timeout=1)
+    for i in range(10):
+        aggregator.record(StatsEvent(key=f'e{i}', vendor_id=1 + i % 2, project_count=1))
+    assert aggregator.flush() == 10
+    vendor = StatsVendor.objects.get(vendor_id=2)
+    assert vendor.project_count == 5
+    assert vendor.fence > 0
+    # released once applied
+    assert memory_etcd.call(lambda: memory_etcd.client.store) == {}
+
+    # a holder that stalled while a later one wrote the vendor
+    with pytest.raises(LockLost):
+        with transaction.atomic():
+            deltas = {**dict.fromkeys(STATS_FIELDS, 0), 'project_count': 1}
+            apply_deltas({1: deltas, 2: deltas}, fence=1)
+    assert StatsVendor.objects.get(vendor_id=1).project_count == 5
+
+
+def test_vendors_summary(transactional_db, rf, settings):
+    from django.contrib.auth import get_user_model
+    from django.contrib.auth.models import AnonymousUser
+    from django.db import connection
+    from django.urls import resolve
+
+    StatsVendor.objects.bulk_create(
+        [
+            StatsVendor(
+                vendor_id=1 + i,
+                total_earned=float(i),
+                project_count=2,
+                project_not_complete_count=i % 2,
+                ongoing_tickets=i % 4 // 3,
+            )
+            for i in range(20)
+        ]
+        + [StatsVendor(vendor_id=None, total_earned=None, project_count=None)]
+    )
+
+    view = resolve('/api-extra/stats/vendors/summary').func
+    request = rf.get('/api-extra/stats/vendors/summary', {'top': 2, 'bins': 4})
+    request.user = AnonymousUser()
+    assert view(request).status_code == 403
+
+    request.user = get_user_model().objects.create_user('bob@example.com', 'bob')
+    sql_count = len(connection.queries)
+    response = view(request)
+    assert response.status_code == 200
+    # every column in one scan
+    assert len(connection.queries) == sql_count + 1
+    summary = json.loads(response.content)
+
+    assert summary['rows'] == 21
+    assert summary['truncated'] is False
+    assert summary['vendors'] == 20
+    total_earned = summary['columns']['total_earned']
+    assert total_earned['count'] == 20
+    assert total_earned['sum'] == sum(range(20))
+    assert total_earned['p50'] == 9.5
+    assert sum(summary['total_earned_histogram']['counts']) == 20
+    assert len(summary['total_earned_histogram']['edges']) == 5
+    assert summary['top_earners'] == [
+        {'vendor_id': 20, 'total_earned': 19.0},
+        {'vendor_id': 19, 'total_earned': 18.0},
+    ]
+    assert summary['vendors_with_tickets'] == 5
+    assert summary['not_complete_ratio']['max'] == 0.5
+
+    # a bounded read of a larger table
+    settings.STATS_SUMMARY_MAX_ROWS = 5
+    summary = json.loads(view(request).content)
+    assert summary['rows'] == 5 and summary['truncated'] is True
+    assert 'LIMIT 6' in connection.queries[-1]['sql']
@@ -1,11 +1,28 @@
+import json
+import logging
+
 from django.http import JsonResponse
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
+from server.drivers import SyncDriver
+from server.registry import (
+    Dispatcher,
+    InvalidMessage,
+    MessageTypeNotFound,
+    NotAllowed,
+    parse_message,
+)
+from server.replay import recorder_from_settings
+
+LOGGER = logging.getLogger("django")
+
 
 @method_decorator(csrf_exempt, name="dispatch")
 class ServerView(View):
+    dispatcher = Dispatcher(SyncDriver(), recorder=recorder_from_settings())
+
     def __init__(self, **kwargs):
         super(ServerView, self).__init__(**kwargs)
         self.response_dict = {}
@@ -13,6 +30,30 @@ class ServerView(View):
     def get(self, request):
         return JsonResponse(self.response_dict)
 
+    def post(self, request):
+        """Body: {"type": "account.profile", "data": {...}}"""
+        try:
+            message = parse_message(json.loads(request.body), user=request.user)
+        except ValueError as e:
+            return JsonResponse({"error": f"invalid message: {e}"}, status=400)
+
+        try:
+            result = self.dispatcher.dispatch(message)
+        except MessageTypeNotFound:
+            return JsonResponse(
+                {"error": f"unknown message type {message.type}"}, status=404
+            )
+        except InvalidMessage as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        except NotAllowed as e:
+            return JsonResponse({"error": str(e)}, status=403)
+        except Exception as e:
+            # not the client's fault, and nothing the handler wrote is flushed
+            LOGGER.error("handler of %s failed", message.type, exc_info=e)
+            return JsonResponse({"error": f"{message.type} failed"}, status=500)
+        self.response_dict.update(type=message.type, data=result)
+        return JsonResponse(self.response_dict)
+
 
 async def async_func(request):
     return JsonResponse(